@@ -9,13 +9,18 @@ from flask_mail import Mail
 from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
 from config import Config
+from app.activity import LastSeenTracker
+from app.cache import Cache
+from app.database import ReplicaRouter, RoutingSession, configure_engine, engine_options
+from app.metrics import Metrics
+from app.profiler import QueryProfiler
 
 
 def get_locale():
     return request.accept_languages.best_match(current_app.config['LANGUAGES'])
 
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 migrate = Migrate()
 login = LoginManager()
 login.login_view = 'auth.login'
@@ -23,18 +28,33 @@ login.login_message = _l('Please log in to access this page.')
 mail = Mail()
 moment = Moment()
 babel = Babel()
+last_seen = LastSeenTracker()
+cache = Cache()
+replicas = ReplicaRouter()
+profiler = QueryProfiler()
+metrics = Metrics()
 
 
 def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
 
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(
+        engine_options(app.config), **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
     db.init_app(app)
+    with app.app_context():
+        for engine in db.engines.values():
+            configure_engine(engine, app.config)
+    replicas.init_app(app)
     migrate.init_app(app, db)
     login.init_app(app)
     mail.init_app(app)
     moment.init_app(app)
     babel.init_app(app, locale_selector=get_locale)
+    last_seen.init_app(app)
+    cache.init_app(app)
+    profiler.init_app(app)
+    metrics.init_app(app)
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
@@ -78,10 +98,17 @@ def create_app(config_class=Config):
         file_handler.setLevel(logging.INFO)
         app.logger.addHandler(file_handler)
 
+        slow_query_handler = RotatingFileHandler('logs/slow_queries.log',
+                                                 maxBytes=10240, backupCount=10)
+        slow_query_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        sql_logger = app.logger.getChild('sql')
+        sql_logger.addHandler(slow_query_handler)
+        sql_logger.propagate = False
+
         app.logger.setLevel(logging.INFO)
         app.logger.info('Microblog startup')
 
-        os.makedirs(current_app.config['UPLOAD_FOLDER'], exist_ok=True)
+        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
     return app
 
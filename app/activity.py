@@ -0,0 +1,90 @@
+import atexit
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+from time import monotonic
+from flask import current_app
+import sqlalchemy as sa
+
+
+class LastSeenTracker:
+    """Buffers ``User.last_seen`` updates in memory.
+
+    A request only records activity when the stored value is older than
+    ``LAST_SEEN_WINDOW`` seconds. Buffered timestamps are written back in
+    batched ``UPDATE ... CASE`` statements at request teardown once
+    ``LAST_SEEN_FLUSH_INTERVAL`` seconds have passed since the last flush, or
+    as soon as ``LAST_SEEN_BATCH_SIZE`` users are pending.
+    """
+
+    def __init__(self, app=None):
+        self.pending = {}
+        self.lock = Lock()
+        self.last_flush = monotonic()
+        self.counters = {'recorded': 0, 'skipped': 0, 'flushes': 0,
+                         'rows_flushed': 0, 'errors': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.teardown_request(self.teardown)
+        atexit.register(self.flush_app, app)
+
+    def record(self, user):
+        now = datetime.now(timezone.utc)
+        window = timedelta(seconds=current_app.config['LAST_SEEN_WINDOW'])
+        with self.lock:
+            seen = self.pending.get(user.id, user.last_seen)
+            if seen is not None and seen.tzinfo is None:
+                seen = seen.replace(tzinfo=timezone.utc)
+            if seen is not None and now - seen < window:
+                self.counters['skipped'] += 1
+                return
+            self.pending[user.id] = now
+            self.counters['recorded'] += 1
+
+    def teardown(self, exc):
+        app = current_app._get_current_object()
+        due = monotonic() - self.last_flush >= app.config['LAST_SEEN_FLUSH_INTERVAL']
+        if self.pending and (due or len(self.pending) >= app.config['LAST_SEEN_BATCH_SIZE']):
+            self.flush(app)
+
+    def flush_app(self, app):
+        with app.app_context():
+            self.flush(app)
+
+    def flush(self, app):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = monotonic()
+        if not pending:
+            return 0
+        items = list(pending.items())
+        size = app.config['LAST_SEEN_BATCH_SIZE']
+        db = app.extensions['sqlalchemy']
+        table = db.metadata.tables['user']
+        try:
+            with db.engine.begin() as conn:
+                for i in range(0, len(items), size):
+                    batch = dict(items[i:i + size])
+                    conn.execute(
+                        table.update()
+                        .where(table.c.id.in_(batch))
+                        .values(last_seen=sa.case(batch, value=table.c.id))
+                    )
+        except sa.exc.OperationalError:
+            # e.g. the database is locked; keep the entries for the next flush
+            app.logger.warning('Could not flush last_seen', exc_info=True)
+            with self.lock:
+                self.counters['errors'] += 1
+                for user_id, seen in pending.items():
+                    self.pending.setdefault(user_id, seen)
+            return 0
+        with self.lock:
+            self.counters['flushes'] += 1
+            self.counters['rows_flushed'] += len(items)
+        app.logger.debug('Flushed last_seen for %d users', len(items))
+        return len(items)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, pending=len(self.pending))
@@ -1,18 +1,43 @@
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, time, timedelta, timezone
 import os
-from flask import current_app, render_template, redirect, send_file, url_for, flash, request, Response
+from flask import current_app, render_template, redirect, send_file, url_for, flash, request, Response, \
+    stream_with_context
 from flask.cli import F
 from flask_login import login_required, current_user
 from flask_babel import _
 import sqlalchemy as sa
+import sqlalchemy.orm as so
 import csv
 from io import StringIO
 
-from app import db
+from app import db, profiler
 from app.admin.forms import ApprovePostForm, CreateUserForm
 from app.admin import bp
 from app.main.forms import EmptyForm
-from app.models import Comment, Post, User
+from app.models import Comment, DailyPostStats, Post, User, UserDeletion, as_date
+from app.pagination import paginate
+from app.purge import start_deletion
+from app import moderation, queries
+
+EXPORT_CHUNK_SIZE = 1000
+
+def csv_response(filename, header, rows):
+    """Stream ``rows`` as a CSV download, one chunk of rows at a time."""
+    def generate():
+        si = StringIO()
+        writer = csv.writer(si)
+        writer.writerow(header)
+        for i, row in enumerate(rows, 1):
+            writer.writerow(row)
+            if i % EXPORT_CHUNK_SIZE == 0:
+                yield si.getvalue()
+                si.seek(0)
+                si.truncate(0)
+        yield si.getvalue()
+
+    output = Response(stream_with_context(generate()), mimetype="text/csv")
+    output.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return output
 
 def admin_or_analyst_required():
     if current_user.is_admin() or current_user.is_analyst():
@@ -33,18 +58,12 @@ def admin_dashboard():
         return redirect(url_for('main.index'))
     
     form = ApprovePostForm()
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
 
     # Pending Posts (not approved)
-    pending_posts_query = sa.select(Post).where(Post.is_approved.is_(False)).order_by(Post.timestamp.desc())
-    pending_posts = db.paginate(
-        pending_posts_query,
-        page = page,
-        per_page=current_app.config['POSTS_PER_PAGE'],
-        error_out=False
-    )
-    next_url = url_for('admin.admin_dashboard', page=pending_posts.next_num) if pending_posts.has_next else None
-    prev_url = url_for('admin.admin_dashboard', page=pending_posts.prev_num) if pending_posts.has_prev else None
+    pending_posts = paginate(queries.posts(approved=False), cursor=cursor, count=True)
+    next_url = url_for('admin.admin_dashboard', cursor=pending_posts.next_cursor) if pending_posts.has_next else None
+    prev_url = url_for('admin.admin_dashboard', cursor=pending_posts.prev_cursor) if pending_posts.has_prev else None
 
     total_users = db.session.scalar(sa.select(sa.func.count()).select_from(User))
 
@@ -70,21 +89,15 @@ def all_posts():
     if not current_user.is_admin():
         return redirect(url_for('main.index'))
     
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
     status = request.args.get('status', 'all')
 
-    posts_query = sa.select(Post).order_by(Post.timestamp.desc())
-
-    if status ==  'approved':
-        posts_query = posts_query.where(Post.is_approved.is_(True))
-    elif status == 'pending':
-        posts_query = posts_query.where(Post.is_approved.is_(False))
-
-    posts = db.paginate(posts_query, page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
+    approved = {'approved': True, 'pending': False}.get(status)
+    posts = paginate(queries.posts(approved), cursor=cursor)
     form = EmptyForm()
     
-    next_url = url_for('admin.all_posts', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('admin.all_posts', page=posts.prev_num) if posts.has_prev else None
+    next_url = url_for('admin.all_posts', cursor=posts.next_cursor, status=status) if posts.has_next else None
+    prev_url = url_for('admin.all_posts', cursor=posts.prev_cursor, status=status) if posts.has_prev else None
     
     return render_template(
         'admin/all_posts.html',
@@ -102,7 +115,7 @@ def all_users():
     if not current_user.is_admin():
         return redirect(url_for('main.index'))
     
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
     filter_username = request.args.get('username', '', type=str).strip()
     filter_role = request.args.get('role', '', type=str).strip()
 
@@ -112,12 +125,12 @@ def all_users():
     if filter_role:
         users_query = users_query.where(User.role == filter_role)
 
-    users_query = users_query.order_by(User.username.asc())
+    users_query = users_query.order_by(User.username.asc(), User.id.asc())
 
-    users = db.paginate(users_query, page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
+    users = paginate(users_query, cursor=cursor)
     
-    next_url = url_for('admin.all_users', page=users.next_num) if users.has_next else None
-    prev_url = url_for('admin.all_users', page=users.prev_num) if users.has_prev else None
+    next_url = url_for('admin.all_users', cursor=users.next_cursor, username=filter_username, role=filter_role) if users.has_next else None
+    prev_url = url_for('admin.all_users', cursor=users.prev_cursor, username=filter_username, role=filter_role) if users.has_prev else None
  
     return render_template(
         'admin/all_users.html',
@@ -152,6 +165,8 @@ def approve_post(post_id):
     post = db.session.get(Post, post_id)
     if post:
         post.is_approved = True
+        post.touch()
+        post.fan_out()
         db.session.commit()
         flash(_('Post Approved'))
     return redirect(url_for('admin.admin_dashboard'))
@@ -164,6 +179,7 @@ def delete_post(post_id):
     
     post = db.session.get(Post, post_id)
     if post:
+        post.remove_from_timelines()
         db.session.delete(post)
         db.session.commit()
         flash(_('Post Deleted'))
@@ -173,6 +189,39 @@ def delete_post(post_id):
         return redirect(next_page)
     return redirect(url_for('main.index'))
 
+@bp.route('/admin/posts/bulk', methods=['POST'])
+@login_required
+def bulk_moderate():
+    if not current_user.is_admin():
+        return redirect(url_for('main.index'))
+
+    next_page = request.form.get('next') or url_for('admin.admin_dashboard')
+    form = EmptyForm()
+    action = request.form.get('action')
+    if not form.validate_on_submit() or action not in ('approve', 'delete'):
+        return redirect(next_page)
+
+    query = sa.select(Post.id)
+    if request.form.get('scope') == 'all':
+        # everything matching the list's filter, not just the shown page
+        approved = {'approved': True, 'pending': False}.get(request.form.get('status'))
+        if approved is not None:
+            query = query.where(Post.is_approved.is_(approved))
+    else:
+        ids = request.form.getlist('post_ids', type=int)
+        if not ids:
+            flash(_('No posts selected.'))
+            return redirect(next_page)
+        query = query.where(Post.id.in_(ids))
+
+    if action == 'approve':
+        count = moderation.approve_all(query.where(Post.is_approved.is_(False)))
+        flash(_('%(count)d posts approved.', count=count))
+    else:
+        count = moderation.delete_all(query)
+        flash(_('%(count)d posts deleted.', count=count))
+    return redirect(next_page)
+
 @bp.route('/admin/delete_comment/<int:comment_id>', methods=['POST'])
 @login_required
 def delete_comment(comment_id):
@@ -181,6 +230,7 @@ def delete_comment(comment_id):
     
     comment = db.session.get(Comment, comment_id)
     if comment:
+        comment.post.update_comment_count(-1)
         db.session.delete(comment)
         db.session.commit()
         flash(_('Comment Deleted'))
@@ -196,9 +246,7 @@ def admin_post_detail(post_id):
     if not current_user.is_admin():
         return redirect(url_for('main.index'))
     
-    post = db.first_or_404(sa.select(Post).where(
-        Post.id == post_id
-    ))
+    post = queries.post_or_404(post_id)
     form = ApprovePostForm()
     return render_template(
         'admin/admin_post_detail.html',
@@ -252,15 +300,33 @@ def delete_user(user_id):
         flash('You cannot delete yourself.')
         return redirect(url_for('admin.all_users'))
 
-    try:
-        db.session.delete(user)
-        db.session.commit()
-        flash(f'User {user.username} deleted.')
-    except Exception as e:
-        db.session.rollback()
-        print(e)
-        flash(f'Error deleting user: {str(e)}')
-    return redirect(url_for('admin.all_users'))
+    if not user.is_active:
+        flash(f'User {user.username} is already being deleted.')
+        return redirect(url_for('admin.user_deletions'))
+
+    start_deletion(user)
+    db.session.commit()
+    flash(f'User {user.username} disabled; their content is being deleted.')
+    return redirect(url_for('admin.user_deletions'))
+
+@bp.route('/admin/users/deletions')
+@login_required
+def user_deletions():
+    if not current_user.is_admin():
+        return redirect(url_for('main.index'))
+
+    deletions = paginate(
+        sa.select(UserDeletion).order_by(UserDeletion.created_at.desc(), UserDeletion.id.desc()),
+        cursor=request.args.get('cursor'))
+    next_url = url_for('admin.user_deletions', cursor=deletions.next_cursor) if deletions.has_next else None
+    prev_url = url_for('admin.user_deletions', cursor=deletions.prev_cursor) if deletions.has_prev else None
+    return render_template(
+        'admin/user_deletions.html',
+        title='User Deletions',
+        deletions=deletions,
+        next_url=next_url,
+        prev_url=prev_url
+    )
 
 ##################
 # Analyst routes
@@ -314,27 +380,28 @@ def export_users():
     if filter_role:
         users_query = users_query.where(User.role == filter_role)
 
-    users_query = users_query.order_by(User.id.asc())
-    users = db.session.execute(users_query).scalars().all()
-
-    si = StringIO()
-    writer = csv.writer(si)
-    writer.writerow(["ID", "Username", "Email", "Role", "Last Seen", "Followers Count", "Following Count"])
+    users_query = users_query.order_by(User.id.asc()).with_only_columns(
+        User.id, User.username, User.email, User.role, User.last_seen,
+        User.num_followers, User.num_following
+    )
 
-    for user in users:
-        writer.writerow([
+    rows = (
+        [
             user.id,
             user.username,
             user.email,
             user.role,
             user.last_seen.strftime("%Y-%m-%d %H:%M:%S") if user.last_seen else "",
-            user.followers_count(),
-            user.following_count()
-        ])
-
-    output = Response(si.getvalue(), mimetype="text/csv")
-    output.headers["Content-Disposition"] = "attachment; filename=users_export.csv"
-    return output 
+            user.num_followers,
+            user.num_following
+        ]
+        for user in db.session.execute(users_query.execution_options(yield_per=EXPORT_CHUNK_SIZE))
+    )
+    return csv_response(
+        "users_export.csv",
+        ["ID", "Username", "Email", "Role", "Last Seen", "Followers Count", "Following Count"],
+        rows
+    )
 
 @bp.route('/admin/report')
 @login_required
@@ -346,8 +413,9 @@ def report():
     filter_status = request.args.get('status', 'all')
     filter_user = request.args.get('user', '')
     order = request.args.get('order', 'timestamp_desc')
+    cursor = request.args.get('cursor')
 
-    query = sa.select(Post)
+    query = sa.select(Post).join(Post.author).options(so.contains_eager(Post.author))
 
     if filter_status == 'approved':
         query = query.where(Post.is_approved.is_(True))
@@ -355,38 +423,31 @@ def report():
         query = query.where(Post.is_approved.is_(False))
 
     if filter_user:
-        query = query.join(User).where(User.username.ilike(f"%{filter_user}%"))
+        query = query.where(User.username.ilike(f"%{filter_user}%"))
 
     if order == 'timestamp_asc':
-        query = query.order_by(Post.timestamp.asc())
+        query = query.order_by(Post.timestamp.asc(), Post.id.asc())
     elif order == 'title_asc':
-        query = query.order_by(Post.title.asc())
+        query = query.order_by(Post.title.asc(), Post.id.asc())
     elif order == 'title_desc':
-        query = query.order_by(Post.title.desc())
+        query = query.order_by(Post.title.desc(), Post.id.desc())
     else:  # default
-        query = query.order_by(Post.timestamp.desc())
+        query = query.order_by(Post.timestamp.desc(), Post.id.desc())
 
-    query = query.order_by(Post.timestamp.desc())
-    posts = db.session.scalars(query).all()
+    posts = paginate(query, cursor=cursor)
 
-    metrics = {
-        'total_posts': db.session.scalar(sa.select(sa.func.count(Post.id))),
-        'pending_posts': db.session.scalar(sa.select(sa.func.count(Post.id)).where(Post.is_approved.is_(False))),
-        'total_users': db.session.scalar(sa.select(sa.func.count(User.id))),
-        'posts_with_images': db.session.scalar(sa.select(sa.func.count(Post.id)).where(Post.image.isnot(None))),
-    }
+    metrics = db.session.execute(sa.select(
+        sa.func.count(Post.id).label('total_posts'),
+        sa.func.coalesce(sa.func.sum(sa.case((Post.is_approved.is_(False), 1), else_=0)), 0).label('pending_posts'),
+        sa.select(sa.func.count(User.id)).scalar_subquery().label('total_users'),
+        sa.func.count(Post.image).label('posts_with_images'),
+    )).one()._asdict()
 
-    page = request.args.get('page', 1, type=int)
-    per_page = current_app.config['POSTS_PER_PAGE']
-    start = (page - 1) * per_page
-    end = start + per_page
-    paginated_posts = posts[start:end]
-
-    next_url = url_for('admin.report', page=page + 1, status=filter_status, user=filter_user) if end < len(posts) else None
-    prev_url = url_for('admin.report', page=page - 1, status=filter_status, user=filter_user) if page > 1 else None
+    next_url = url_for('admin.report', cursor=posts.next_cursor, status=filter_status, user=filter_user, order=order) if posts.has_next else None
+    prev_url = url_for('admin.report', cursor=posts.prev_cursor, status=filter_status, user=filter_user, order=order) if posts.has_prev else None
 
     return render_template('admin/report.html',
-                           posts=paginated_posts,
+                           posts=posts.items,
                            metrics=metrics,
                            filter_status=filter_status,
                            filter_user=filter_user,
@@ -407,7 +468,10 @@ def export_report():
     order = request.args.get('order', 'timestamp_desc')
 
     # Build query
-    query = sa.select(Post)
+    query = sa.select(
+        Post.id, Post.title, User.username, Post.is_approved,
+        Post.num_comments, Post.timestamp
+    ).join(Post.author)
 
     if filter_status == 'approved':
         query = query.where(Post.is_approved.is_(True))
@@ -415,7 +479,7 @@ def export_report():
         query = query.where(Post.is_approved.is_(False))
 
     if filter_user:
-        query = query.join(User).where(User.username.ilike(f"%{filter_user}%"))
+        query = query.where(User.username.ilike(f"%{filter_user}%"))
 
     # Apply ordering
     if order == 'timestamp_asc':
@@ -427,25 +491,23 @@ def export_report():
     elif order == 'title_desc':
         query = query.order_by(Post.title.desc())
 
-    posts = db.session.scalars(query).all()
-
     # Generate CSV
-    si = StringIO()
-    writer = csv.writer(si)
-    writer.writerow(['Post ID', 'Title', 'Author', 'Status', 'Comments', 'Timestamp'])
-    for post in posts:
-        writer.writerow([
+    rows = (
+        [
             post.id,
             post.title.replace(',', ' '),
-            post.author.username,
+            post.username,
             'Approved' if post.is_approved else 'Pending',
-            post.comment_count(),
+            post.num_comments,
             post.timestamp.strftime("%Y-%m-%d %H:%M:%S") if post.timestamp else ''
-        ])
-
-    output = Response(si.getvalue(), mimetype="text/csv")
-    output.headers["Content-Disposition"] = "attachment; filename=users_export.csv"
-    return output
+        ]
+        for post in db.session.execute(query.execution_options(yield_per=EXPORT_CHUNK_SIZE))
+    )
+    return csv_response(
+        "posts_report.csv",
+        ['Post ID', 'Title', 'Author', 'Status', 'Comments', 'Timestamp'],
+        rows
+    )
 
 @bp.route('/admin/analytics')
 @login_required
@@ -453,35 +515,54 @@ def analytics():
     resp = admin_or_analyst_required()
     if resp:
         return resp
-    
-    # Posts Over Time
-    posts_query = sa.select(Post).order_by(Post.timestamp.asc())
-    posts = db.session.scalars(posts_query).all()
 
-    # Aggregrate Posts Per Day
+    # Date range (inclusive), defaulting to the last ANALYTICS_DEFAULT_DAYS days
+    today = datetime.now(timezone.utc).date()
+    try:
+        end = date.fromisoformat(request.args.get('end', ''))
+    except ValueError:
+        end = today
+    try:
+        start = date.fromisoformat(request.args.get('start', ''))
+    except ValueError:
+        start = end - timedelta(days=current_app.config['ANALYTICS_DEFAULT_DAYS'] - 1)
+    start_at = datetime.combine(start, time.min)
+    end_at = datetime.combine(end + timedelta(days=1), time.min)
+
+    # Posts Per Day
+    if current_app.config['ANALYTICS_ROLLUP']:
+        posts_query = sa.select(DailyPostStats.day, DailyPostStats.posts, DailyPostStats.approved) \
+                        .where(DailyPostStats.day.between(start, end)) \
+                        .order_by(DailyPostStats.day)
+    else:
+        day = sa.func.date(Post.timestamp)
+        posts_query = sa.select(day, sa.func.count(),
+                                sa.func.sum(sa.case((Post.is_approved, 1), else_=0))) \
+                        .where(Post.timestamp >= start_at, Post.timestamp < end_at) \
+                        .group_by(day) \
+                        .order_by(day)
+
     posts_per_day = {}
     approved_per_day = {}
-    for post in posts:
-        day = post.timestamp.date()
-        posts_per_day[day] = posts_per_day.get(day, 0) + 1
-        if post.is_approved:
-            approved_per_day[day] = approved_per_day.get(day, 0) + 1
-
     pending_per_day = {}
-    for post in posts:
-        day = post.timestamp.date()
-        if not post.is_approved:
-            pending_per_day[day] = pending_per_day.get(day, 0) + 1
+    for day, total, approved in db.session.execute(posts_query):
+        if not total:
+            continue
+        day = as_date(day).isoformat()
+        posts_per_day[day] = total
+        approved_per_day[day] = approved
+        pending_per_day[day] = total - approved
 
     # Active users per day based on last_seen
-    users_query = sa.select(User).order_by(User.last_seen.asc())
-    users = db.session.scalars(users_query).all()
-
-    active_users_per_day = {}
-    for user in users:
-        if user.last_seen:
-            day = user.last_seen.date()
-            active_users_per_day[day] = active_users_per_day.get(day, 0) + 1
+    day = sa.func.date(User.last_seen)
+    active_query = sa.select(day, sa.func.count()) \
+                    .where(User.last_seen >= start_at, User.last_seen < end_at) \
+                    .group_by(day) \
+                    .order_by(day)
+    active_users_per_day = {
+        as_date(day).isoformat(): count
+        for day, count in db.session.execute(active_query)
+    }
 
     # Top Posters
     top_users_query = sa.select(User.username, sa.func.count(Post.id).label('post_count')) \
@@ -497,5 +578,20 @@ def analytics():
         approved_per_day=approved_per_day,
         pending_per_day=pending_per_day,
         active_users_per_day=active_users_per_day,
-        top_users=top_users
-    )
\ No newline at end of file
+        top_users=top_users,
+        start=start,
+        end=end
+    )
+
+@bp.route('/admin/sql')
+@login_required
+def sql_profile():
+    if not current_user.is_admin():
+        return redirect(url_for('main.index'))
+    return render_template(
+        'admin/sql_profile.html',
+        title='SQL Profile',
+        enabled=current_app.config['SQL_PROFILER'],
+        requests=profiler.recent(),
+        threshold=current_app.config['SQL_SLOW_QUERY_THRESHOLD']
+    )
@@ -21,7 +21,7 @@ def login():
         user = db.session.scalar(
             sa.select(User).where(User.username == form.username.data)
         )
-        if user is None or not user.check_password(form.password.data):
+        if user is None or not user.is_active or not user.check_password(form.password.data):
             flash(_('Invalid username or password'))
             return redirect(url_for('auth.login'))
         login_user(user, remember=form.remember_me.data)
@@ -70,6 +70,7 @@ def reset_password_request():
         )
         if user:
             send_password_reset_email(user)
+            db.session.commit()
         flash(_('Check your email for the instructions to reset your password'))
         return redirect(url_for('auth.login'))
     return render_template('auth/reset_password_request.html',
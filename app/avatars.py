@@ -0,0 +1,49 @@
+import colorsys
+import os
+import tempfile
+from PIL import Image, ImageDraw
+from flask import current_app
+
+GRID = 5
+
+
+def avatar_size(size):
+    """The smallest of AVATAR_SIZES that is at least ``size`` pixels, so a
+    handful of files per user serves every size the templates ask for."""
+    sizes = sorted(current_app.config['AVATAR_SIZES'])
+    return next((s for s in sizes if s >= size), sizes[-1])
+
+
+def identicon(digest, size):
+    """A symmetric 5x5 pattern and colour derived from a hex ``digest``."""
+    bits = [int(c, 16) for c in digest]
+    hue = int(digest[-6:], 16) / 0xffffff
+    color = tuple(int(c * 255) for c in colorsys.hls_to_rgb(hue, 0.45, 0.65))
+    image = Image.new('RGB', (size, size), (240, 240, 240))
+    draw = ImageDraw.Draw(image)
+    cell = size / (GRID + 1)
+    margin = cell / 2
+    for row in range(GRID):
+        for col in range((GRID + 1) // 2):
+            if bits[row * 3 + col] % 2:
+                continue
+            for x in {col, GRID - 1 - col}:
+                left, top = margin + x * cell, margin + row * cell
+                draw.rectangle([round(left), round(top),
+                                round(left + cell) - 1, round(top + cell) - 1], fill=color)
+    return image
+
+
+def avatar_file(digest, size):
+    """Name of the identicon for ``digest`` in AVATAR_FOLDER, generating it
+    on first use."""
+    folder = current_app.config['AVATAR_FOLDER']
+    name = f'{digest}-{size}.png'
+    path = os.path.join(folder, name)
+    if not os.path.exists(path):
+        os.makedirs(folder, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=folder, suffix='.part', delete=False) as tmp:
+            identicon(digest, size).save(tmp, format='PNG', optimize=True)
+        # concurrent requests write identical files, the last rename wins
+        os.replace(tmp.name, path)
+    return name
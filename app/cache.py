@@ -0,0 +1,295 @@
+import hashlib
+import json
+import os
+import socket
+import tempfile
+from collections import OrderedDict, defaultdict
+from threading import Lock
+from time import time
+from urllib.parse import urlparse
+from uuid import uuid4
+from flask import current_app
+from flask_babel import get_locale
+from markupsafe import Markup
+
+
+class NullCache:
+    """Caches nothing; every lookup is a miss."""
+    shared = False
+
+    def __init__(self, app):
+        pass
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, timeout):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+class MemoryCache:
+    """Per-process LRU with expiry. Each worker holds its own copy."""
+    shared = False
+
+    def __init__(self, app):
+        self.threshold = app.config['CACHE_THRESHOLD']
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires and expires <= time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        with self.lock:
+            self.entries[key] = (time() + timeout if timeout else 0, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.threshold:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class FileSystemCache:
+    """One file per key under ``CACHE_DIR``, shared by the workers of a host."""
+    shared = True
+
+    def __init__(self, app):
+        self.directory = app.config['CACHE_DIR']
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                expires, value = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if expires and expires <= time():
+            self._unlink(path)
+            return None
+        return value
+
+    def set(self, key, value, timeout):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump([time() + timeout if timeout else 0, value], f)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            self._unlink(tmp)
+            current_app.logger.warning('Could not write cache entry', exc_info=True)
+
+    def delete(self, key):
+        self._unlink(self._path(key))
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            self._unlink(os.path.join(self.directory, name))
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class RedisCache:
+    """Talks the Redis protocol (RESP) over a single socket, so any
+    Redis-compatible server works without a client library. Connection
+    errors are logged and treated as misses."""
+    shared = True
+
+    def __init__(self, app):
+        url = urlparse(app.config['CACHE_REDIS_URL'])
+        self.address = (url.hostname or 'localhost', url.port or 6379)
+        self.password = url.password
+        self.db = int(url.path.lstrip('/') or 0)
+        self.prefix = app.config['CACHE_KEY_PREFIX']
+        self.sock = None
+        self.reader = None
+        self.lock = Lock()
+
+    def _connect(self):
+        self.sock = socket.create_connection(self.address, timeout=1)
+        self.reader = self.sock.makefile('rb')
+        if self.password:
+            self._send('AUTH', self.password)
+        if self.db:
+            self._send('SELECT', self.db)
+
+    def _send(self, *args):
+        parts = [f'*{len(args)}\r\n'.encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+        self.sock.sendall(b''.join(parts))
+        return self._read()
+
+    def _read(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError('connection closed')
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'-':
+            raise ConnectionError(rest.decode())
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            if int(rest) < 0:
+                return None
+            data = self.reader.read(int(rest) + 2)
+            return data[:-2]
+        if kind == b'*':
+            return [self._read() for _ in range(int(rest))]
+        return rest
+
+    def command(self, *args):
+        with self.lock:
+            try:
+                if self.sock is None:
+                    self._connect()
+                return self._send(*args)
+            except OSError:
+                current_app.logger.warning('Cache server unavailable', exc_info=True)
+                if self.sock is not None:
+                    self.sock.close()
+                self.sock = None
+                return None
+
+    def get(self, key):
+        value = self.command('GET', self.prefix + key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key, value, timeout):
+        if timeout:
+            self.command('SET', self.prefix + key, value, 'EX', timeout)
+        else:
+            self.command('SET', self.prefix + key, value)
+
+    def delete(self, key):
+        self.command('DEL', self.prefix + key)
+
+    def clear(self):
+        keys = self.command('KEYS', self.prefix + '*')
+        if keys:
+            self.command('DEL', *keys)
+
+
+BACKENDS = {
+    'null': NullCache,
+    'memory': MemoryCache,
+    'filesystem': FileSystemCache,
+    'redis': RedisCache,
+}
+
+
+class Cache:
+    """Caches rendered HTML for post cards and whole pages.
+
+    Post cards are keyed by the post id and ``Post.version``, which is bumped
+    whenever the card's content changes, so stale entries are never read and
+    simply age out. Pages are keyed by a generation token that is replaced
+    whenever a post is created, edited, approved, commented on or deleted.
+    The token only reaches the processes that read the same backend, so
+    pages are cached only when the backend is shared (``filesystem``,
+    ``redis``) unless ``CACHE_PAGES`` says otherwise. All keys include the
+    locale. Hits and misses are counted per kind of
+    entry (``fragment``, ``page``).
+    """
+
+    def __init__(self, app=None):
+        self.lock = Lock()
+        self.counters = defaultdict(lambda: {'hits': 0, 'misses': 0})
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['cache'] = BACKENDS[app.config['CACHE_TYPE']](app)
+        app.jinja_env.globals['cached'] = self.fragment
+
+    @property
+    def backend(self):
+        return current_app.extensions['cache']
+
+    def _key(self, kind, parts):
+        return ':'.join([kind, *map(str, parts), str(get_locale())])
+
+    def _count(self, kind, hit):
+        with self.lock:
+            self.counters[kind]['hits' if hit else 'misses'] += 1
+
+    def lookup(self, kind, *parts):
+        """Return ``(key, value)``; ``value`` is None on a miss."""
+        key = self._key(kind, parts)
+        value = self.backend.get(key)
+        self._count(kind, value is not None)
+        return key, value
+
+    def store(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = current_app.config['CACHE_DEFAULT_TIMEOUT']
+        self.backend.set(key, value, timeout)
+        return value
+
+    def fragment(self, *parts, caller):
+        """Jinja ``{% call cached(name, ...) %}`` block: renders the body
+        once per key and serves it from the cache afterwards."""
+        key, html = self.lookup('fragment', *parts)
+        if html is None:
+            html = self.store(key, str(caller()))
+        return Markup(html)
+
+    def generation(self, name):
+        token = self.backend.get(f'generation:{name}')
+        return token if token is not None else self.invalidate(name)
+
+    def invalidate(self, name):
+        """Start a new generation of the ``name`` pages."""
+        token = uuid4().hex[:12]
+        self.backend.set(f'generation:{name}', token, 0)
+        return token
+
+    @property
+    def pages_enabled(self):
+        setting = current_app.config['CACHE_PAGES']
+        return self.backend.shared if setting is None else setting
+
+    def page(self, name, *parts):
+        """Return ``(key, html)`` for a page of the ``name`` family."""
+        return self.lookup('page', name, self.generation(name), *parts)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            for kind, counts in self.counters.items():
+                total = counts['hits'] + counts['misses']
+                stats[kind] = dict(counts, ratio=counts['hits'] / total if total else 0.0)
+            return stats
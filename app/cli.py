@@ -1,6 +1,14 @@
+from concurrent.futures import ProcessPoolExecutor
 import os
-from flask import Blueprint
+import signal
+from flask import Blueprint, current_app
 import click
+import sqlalchemy as sa
+from app import db
+from app.images import collect_garbage
+from app.jobs import Worker, enqueue
+from app.language import detect_language
+from app.models import Comment, DailyPostStats, Post, User, followers, timeline
 
 bp = Blueprint('cli', __name__, cli_group=None)
 
@@ -37,4 +45,173 @@ def update():
 def compile():
     """Compile all languages."""
     if os.system('pybabel compile -d app/translations'):
-        raise RuntimeError('compile command failed')
\ No newline at end of file
+        raise RuntimeError('compile command failed')
+
+
+@bp.cli.command()
+@click.option('--workers', type=int, default=None,
+              help='Jobs run at once (default: JOB_WORKERS).')
+@click.option('--burst', is_flag=True,
+              help='Exit once no job is due instead of waiting for more.')
+def worker(workers, burst):
+    """Run queued background jobs."""
+    w = Worker(current_app._get_current_object(), workers)
+    signal.signal(signal.SIGTERM, lambda signum, frame: w.stop())
+    click.echo(f'Worker started with {w.workers} threads.')
+    try:
+        w.run(burst=burst)
+    except KeyboardInterrupt:
+        # run() lets the jobs in progress finish before returning
+        pass
+    click.echo('Worker stopped.')
+
+
+@bp.cli.group('timeline')
+def timeline_group():
+    """Home timeline commands."""
+    pass
+
+
+@timeline_group.command()
+def rebuild():
+    """Rebuild every materialized home timeline."""
+    limit = current_app.config['TIMELINE_FANOUT_LIMIT']
+    own_posts = sa.select(Post.user_id, Post.id, Post.timestamp) \
+        .where(Post.is_approved.is_(True))
+    followed_posts = sa.select(followers.c.follower_id, Post.id, Post.timestamp) \
+        .join(Post, Post.user_id == followers.c.followed_id) \
+        .where(Post.is_approved.is_(True))
+    if limit is not None:
+        popular = sa.select(User.id).where(User.num_followers > limit)
+        followed_posts = followed_posts.where(followers.c.followed_id.not_in(popular))
+    db.session.execute(timeline.delete())
+    db.session.execute(timeline.insert().from_select(
+        ['user_id', 'post_id', 'timestamp'],
+        sa.union(own_posts, followed_posts)
+    ))
+    db.session.commit()
+    count = db.session.scalar(sa.select(sa.func.count()).select_from(timeline))
+    click.echo(f'Rebuilt timelines: {count} entries.')
+
+
+@bp.cli.group()
+def counters():
+    """Denormalized counter commands."""
+    pass
+
+
+@counters.command('rebuild')
+def rebuild_counters():
+    """Recompute follower, following and comment counters."""
+    db.session.execute(sa.update(User).values(
+        num_followers=sa.select(sa.func.count())
+        .where(followers.c.followed_id == User.id)
+        .scalar_subquery(),
+        num_following=sa.select(sa.func.count())
+        .where(followers.c.follower_id == User.id)
+        .scalar_subquery()
+    ))
+    db.session.execute(sa.update(Post).values(
+        num_comments=sa.select(sa.func.count())
+        .where(Comment.post_id == Post.id)
+        .scalar_subquery()
+    ))
+    db.session.commit()
+    click.echo('Counters rebuilt.')
+
+
+@bp.cli.group()
+def search():
+    """Full-text search commands."""
+    pass
+
+
+@search.command('reindex')
+def reindex_search():
+    """Rebuild the post search index."""
+    count = Post.reindex()
+    db.session.commit()
+    click.echo(f'Indexed {count} posts.')
+
+
+@bp.cli.group()
+def analytics():
+    """Analytics commands."""
+    pass
+
+
+@analytics.command()
+def rollup():
+    """Rebuild the daily post statistics from the post table."""
+    days = DailyPostStats.rebuild()
+    db.session.commit()
+    click.echo(f'Rebuilt statistics for {days} days.')
+
+
+@bp.cli.group()
+def language():
+    """Language detection commands."""
+    pass
+
+
+@language.command()
+@click.option('--workers', type=int, default=None,
+              help='Detector processes (default: one per CPU).')
+@click.option('--batch-size', type=int, default=1000,
+              help='Rows read and updated per transaction.')
+def backfill(workers, batch_size):
+    """Detect the language of posts and comments that have none."""
+    sources = [
+        (Post, (Post.title, Post.body), lambda row: f'{row.title}\n{row.body}'),
+        (Comment, (Comment.body,), lambda row: row.body),
+    ]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for model, columns, text in sources:
+            count = 0
+            last_id = 0
+            while True:
+                rows = db.session.execute(
+                    sa.select(model.id, *columns)
+                    .where(model.language.is_(None), model.id > last_id)
+                    .order_by(model.id).limit(batch_size)
+                ).all()
+                if not rows:
+                    break
+                languages = pool.map(detect_language, [text(row) for row in rows],
+                                     chunksize=50)
+                db.session.execute(sa.update(model), [
+                    {'id': row.id, 'language': language}
+                    for row, language in zip(rows, languages)
+                ])
+                db.session.commit()
+                last_id = rows[-1].id
+                count += len(rows)
+            click.echo(f'Detected the language of {count} {model.__tablename__}s.')
+
+
+@bp.cli.group()
+def uploads():
+    """Uploaded file commands."""
+    pass
+
+
+@uploads.command('process')
+def process_images():
+    """Queue variant generation for images uploaded before it existed."""
+    rows = db.session.execute(
+        sa.select(Post.id, Post.image)
+        .where(Post.image.is_not(None), Post.image_format.is_(None))
+    ).all()
+    for post_id, filename in rows:
+        enqueue('process_image', post_id=post_id, filename=filename)
+    db.session.commit()
+    click.echo(f'Queued {len(rows)} images.')
+
+
+@uploads.command()
+@click.option('--grace', type=int, default=None,
+              help='Keep files younger than this many seconds (default: UPLOAD_GC_GRACE).')
+def gc(grace):
+    """Delete uploads that no post uses any more."""
+    blobs, files = collect_garbage(grace)
+    click.echo(f'Deleted {blobs} unused uploads and {files} stray files.')
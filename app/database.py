@@ -0,0 +1,136 @@
+"""Engine profiles.
+
+``DATABASE_PROFILE = 'tuned'`` (the default) sets up each database for
+concurrent web traffic: SQLite gets WAL journaling and the other pragmas
+below on every new connection, server databases get a sized, pre-pinged
+connection pool and a statement timeout. ``'plain'`` keeps the driver's
+defaults.
+
+With ``DATABASE_REPLICA_URLS`` set, reads of ``GET`` requests go to a
+replica (see ``RoutingSession`` and ``ReplicaRouter``).
+"""
+from functools import partial
+import random
+from time import time
+from flask import current_app, request, session
+from flask_sqlalchemy.session import Session
+import sqlalchemy as sa
+
+
+def sqlite_pragmas(config):
+    return {
+        'journal_mode': config['SQLITE_JOURNAL_MODE'],
+        'synchronous': config['SQLITE_SYNCHRONOUS'],
+        'mmap_size': config['SQLITE_MMAP_SIZE'],
+        'cache_size': config['SQLITE_CACHE_SIZE'],
+        'busy_timeout': int(config['DATABASE_BUSY_TIMEOUT'] * 1000),
+        # without this the ON DELETE CASCADE clauses are ignored
+        'foreign_keys': 'ON',
+    }
+
+
+def engine_options(config, uri=None):
+    """``SQLALCHEMY_ENGINE_OPTIONS`` for the database at ``uri``."""
+    url = sa.engine.make_url(uri or config['SQLALCHEMY_DATABASE_URI'])
+    backend = url.get_backend_name()
+    if config['DATABASE_PROFILE'] == 'plain' or backend == 'sqlite':
+        return {}
+    options = {
+        'pool_size': config['DATABASE_POOL_SIZE'],
+        'max_overflow': config['DATABASE_MAX_OVERFLOW'],
+        'pool_timeout': config['DATABASE_POOL_TIMEOUT'],
+        'pool_recycle': config['DATABASE_POOL_RECYCLE'],
+        # drop connections the server closed while they sat in the pool
+        'pool_pre_ping': True,
+    }
+    timeout = int(config['DATABASE_STATEMENT_TIMEOUT'] * 1000)
+    if backend == 'postgresql':
+        options['connect_args'] = {'options': f'-c statement_timeout={timeout}'}
+    return options
+
+
+def _set_pragmas(pragmas, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+
+def _set_mysql_timeout(timeout, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f'SET SESSION max_execution_time = {timeout}')
+    cursor.close()
+
+
+def configure_engine(engine, config):
+    """Apply the per-connection settings of the profile to ``engine``."""
+    if config['DATABASE_PROFILE'] == 'plain':
+        return
+    if engine.dialect.name == 'sqlite':
+        sa.event.listen(engine, 'connect', partial(_set_pragmas, sqlite_pragmas(config)))
+    elif engine.dialect.name in ('mysql', 'mariadb'):
+        sa.event.listen(engine, 'connect', partial(
+            _set_mysql_timeout, int(config['DATABASE_STATEMENT_TIMEOUT'] * 1000)))
+
+
+def replica_engines(config):
+    """An engine for each of ``DATABASE_REPLICA_URLS``, tuned like the primary."""
+    engines = []
+    for uri in config['DATABASE_REPLICA_URLS']:
+        engine = sa.create_engine(uri, **engine_options(config, uri))
+        configure_engine(engine, config)
+        engines.append(engine)
+    return engines
+
+
+class RoutingSession(Session):
+    """Runs ``SELECT`` statements on the replica engine in
+    ``info['replica']`` and everything else on the primary. Once the
+    session flushes or runs a write statement it stops using the replica,
+    so the rest of the request reads its own writes."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if self._flushing or isinstance(clause, sa.sql.dml.UpdateBase):
+            self.info.pop('replica', None)
+        replica = self.info.get('replica')
+        if replica is not None and bind is None and isinstance(clause, sa.sql.Select):
+            return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ReplicaRouter:
+    """Picks a replica for each ``GET`` request.
+
+    A user who sent any other request reads from the primary for the next
+    ``REPLICA_STICKY_SECONDS``, so they see their own changes even while
+    the replicas lag behind.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['replicas'] = replica_engines(app.config)
+        if app.extensions['replicas']:
+            app.before_request(self.start)
+            app.after_request(self.finish)
+            app.teardown_request(self.teardown)
+
+    @staticmethod
+    def start():
+        db_session = current_app.extensions['sqlalchemy'].session
+        if request.method in ('GET', 'HEAD') and session.get('primary_until', 0) < time():
+            db_session.info['replica'] = random.choice(current_app.extensions['replicas'])
+        else:
+            db_session.info.pop('replica', None)
+
+    @staticmethod
+    def finish(response):
+        if request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            session['primary_until'] = time() + current_app.config['REPLICA_STICKY_SECONDS']
+        return response
+
+    @staticmethod
+    def teardown(exc):
+        current_app.extensions['sqlalchemy'].session.info.pop('replica', None)
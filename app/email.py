@@ -1,17 +1,69 @@
-from threading import Thread
-from flask import current_app
+import smtplib
+from threading import Lock, local
 from flask_mail import Message
 from app import mail
+from app.jobs import enqueue, on_worker_shutdown, task
 
+# one SMTP connection per worker thread, reused across messages
+_local = local()
+_connections = []
+_lock = Lock()
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
 
+def _connection():
+    conn = getattr(_local, 'connection', None)
+    if conn is None:
+        conn = mail.connect().__enter__()
+        _local.connection = conn
+        with _lock:
+            _connections.append(conn)
+    return conn
 
-def send_email(subject, sender, recipients, text_body, html_body):
+
+def _close(conn):
+    with _lock:
+        if conn in _connections:
+            _connections.remove(conn)
+    try:
+        if conn.host is not None:
+            conn.host.quit()
+    except smtplib.SMTPException:
+        pass
+
+
+def _drop_connection():
+    conn = getattr(_local, 'connection', None)
+    _local.connection = None
+    if conn is not None:
+        _close(conn)
+
+
+@on_worker_shutdown
+def close_connections():
+    with _lock:
+        connections = list(_connections)
+    for conn in connections:
+        _close(conn)
+
+
+@task('send_email')
+def deliver_email(subject, sender, recipients, text_body, html_body):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    Thread(target=send_async_email,
-           args=(current_app._get_current_object(), msg)).start()
\ No newline at end of file
+    try:
+        try:
+            _connection().send(msg)
+        except smtplib.SMTPServerDisconnected:
+            # the server dropped an idle connection; reconnect once
+            _drop_connection()
+            _connection().send(msg)
+    except Exception:
+        # the connection may be in an unknown state
+        _drop_connection()
+        raise
+
+
+def send_email(subject, sender, recipients, text_body, html_body):
+    enqueue('send_email', subject=subject, sender=sender, recipients=recipients,
+            text_body=text_body, html_body=html_body)
@@ -0,0 +1,139 @@
+import tempfile
+from datetime import datetime, timedelta, timezone
+from PIL import Image, ImageOps, UnidentifiedImageError
+from flask import current_app
+import sqlalchemy as sa
+from app import db
+from app.jobs import task
+from app.models import Blob, Post, fit
+from app.storage import get_storage, variant_name
+
+
+def attach_image(post, file):
+    """Store an uploaded file and make it the image of ``post``.
+
+    The upload is hashed while it is written, and a file that is already
+    stored is not stored again. Returns True when the variants still have
+    to be made (queue ``process_image`` once the post has an id).
+    """
+    storage = get_storage()
+    hash, size, tmp = storage.spool(file.stream)
+    blob = db.session.get(Blob, hash)
+    if blob is None:
+        blob = Blob(hash=hash, extension=file.filename.rsplit('.', 1)[-1].lower(), size=size)
+        try:
+            with db.session.begin_nested():
+                db.session.add(blob)
+        except sa.exc.IntegrityError:
+            # the same file was just uploaded by another request
+            blob = db.session.get(Blob, hash)
+    if blob.format is None and not storage.exists(blob.filename):
+        storage.put(blob.filename, tmp)
+    else:
+        storage.discard(tmp)
+    post.image = blob.filename
+    post.image_width, post.image_height, post.image_format = blob.width, blob.height, blob.format
+    return blob.format is None
+
+
+def normalize(image, fmt):
+    """Apply the EXIF orientation and drop all metadata (EXIF, GPS, ICC)."""
+    image = ImageOps.exif_transpose(image)
+    transparent = image.mode in ('RGBA', 'LA') or \
+        (image.mode == 'P' and 'transparency' in image.info)
+    image = image.convert('RGBA' if transparent and fmt == 'webp' else 'RGB')
+    image.info = {}
+    return image
+
+
+def write_variants(filename, image, fmt):
+    storage = get_storage()
+    for variant, box in current_app.config['IMAGE_VARIANTS'].items():
+        resized = image.resize(fit(image.size, box), Image.LANCZOS)
+        with tempfile.NamedTemporaryFile(dir=storage.temporary_dir(), suffix='.part',
+                                         delete=False) as tmp:
+            resized.save(tmp, format=fmt, quality=current_app.config['IMAGE_QUALITY'])
+        storage.put(variant_name(filename, variant, fmt), tmp.name)
+
+
+@task('process_image')
+def process_image(post_id, filename):
+    """Make resized, metadata-free variants of an uploaded image and record
+    their size on every post that uses it."""
+    post = db.session.get(Post, post_id)
+    if post is None or post.image != filename or post.image_format is not None:
+        # deleted, replaced or already processed in the meantime
+        return
+    hash = Blob.hash_of(filename)
+    blob = db.session.get(Blob, hash) if hash else None
+    processed = blob is None or blob.format is None
+    if processed:
+        fmt = current_app.config['IMAGE_FORMAT']
+        try:
+            with get_storage().open(filename) as f, Image.open(f) as original:
+                image = normalize(original, fmt)
+        except (UnidentifiedImageError, Image.DecompressionBombError):
+            current_app.logger.warning('Dropping unreadable image %s of post %d', filename, post_id)
+            post.image = None
+            post.touch()
+            db.session.commit()
+            return
+        write_variants(filename, image, fmt)
+        width, height = image.size
+        if blob is not None:
+            blob.width, blob.height, blob.format = width, height, fmt
+    else:
+        width, height, fmt = blob.width, blob.height, blob.format
+
+    db.session.execute(
+        sa.update(Post).where(Post.image == filename, Post.image_format.is_(None))
+        .values(image_width=width, image_height=height, image_format=fmt,
+                version=Post.version + 1))
+    db.session.info['posts_changed'] = True
+    db.session.commit()
+    if processed:
+        # the original may carry location and camera details
+        get_storage().delete(filename)
+
+
+def collect_garbage(grace=None):
+    """Delete blobs no post uses any more, and stored files that belong to
+    no blob or post. Anything younger than ``grace`` seconds is kept, as it
+    may belong to an upload in progress. Returns (blobs, files) deleted."""
+    if grace is None:
+        grace = current_app.config['UPLOAD_GC_GRACE']
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=grace)
+    storage = get_storage()
+    variants = current_app.config['IMAGE_VARIANTS']
+
+    def names(filename, fmt):
+        return [filename] + [variant_name(filename, v, fmt) for v in variants] if fmt else [filename]
+
+    # fix any drift, e.g. from posts removed with bulk deletes
+    db.session.execute(sa.update(Blob).values(refcount=sa.select(sa.func.count())
+        .where(Post.image == Blob.hash + '.' + Blob.extension).scalar_subquery()))
+    dead = db.session.scalars(
+        sa.select(Blob).where(Blob.refcount <= 0, Blob.created_at < cutoff)).all()
+    doomed = []
+    for blob in dead:
+        doomed += names(blob.filename, blob.format)
+        db.session.delete(blob)
+    db.session.commit()
+    for name in doomed:
+        storage.delete(name)
+
+    live = set()
+    for filename, fmt in db.session.execute(
+            sa.select(Blob.hash + '.' + Blob.extension, Blob.format)):
+        live.update(names(filename, fmt))
+    for filename, fmt in db.session.execute(
+            sa.select(Post.image, Post.image_format).where(Post.image.is_not(None))):
+        live.update(names(filename, fmt))
+    files = 0
+    for name, modified in list(storage.list()):
+        if modified.tzinfo is None:
+            modified = modified.replace(tzinfo=timezone.utc)
+        if name not in live and modified < cutoff:
+            storage.delete(name)
+            files += 1
+    return len(dead), files
@@ -0,0 +1,176 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from threading import Condition, Event
+from time import monotonic
+from flask import current_app
+import sqlalchemy as sa
+from app import db
+from app.models import Job
+
+TASKS = {}
+SHUTDOWN_HOOKS = []
+
+
+def task(name):
+    """Register the decorated function as the handler of ``name`` jobs. It
+    is called with the job's payload as keyword arguments."""
+    def decorator(f):
+        TASKS[name] = f
+        return f
+    return decorator
+
+
+def on_worker_shutdown(f):
+    """Register ``f`` to release per-thread resources when a worker stops."""
+    SHUTDOWN_HOOKS.append(f)
+    return f
+
+
+def enqueue(name, delay=0, max_attempts=None, **payload):
+    """Queue a ``name`` job. The workers see it once the session commits."""
+    job = Job(name=name, payload=payload,
+              run_at=datetime.now(timezone.utc) + timedelta(seconds=delay),
+              max_attempts=max_attempts or current_app.config['JOB_MAX_ATTEMPTS'])
+    db.session.add(job)
+    return job
+
+
+class Worker:
+    """Runs queued jobs on a bounded pool of threads.
+
+    Jobs are claimed with a conditional ``UPDATE``, so any number of worker
+    processes can share the queue. A failed job is tried again after
+    ``JOB_RETRY_BACKOFF * 2 ** (attempts - 1)`` seconds, until it has been
+    tried ``max_attempts`` times. Jobs left running by a worker that died are
+    queued again after ``JOB_TIMEOUT`` seconds. Jobs that finished more than
+    ``JOB_RETENTION`` seconds ago are deleted every ``JOB_PRUNE_INTERVAL``
+    seconds, so the queue table does not keep growing.
+    """
+
+    def __init__(self, app, workers=None):
+        self.app = app
+        self.workers = workers or app.config['JOB_WORKERS']
+        self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix='job')
+        self.busy = 0
+        self.changed = Condition()
+        self.stopping = Event()
+        self.last_prune = None
+
+    def requeue_stale(self):
+        now = datetime.now(timezone.utc)
+        cutoff = now - timedelta(seconds=self.app.config['JOB_TIMEOUT'])
+        result = db.session.execute(
+            sa.update(Job).where(Job.status == 'running', Job.locked_at < cutoff)
+            .values(status='queued', run_at=now),
+            execution_options={'synchronize_session': False})
+        db.session.commit()
+        return result.rowcount
+
+    def prune(self, batch_size=1000):
+        """Delete finished jobs older than ``JOB_RETENTION``, a batch at a
+        time. Returns the number deleted."""
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.app.config['JOB_RETENTION'])
+        self.last_prune = monotonic()
+        count = 0
+        while True:
+            ids = db.session.scalars(
+                sa.select(Job.id).where(Job.status.in_(('done', 'failed')),
+                                        Job.finished_at < cutoff)
+                .limit(batch_size)).all()
+            if not ids:
+                return count
+            db.session.execute(sa.delete(Job).where(Job.id.in_(ids)),
+                               execution_options={'synchronize_session': False})
+            db.session.commit()
+            count += len(ids)
+
+    def claim(self, limit):
+        now = datetime.now(timezone.utc)
+        ids = db.session.scalars(
+            sa.select(Job.id).where(Job.status == 'queued', Job.run_at <= now)
+            .order_by(Job.run_at, Job.id).limit(limit)).all()
+        claimed = []
+        for id in ids:
+            result = db.session.execute(
+                sa.update(Job).where(Job.id == id, Job.status == 'queued')
+                .values(status='running', locked_at=now, attempts=Job.attempts + 1),
+                execution_options={'synchronize_session': False})
+            # another worker may have taken it first
+            if result.rowcount:
+                claimed.append(id)
+        db.session.commit()
+        return claimed
+
+    def run_once(self):
+        """Hand due jobs to idle threads. Returns the number started."""
+        with self.changed:
+            free = self.workers - self.busy
+        if not free:
+            return 0
+        claimed = self.claim(free)
+        with self.changed:
+            self.busy += len(claimed)
+        for id in claimed:
+            self.pool.submit(self.execute, id)
+        return len(claimed)
+
+    def execute(self, id):
+        try:
+            with self.app.app_context():
+                job = db.session.get(Job, id)
+                try:
+                    TASKS[job.name](**job.payload)
+                except Exception as e:
+                    db.session.rollback()
+                    self.fail(job, e)
+                else:
+                    job.status = 'done'
+                    job.error = None
+                    job.finished_at = datetime.now(timezone.utc)
+                db.session.commit()
+        finally:
+            with self.changed:
+                self.busy -= 1
+                self.changed.notify_all()
+
+    def fail(self, job, error):
+        now = datetime.now(timezone.utc)
+        job.error = f'{type(error).__name__}: {error}'
+        if job.attempts >= job.max_attempts:
+            job.status = 'failed'
+            job.finished_at = now
+            current_app.logger.error('Job %d (%s) failed for good', job.id, job.name,
+                                     exc_info=error)
+        else:
+            delay = self.app.config['JOB_RETRY_BACKOFF'] * 2 ** (job.attempts - 1)
+            job.status = 'queued'
+            job.run_at = now + timedelta(seconds=delay)
+            current_app.logger.warning('Job %d (%s) failed, retrying in %ds',
+                                       job.id, job.name, delay, exc_info=error)
+
+    def run(self, burst=False):
+        """Process jobs until ``stop()`` is called, or with ``burst`` until
+        no job is due."""
+        poll_interval = self.app.config['JOB_POLL_INTERVAL']
+        self.requeue_stale()
+        try:
+            while not self.stopping.is_set():
+                if self.last_prune is None or \
+                        monotonic() - self.last_prune >= self.app.config['JOB_PRUNE_INTERVAL']:
+                    self.prune()
+                if self.run_once():
+                    continue
+                with self.changed:
+                    if burst and not self.busy:
+                        break
+                    # wake up early when a thread frees up
+                    self.changed.wait(poll_interval)
+        finally:
+            self.pool.shutdown(wait=True)
+            for hook in SHUTDOWN_HOOKS:
+                hook()
+
+    def stop(self):
+        self.stopping.set()
+        with self.changed:
+            self.changed.notify_all()
@@ -0,0 +1,13 @@
+from langdetect import DetectorFactory, LangDetectException, detect
+
+# langdetect is randomized; a fixed seed gives the same answer every time
+DetectorFactory.seed = 0
+
+
+def detect_language(text):
+    """Return the language code of ``text``, or '' if it cannot be told."""
+    try:
+        language = detect(text)
+    except LangDetectException:
+        return ''
+    return language if len(language) <= 5 else ''
@@ -1,27 +1,30 @@
-from datetime import datetime, timezone
+import mimetypes
+import os
+import re
 from flask import render_template, flash, redirect, url_for, request, g, \
-    current_app
+    current_app, session, abort, send_from_directory, Response
+from werkzeug.security import safe_join
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
 import sqlalchemy as sa
-from langdetect import detect, LangDetectException
-from app import db
+from app import db, last_seen, cache, metrics
 from app.admin.forms import DeletePostForm
 from app.main.forms import CommentForm, EditProfileForm, EmptyForm, PostForm, SearchForm
 from app.models import Comment, User, Post
-from app.translate import translate
+from app.images import attach_image
+from app.jobs import enqueue
+from app.pagination import paginate
+from app import queries
+from app.avatars import avatar_file
+from app.storage import LocalStorage, get_storage
+from app.translate import TranslationError, translate, translate_batch
 from app.main import bp
 
-import uuid
-import os
-from werkzeug.utils import secure_filename
-
 
 @bp.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        db.session.commit()
+        last_seen.record(current_user)
     g.locale = str(get_locale())
 
 
@@ -38,14 +41,17 @@ def index():
             body=form.post.data, 
             author=current_user, 
             is_approved=True if current_user.is_admin() else False)
+        post.detect_language()
         
+        # in the session first: attach_image queries, which autoflushes
+        db.session.add(post)
         file = form.image.data
-        if file:
-            filename = f"{uuid.uuid4().hex}_{secure_filename(file.filename)}"
-            file.save(os.path.join(current_app.config["UPLOAD_FOLDER"], filename))
-            post.image = filename
+        needs_processing = attach_image(post, file) if file else False
 
-        db.session.add(post)
+        db.session.flush()
+        if needs_processing:
+            enqueue('process_image', post_id=post.id, filename=post.image)
+        post.fan_out()
         db.session.commit()
         if current_user.is_admin():
             flash(_('Your post is now live!'))
@@ -54,28 +60,26 @@ def index():
         return redirect(url_for('main.index'))
     
     # Show posts
-    page = request.args.get('page', 1, type=int)
-    posts = db.paginate(current_user.following_posts(), page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('main.index', page=posts.next_num) \
+    cursor = request.args.get('cursor')
+    posts = paginate(queries.with_authors(current_user.home_timeline()), cursor=cursor,
+                     key=lambda post: (post.timestamp, post.id))
+    next_url = url_for('main.index', cursor=posts.next_cursor) \
         if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) \
+    prev_url = url_for('main.index', cursor=posts.prev_cursor) \
         if posts.has_prev else None
     return render_template('index.html', title='Home', posts=posts, form=form, next_url=next_url, prev_url=prev_url)
 
 @bp.route('/post/<post_id>', methods=['GET', 'POST'])
 def post_detail(post_id):
-    post = db.first_or_404(sa.select(Post).where(
-        Post.id == post_id
-    ))
+    post = queries.post_or_404(post_id)
     form = CommentForm()
     delete_post = DeletePostForm()
 
     # Show Comments
     page = request.args.get('page', 1, type=int)
-    comments = db.paginate(post.get_comments(), page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('main.post_detail', page=comments.next_num) if comments.has_next else None
-    prev_url = url_for('main.post_detail', page=comments.prev_num) if comments.has_prev else None
+    comments = db.paginate(queries.comments(post), page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
+    next_url = url_for('main.post_detail', post_id=post.id, page=comments.next_num) if comments.has_next else None
+    prev_url = url_for('main.post_detail', post_id=post.id, page=comments.prev_num) if comments.has_prev else None
     return render_template('post_detail.html', title=post.title, post=post, form=form, delete_post=delete_post, comments=comments, next_url=next_url, prev_url=prev_url)
 
 @bp.route('/post/<int:post_id>/edit', methods=['GET', 'POST'])
@@ -97,13 +101,13 @@ def edit_post(post_id):
     if form.validate_on_submit():
         post.title = form.title.data
         post.body = form.post.data
+        post.detect_language()
         
         file = form.image.data
-        if file:
-            filename = f"{uuid.uuid4().hex}_{secure_filename(file.filename)}"
-            file.save(os.path.join(current_app.config["UPLOAD_FOLDER"], filename))
-            post.image = filename
+        if file and attach_image(post, file):
+            enqueue('process_image', post_id=post.id, filename=post.image)
         
+        post.touch()
         db.session.commit()
         flash(_("Your post has been updated."))
         return redirect(url_for('main.post_detail', post_id=post_id))
@@ -120,12 +124,7 @@ def delete_post(post_id):
         flash(_("You cannot delete someone else's post."))
         return redirect(url_for('main.post_detail', post_id=post_id))
     
-    if post.image:
-        try:
-            os.remove(os.path.join(current_app.config["UPLOAD_FOLDER"], post.image))
-        except FileNotFoundError:
-            pass
-    
+    post.remove_from_timelines()
     db.session.delete(post)
     db.session.commit()
     flash(_("Your post has been deleted."))
@@ -136,62 +135,123 @@ def delete_post(post_id):
 @bp.route('/post/<post_id>/comment', methods=['GET', 'POST'])
 @login_required
 def make_comment(post_id):
-    post = db.first_or_404(sa.select(Post).where(
-        Post.id == post_id
-    ))
+    post = queries.post_or_404(post_id)
     form = CommentForm()
     if form.validate_on_submit():
         comment = Comment(body=form.body.data, author=current_user, post=post)
+        comment.detect_language()
         db.session.add(comment)
+        post.update_comment_count(1)
         db.session.commit()
         flash(_('You comment is now live!'))
         return redirect(url_for('main.post_detail', post_id=post_id))
     return render_template('post_detail.html', title=post.title, post=post, form=form)
 
+@bp.route('/uploads/<name>')
+def upload(name):
+    """Serve an uploaded file. A stored name never changes content, so
+    browsers may cache it for good and revalidate by its hash."""
+    storage = get_storage()
+    if not isinstance(storage, LocalStorage):
+        return redirect(storage.url(name), 301)
+    etag = name.rsplit('.', 1)[0]
+    max_age = current_app.config['UPLOAD_MAX_AGE']
+    accel = current_app.config['UPLOAD_X_ACCEL_PREFIX']
+    if accel:
+        # let nginx send the bytes (and answer range requests) itself
+        path = safe_join(storage.root, name)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        response = current_app.response_class(mimetype=mimetypes.guess_type(name)[0])
+        response.headers['X-Accel-Redirect'] = accel.rstrip('/') + '/' + name
+    else:
+        response = send_from_directory(storage.root, name, etag=etag, max_age=max_age)
+    return cache_forever(response, etag, max_age)
+
+
+@bp.route('/avatars/<digest>/<int:size>')
+def avatar(digest, size):
+    """Serve a user's identicon. The URL changes with the email address,
+    so the image can be cached for good."""
+    if size not in current_app.config['AVATAR_SIZES'] or \
+            not re.fullmatch('[0-9a-f]{32}', digest):
+        abort(404)
+    folder = current_app.config['AVATAR_FOLDER']
+    if not os.path.exists(os.path.join(folder, f'{digest}-{size}.png')):
+        # only generate files for users that exist
+        db.first_or_404(sa.select(User.id).where(User.avatar_hash == digest))
+    name = avatar_file(digest, size)
+    max_age = current_app.config['AVATAR_MAX_AGE']
+    response = send_from_directory(folder, name, etag=name, max_age=max_age)
+    return cache_forever(response, name, max_age)
+
+
+def cache_forever(response, etag, max_age):
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
+
+@bp.route('/metrics')
+def metrics_view():
+    """Metrics for Prometheus. Needs ``Authorization: Bearer <METRICS_TOKEN>``
+    when a token is configured."""
+    token = current_app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        abort(403)
+    return Response(metrics.render(current_app._get_current_object()),
+                    mimetype='text/plain; version=0.0.4')
+
+
 @bp.route('/explore')
 def explore():
-    page = request.args.get('page', 1, type=int)
-    query = sa.select(Post).where(Post.is_approved.is_(True)).order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('main.explore', page=posts.next_num) \
+    cursor = request.args.get('cursor')
+    # anonymous visitors all see the same page, unless a message is flashed
+    cacheable = cache.pages_enabled and current_user.is_anonymous and '_flashes' not in session
+    if cacheable:
+        key, html = cache.page('explore', cursor)
+        if html is not None:
+            return html
+        # a lagging replica would store an old page under the new generation
+        db.session.info.pop('replica', None)
+    posts = paginate(queries.posts(approved=True), cursor=cursor)
+    next_url = url_for('main.explore', cursor=posts.next_cursor) \
         if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) \
+    prev_url = url_for('main.explore', cursor=posts.prev_cursor) \
         if posts.has_prev else None
-    return render_template('index.html', title='Explore', posts=posts, next_url=next_url, prev_url=prev_url)
+    html = render_template('index.html', title='Explore', posts=posts, next_url=next_url, prev_url=prev_url)
+    if cacheable:
+        cache.store(key, html)
+    return html
 
 
 @bp.route('/user/<username>')
 @login_required
 def user(username):
     user = db.first_or_404(sa.select(User).where(
-        User.username == username
+        User.username == username, User.deleted_at.is_(None)
     ))
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
 
     # Approved posts
-    approved_query = user.posts.select().where(Post.is_approved.is_(True)).order_by(Post.timestamp.desc())
-    approved_posts = db.paginate(approved_query, page=page,
-                        per_page=3,
-                        error_out=False)
-    next_url = url_for('main.user', username=user.username, page=approved_posts.next_num) \
+    approved_posts = paginate(queries.user_posts(user, approved=True), cursor=cursor, per_page=3)
+    next_url = url_for('main.user', username=user.username, cursor=approved_posts.next_cursor) \
         if approved_posts.has_next else None
-    prev_url = url_for('main.user', username=user.username, page=approved_posts.prev_num) \
+    prev_url = url_for('main.user', username=user.username, cursor=approved_posts.prev_cursor) \
         if approved_posts.has_prev else None
     
     # Pending posts (only if the user is viewing their own profile)
     pending_posts = None
     p_next_url = None
     p_prev_url = None
-    p_page = request.args.get('p_page', 1, type=int)
+    p_cursor = request.args.get('p_cursor')
     if user == current_user:
-        pending_query = user.posts.select().where(Post.is_approved.is_(False)).order_by(Post.timestamp.desc())
-        pending_posts = db.paginate(pending_query, page=p_page, 
-                                    per_page=3,
-                                    error_out=False)
-        p_next_url = url_for('main.user', username=user.username, p_page=pending_posts.next_num) \
+        pending_posts = paginate(queries.user_posts(user, approved=False), cursor=p_cursor, per_page=3)
+        p_next_url = url_for('main.user', username=user.username, p_cursor=pending_posts.next_cursor) \
             if pending_posts.has_next else None
-        p_prev_url = url_for('main.user', username=user.username, p_page=pending_posts.prev_num) \
+        p_prev_url = url_for('main.user', username=user.username, p_cursor=pending_posts.prev_cursor) \
             if pending_posts.has_prev else None
     
 
@@ -203,6 +263,8 @@ def user(username):
 def edit_profile():
     form = EditProfileForm(current_user.username)
     if form.validate_on_submit():
+        if form.username.data != current_user.username:
+            current_user.touch_posts()
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
         db.session.commit()
@@ -221,7 +283,7 @@ def follow(username):
     form = EmptyForm()
     if form.validate_on_submit():
         user = db.session.scalar(
-            sa.select(User).where(User.username == username))
+            sa.select(User).where(User.username == username, User.deleted_at.is_(None)))
         if user is None:
             flash(_('User %(username)s not found.', username=username))
             return redirect(url_for('main.index'))
@@ -242,7 +304,7 @@ def unfollow(username):
     form = EmptyForm()
     if form.validate_on_submit():
         user = db.session.scalar(
-            sa.select(User).where(User.username == username))
+            sa.select(User).where(User.username == username, User.deleted_at.is_(None)))
         if user is None:
             flash(_('User %(username)s not found.', username=username))
             return redirect(url_for('main.index'))
@@ -261,30 +323,16 @@ def search():
     form = SearchForm(request.args)
     query = form.query.data
     page = request.args.get('page', 1, type=int)
-    
-    post_query = sa.select(Post).where(
-        sa.and_(
-            Post.is_approved.is_(True),
-            sa.or_(
-                Post.title.ilike(f'%{query}%'),
-                Post.body.ilike(f'%{query}%')
-            )
-        )
-    ).order_by(Post.timestamp.desc())
-
-    posts = db.paginate(
-        post_query,
-        page=page,
-        per_page=current_app.config['POSTS_PER_PAGE'],
-        error_out=False
-    )
+    per_page = current_app.config['POSTS_PER_PAGE']
 
-    next_url = url_for('main.search', query=query, page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.search', query=query, page=posts.prev_num) if posts.has_prev else None
+    posts, total = Post.search(query or '', page, per_page, options=[queries.WITH_AUTHOR])
+
+    next_url = url_for('main.search', query=query, page=page + 1) if total > page * per_page else None
+    prev_url = url_for('main.search', query=query, page=page - 1) if page > 1 else None
 
     return render_template(
         'search_results.html',
-        posts=posts.items,
+        posts=posts,
         query=query,
         next_url=next_url,
         prev_url=prev_url,
@@ -296,6 +344,23 @@ def search():
 @login_required
 def translate_text():
     data = request.get_json()
-    return {'text': translate(data['text'],
-                              data['source_language'],
-                              data['dest_language'])}
\ No newline at end of file
+    if 'post_id' in data or 'comment_id' in data:
+        model = Post if 'post_id' in data else Comment
+        row = db.get_or_404(model, data.get('post_id', data.get('comment_id')))
+        text = translate(row.body, row.language, data['dest_language'])
+        db.session.commit()
+        return {'text': text}
+    if 'texts' in data:
+        try:
+            texts = translate_batch(data['texts'],
+                                    data['source_language'],
+                                    data['dest_language'])
+        except TranslationError as e:
+            return {'error': str(e)}, 502
+        db.session.commit()
+        return {'texts': texts}
+    text = translate(data['text'],
+                     data['source_language'],
+                     data['dest_language'])
+    db.session.commit()
+    return {'text': text}
\ No newline at end of file
@@ -0,0 +1,318 @@
+import atexit
+import glob
+import json
+import os
+import tempfile
+import uuid
+from threading import Lock
+from time import monotonic, perf_counter
+from flask import current_app, g, request
+import sqlalchemy as sa
+
+try:
+    import fcntl
+except ImportError:  # Windows: the files of exited processes are kept as they are
+    fcntl = None
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LAST_SEEN_COUNTERS = {
+    'recorded': 'Requests that buffered a new last_seen time.',
+    'skipped': 'Requests whose last_seen was recent enough to leave alone.',
+    'flushes': 'Batched writes of buffered last_seen times.',
+    'rows_flushed': 'Users whose last_seen was written.',
+    'errors': 'Writes of last_seen that failed and were kept for the next flush.',
+}
+POOL_GAUGES = {
+    'size': 'Connections the pool keeps open.',
+    'checkedout': 'Connections in use.',
+    'overflow': 'Connections open beyond the pool size.',
+}
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(names, values, **extra):
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _merge(total, snapshot):
+    """Add the counters of ``snapshot`` to ``total``, a snapshot of
+    processes that have exited, which has no gauges."""
+    latency = {tuple(key): [buckets, s, n] for *key, buckets, s, n in total['latency']}
+    for *key, buckets, s, n in snapshot['latency']:
+        h = latency.setdefault(tuple(key), [[0] * len(BUCKETS), 0.0, 0])
+        latency[tuple(key)] = [[a + b for a, b in zip(h[0], buckets)], h[1] + s, h[2] + n]
+    responses = {tuple(key): n for *key, n in total['responses']}
+    for *key, n in snapshot['responses']:
+        responses[tuple(key)] = responses.get(tuple(key), 0) + n
+    cache = dict(total['cache'])
+    for kind, (hits, misses) in snapshot['cache'].items():
+        old = cache.get(kind, [0, 0])
+        cache[kind] = [old[0] + hits, old[1] + misses]
+    last_seen = dict(total['last_seen'])
+    for name in LAST_SEEN_COUNTERS:
+        last_seen[name] = last_seen.get(name, 0) + snapshot.get('last_seen', {}).get(name, 0)
+    return {
+        'latency': [list(key) + h for key, h in latency.items()],
+        'responses': [list(key) + [n] for key, n in responses.items()],
+        'in_flight': 0,
+        'pool': {},
+        'cache': cache,
+        'last_seen': last_seen,
+    }
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Metrics:
+    """Request latency and app internals in the Prometheus text format.
+
+    Every process counts its own requests. When ``METRICS_DIR`` is set, as
+    it must be under gunicorn with several workers, each process also
+    writes its counts to ``<pid>-<token>.json`` in that directory at most
+    every ``METRICS_FLUSH_INTERVAL`` seconds, and ``/metrics`` adds up the
+    files of all processes. The token is new for every process, so a
+    worker that gets the PID of an exited one does not overwrite its
+    counts. Files of exited processes are folded into ``exited.json``;
+    their counters are kept, gauges only count live processes. Empty the
+    directory when the server starts.
+    """
+
+    EXITED = 'exited.json'
+
+    def __init__(self, app=None):
+        self.lock = Lock()
+        self.latency = {}
+        self.responses = {}
+        self.in_flight = 0
+        self.last_flush = monotonic()
+        self.pid = self.token = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self.start)
+        app.after_request(self.finish)
+        app.teardown_request(self.teardown)
+        if app.config['METRICS_DIR']:
+            os.makedirs(app.config['METRICS_DIR'], exist_ok=True)
+            atexit.register(self.flush_app, app)
+
+    def start(self):
+        g.metrics_start = perf_counter()
+        with self.lock:
+            self.in_flight += 1
+
+    def finish(self, response):
+        start = g.get('metrics_start')
+        if start is None:
+            return response
+        elapsed = perf_counter() - start
+        key = (request.blueprint or '', request.endpoint or '', request.method)
+        with self.lock:
+            histogram = self.latency.setdefault(
+                key, {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0})
+            for i, bound in enumerate(BUCKETS):
+                if elapsed <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += elapsed
+            histogram['count'] += 1
+            status = key + (str(response.status_code),)
+            self.responses[status] = self.responses.get(status, 0) + 1
+        return response
+
+    def teardown(self, exc):
+        if g.pop('metrics_start', None) is None:
+            return
+        with self.lock:
+            self.in_flight -= 1
+        app = current_app._get_current_object()
+        if app.config['METRICS_DIR'] and \
+                monotonic() - self.last_flush >= app.config['METRICS_FLUSH_INTERVAL']:
+            self.flush(app)
+
+    def snapshot(self, app):
+        """This process's numbers, in the form written to ``METRICS_DIR``."""
+        from app import cache, last_seen  # app imports this module before creating them
+        pool = app.extensions['sqlalchemy'].engine.pool
+        activity = last_seen.stats()
+        with self.lock:
+            return {
+                'latency': [list(key) + [h['buckets'], h['sum'], h['count']]
+                            for key, h in self.latency.items()],
+                'responses': [list(key) + [n] for key, n in self.responses.items()],
+                'in_flight': self.in_flight,
+                'pool': {name: getattr(pool, name)() for name in POOL_GAUGES
+                         if hasattr(pool, name)},
+                'cache': {kind: [s['hits'], s['misses']] for kind, s in cache.stats().items()},
+                'last_seen': activity,
+            }
+
+    def flush_app(self, app):
+        with app.app_context():
+            self.flush(app)
+
+    def filename(self):
+        """Name of this process's file in ``METRICS_DIR``."""
+        # workers forked from a preloaded app must not share the token
+        if self.pid != os.getpid():
+            self.pid, self.token = os.getpid(), uuid.uuid4().hex
+        return f'{self.pid}-{self.token}.json'
+
+    @staticmethod
+    def write(path, snapshot):
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), suffix='.part',
+                                         delete=False) as tmp:
+            json.dump(snapshot, tmp)
+        os.replace(tmp.name, path)
+
+    def flush(self, app):
+        snapshot = self.snapshot(app)
+        self.last_flush = monotonic()
+        self.write(os.path.join(app.config['METRICS_DIR'], self.filename()), snapshot)
+
+    def collect(self, app):
+        """Snapshots of all processes, as ``[(alive, snapshot), ...]``."""
+        directory = app.config['METRICS_DIR']
+        if not directory:
+            return [(True, self.snapshot(app))]
+        self.flush(app)
+        if fcntl is None:
+            snapshots = self.read(directory)
+        else:
+            # one process at a time folds the exited processes into EXITED,
+            # and nobody reads while a file would be counted twice
+            with open(os.path.join(directory, 'exited.lock'), 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                snapshots = self.retire(directory, self.read(directory))
+        return [(alive, snapshot) for path, alive, snapshot in snapshots]
+
+    def retire(self, directory, snapshots):
+        """Add the files of exited processes to EXITED and delete them, so
+        the directory does not grow with every worker restart."""
+        path = os.path.join(directory, self.EXITED)
+        exited = [(p, snapshot) for p, alive, snapshot in snapshots
+                  if not alive and p != path]
+        if not exited:
+            return snapshots
+        total = next((snapshot for p, alive, snapshot in snapshots if p == path),
+                     {'latency': [], 'responses': [], 'cache': {}, 'last_seen': {}})
+        for p, snapshot in exited:
+            total = _merge(total, snapshot)
+        self.write(path, total)
+        for p, snapshot in exited:
+            os.remove(p)
+        return [s for s in snapshots if s[1]] + [(path, False, total)]
+
+    def read(self, directory):
+        """The files in ``directory``, as ``[(path, alive, snapshot), ...]``."""
+        snapshots = []
+        for path in glob.glob(os.path.join(directory, '*.json')):
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            name = os.path.basename(path)
+            alive = name != self.EXITED and _alive(int(name.split('.')[0].split('-')[0]))
+            snapshots.append((path, alive, snapshot))
+        return snapshots
+
+    def render(self, app):
+        """All metrics in the Prometheus text exposition format."""
+        from app.models import Blob, Job  # the models import app
+        latency, responses, cache, pool = {}, {}, {}, {}
+        activity = dict.fromkeys(LAST_SEEN_COUNTERS, 0)
+        in_flight = pending = 0
+        for alive, snapshot in self.collect(app):
+            for *key, buckets, total, count in snapshot['latency']:
+                h = latency.setdefault(tuple(key), [[0] * len(BUCKETS), 0.0, 0])
+                h[0] = [a + b for a, b in zip(h[0], buckets)]
+                h[1] += total
+                h[2] += count
+            for *key, n in snapshot['responses']:
+                responses[tuple(key)] = responses.get(tuple(key), 0) + n
+            for kind, (hits, misses) in snapshot['cache'].items():
+                counts = cache.setdefault(kind, [0, 0])
+                counts[0] += hits
+                counts[1] += misses
+            # files written before these were collected have none
+            stats = snapshot.get('last_seen', {})
+            for name in LAST_SEEN_COUNTERS:
+                activity[name] += stats.get(name, 0)
+            if alive:
+                in_flight += snapshot['in_flight']
+                pending += stats.get('pending', 0)
+                for name, value in snapshot['pool'].items():
+                    pool[name] = pool.get(name, 0) + value
+
+        db = app.extensions['sqlalchemy']
+        queued = db.session.execute(
+            sa.select(Job.name, sa.func.count()).where(Job.status == 'queued')
+            .group_by(Job.name)).all()
+        failed = db.session.scalar(
+            sa.select(sa.func.count()).select_from(Job).where(Job.status == 'failed'))
+        blobs, upload_bytes = db.session.execute(
+            sa.select(sa.func.count(), sa.func.coalesce(sa.func.sum(Blob.size), 0))).one()
+
+        lines = []
+
+        def metric(name, type, help, samples):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {type}')
+            for suffix, labels, value in samples:
+                lines.append(f'{name}{suffix}{labels} {value}')
+
+        route = ('blueprint', 'endpoint', 'method')
+        samples = []
+        for key, (buckets, total, count) in sorted(latency.items()):
+            for bound, n in zip(BUCKETS, buckets):
+                samples.append(('_bucket', _labels(route, key, le=f'{bound:g}'), n))
+            samples.append(('_bucket', _labels(route, key, le='+Inf'), count))
+            samples.append(('_sum', _labels(route, key), float(total)))
+            samples.append(('_count', _labels(route, key), count))
+        metric('microblog_request_duration_seconds', 'histogram',
+               'Time spent handling requests.', samples)
+        metric('microblog_responses_total', 'counter', 'Responses sent, by status code.',
+               [('', _labels(route + ('status',), key), n)
+                for key, n in sorted(responses.items())])
+        metric('microblog_requests_in_flight', 'gauge', 'Requests being handled.',
+               [('', '', in_flight)])
+        for name, help in POOL_GAUGES.items():
+            if name in pool:
+                metric(f'microblog_db_pool_{name}', 'gauge', help, [('', '', pool[name])])
+        metric('microblog_job_queue_depth', 'gauge', 'Jobs waiting to run, by task.',
+               [('', _labels(('name',), (name,)), n) for name, n in sorted(queued)])
+        metric('microblog_jobs_failed', 'gauge', 'Jobs that gave up after their last attempt.',
+               [('', '', failed)])
+        metric('microblog_cache_hits_total', 'counter', 'Cache lookups that found an entry.',
+               [('', _labels(('kind',), (kind,)), hits)
+                for kind, (hits, misses) in sorted(cache.items())])
+        metric('microblog_cache_misses_total', 'counter', 'Cache lookups that found nothing.',
+               [('', _labels(('kind',), (kind,)), misses)
+                for kind, (hits, misses) in sorted(cache.items())])
+        metric('microblog_cache_hit_ratio', 'gauge', 'Share of cache lookups that hit.',
+               [('', _labels(('kind',), (kind,)), hits / (hits + misses) if hits + misses else 0.0)
+                for kind, (hits, misses) in sorted(cache.items())])
+        for name, help in LAST_SEEN_COUNTERS.items():
+            metric(f'microblog_last_seen_{name}_total', 'counter', help,
+                   [('', '', activity[name])])
+        metric('microblog_last_seen_pending', 'gauge',
+               'Users whose last_seen is buffered, not yet written.', [('', '', pending)])
+        metric('microblog_upload_blobs', 'gauge', 'Stored uploads.', [('', '', blobs)])
+        metric('microblog_upload_bytes', 'gauge', 'Size of the stored uploads.',
+               [('', '', upload_bytes)])
+        return '\n'.join(lines) + '\n'
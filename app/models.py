@@ -1,11 +1,17 @@
 from hashlib import md5
 from typing import List
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timezone
+from datetime import date, datetime, timezone
 import sqlalchemy as sa
 import sqlalchemy.orm as so
-from app import db, login
-from flask import current_app
+from app import db, login, cache
+from app.avatars import avatar_size
+from app.language import detect_language
+from app.pagination import clear_count_cache
+from app.storage import get_storage, variant_name
+from app.search import add_to_index, remove_from_index, query_index, reindex, \
+    get_backend, rank
+from flask import current_app, url_for
 from flask_login import UserMixin
 from time import time
 import jwt
@@ -14,13 +20,74 @@ followers = sa.Table(
     'followers',
     db.metadata,
     sa.Column('follower_id', sa.Integer, sa.ForeignKey('user.id', ondelete="CASCADE"), primary_key=True),
-    sa.Column('followed_id', sa.Integer, sa.ForeignKey('user.id', ondelete="CASCADE"), primary_key=True)
+    sa.Column('followed_id', sa.Integer, sa.ForeignKey('user.id', ondelete="CASCADE"), primary_key=True),
+    # the primary key only serves lookups by follower
+    sa.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id')
 )
 
+# Materialized home timelines (fan-out on write). One row per post visible in
+# a user's feed; timestamp is copied from the post so the feed is a single
+# range scan over (user_id, timestamp).
+timeline = sa.Table(
+    'timeline',
+    db.metadata,
+    sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id', ondelete="CASCADE"), primary_key=True),
+    sa.Column('post_id', sa.Integer, sa.ForeignKey('post.id', ondelete="CASCADE"), primary_key=True),
+    sa.Column('timestamp', sa.DateTime, nullable=False),
+    sa.Index('ix_timeline_user_id_timestamp_post_id', 'user_id', 'timestamp', 'post_id')
+)
+
+class SearchableMixin:
+    @classmethod
+    def search(cls, expression, page, per_page, options=()):
+        """Return a page of matches ranked by relevance and recency, and the
+        total number of matches. ``options`` are applied to the query that
+        loads the page, e.g. to eager-load relationships."""
+        index, fields = cls.__tablename__, cls.__searchable__
+        if not get_backend(index, fields).loaded:
+            cls.reindex()
+        matches = query_index(index, fields, expression,
+                              current_app.config['SEARCH_MAX_RESULTS'])
+        if not matches:
+            return [], 0
+        timestamps = dict(db.session.execute(
+            sa.select(cls.id, cls.timestamp)
+            .where(cls.id.in_([id for id, _ in matches]))
+        ).all())
+        ids = rank(matches, timestamps)
+        page_ids = ids[(page - 1) * per_page:page * per_page]
+        if not page_ids:
+            return [], len(ids)
+        order = {id: i for i, id in enumerate(page_ids)}
+        results = db.session.scalars(
+            sa.select(cls).where(cls.id.in_(page_ids)).options(*options)).all()
+        return sorted(results, key=lambda obj: order[obj.id]), len(ids)
+
+    @classmethod
+    def reindex(cls):
+        return reindex(cls.__tablename__, cls.__searchable__, cls.searchable_query())
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        for obj in session.new | session.dirty:
+            if isinstance(obj, SearchableMixin):
+                if obj.is_searchable():
+                    add_to_index(obj.__tablename__, obj, session.connection())
+                elif obj in session.dirty:
+                    remove_from_index(obj.__tablename__, obj, session.connection())
+        for obj in session.deleted:
+            if isinstance(obj, SearchableMixin):
+                remove_from_index(obj.__tablename__, obj, session.connection())
+
+
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
+
+
 class User(UserMixin, db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     username: so.Mapped[str] = so.mapped_column(sa.String(64), index=True, unique=True)
     email: so.Mapped[str] = so.mapped_column(sa.String(120), index=True, unique=True)
+    avatar_hash: so.Mapped[str | None] = so.mapped_column(sa.String(32), index=True)
     password_hash: so.Mapped[str | None] = so.mapped_column(sa.String(256))
     role: so.Mapped[str] = so.mapped_column(
     sa.String(20), default="user", nullable=False
@@ -43,9 +110,17 @@ class User(UserMixin, db.Model):
         passive_deletes=True
     )
     comments: so.WriteOnlyMapped['Comment'] = so.relationship(back_populates='author', cascade='all, delete-orphan', passive_deletes=True)
+    num_followers: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    num_following: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    # set when an admin deletes the account; the rows go in the background
+    deleted_at: so.Mapped[datetime | None]
 
     def __repr__(self) -> str:
         return f'<User {self.username}>'
+
+    @property
+    def is_active(self):
+        return self.deleted_at is None
     
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -67,33 +142,60 @@ class User(UserMixin, db.Model):
             return
         return db.session.get(User, id)
     
+    @so.validates('email')
+    def set_avatar_hash(self, key, email):
+        # computed once here instead of on every avatar() call
+        self.avatar_hash = md5(email.lower().encode('utf-8')).hexdigest() if email else None
+        return email
+
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+        if current_app.config['AVATAR_PROVIDER'] == 'gravatar':
+            return f'https://www.gravatar.com/avatar/{self.avatar_hash}?d=identicon&s={size}'
+        return url_for('main.avatar', digest=self.avatar_hash, size=avatar_size(size))
     
     def follow(self, user):
-        if not self.is_following(user):
+        # nobody may follow an account that is being purged
+        if user.is_active and not self.is_following(user):
             self.following.add(user)
+            self.update_follow_counts(user, 1)
+            self.backfill_timeline(user)
 
     def unfollow(self, user):
         if self.is_following(user):
             self.following.remove(user)
+            self.update_follow_counts(user, -1)
+            self.prune_timeline(user)
+            User.lost_a_follower([user.id])
+
+    def update_follow_counts(self, user, delta):
+        db.session.execute(
+            sa.update(User).where(User.id == self.id)
+            .values(num_following=User.num_following + delta)
+        )
+        db.session.execute(
+            sa.update(User).where(User.id == user.id)
+            .values(num_followers=User.num_followers + delta)
+        )
+
+    def touch_posts(self):
+        """Bump the version of this user's posts, whose cached cards show
+        the author's name and avatar."""
+        db.session.execute(
+            sa.update(Post).where(Post.user_id == self.id)
+            .values(version=Post.version + 1),
+            execution_options={'synchronize_session': False}
+        )
+        db.session.info['posts_changed'] = True
 
     def is_following(self, user):
         query = self.following.select().where(User.id == user.id)
         return db.session.scalar(query) is not None
     
     def followers_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.followers.select().subquery()
-        )
-        return db.session.scalar(query)
+        return self.num_followers
     
     def following_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.following.select().subquery()
-        )
-        return db.session.scalar(query)
+        return self.num_following
     
     def following_posts(self):
         Author = so.aliased(User)
@@ -107,9 +209,95 @@ class User(UserMixin, db.Model):
                 Author.id == self.id,
             ), Post.is_approved.is_(True))
             .distinct(Post.id)
-            .order_by(Post.timestamp.desc())
+            .order_by(Post.timestamp.desc(), Post.id.desc())
         )
     
+    def fans_out_on_read(self) -> bool:
+        # Accounts above the fan-out limit are merged into feeds at read time
+        # instead of writing one timeline row per follower.
+        limit = current_app.config['TIMELINE_FANOUT_LIMIT']
+        return limit is not None and self.followers_count() > limit
+
+    def backfill_timeline(self, user):
+        if not current_app.config['TIMELINE_FANOUT']:
+            return
+        if user != self and user.fans_out_on_read():
+            return
+        existing = sa.select(timeline.c.post_id).where(timeline.c.user_id == self.id)
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            sa.select(sa.literal(self.id), Post.id, Post.timestamp).where(
+                Post.user_id == user.id,
+                Post.is_approved.is_(True),
+                Post.id.not_in(existing)
+            )
+        ))
+
+    def backfill_followers(self):
+        """Give every follower timeline rows for this user's posts."""
+        if not current_app.config['TIMELINE_FANOUT']:
+            return
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            sa.select(followers.c.follower_id, Post.id, Post.timestamp)
+            .join(Post, Post.user_id == followers.c.followed_id)
+            .where(followers.c.followed_id == self.id, Post.is_approved.is_(True),
+                   ~sa.exists().where(timeline.c.user_id == followers.c.follower_id,
+                                      timeline.c.post_id == Post.id))
+        ))
+
+    @staticmethod
+    def lost_a_follower(ids):
+        """Call after the follower count of the users ``ids`` went down by
+        one. Posts written while a user was above TIMELINE_FANOUT_LIMIT were
+        only merged into feeds at read time; once the user is back at the
+        limit they are fanned out, or they would drop out of the feeds."""
+        limit = current_app.config['TIMELINE_FANOUT_LIMIT']
+        if not ids or limit is None or not current_app.config['TIMELINE_FANOUT']:
+            return
+        for user in db.session.scalars(
+                sa.select(User).where(User.id.in_(ids), User.num_followers == limit)):
+            user.backfill_followers()
+
+    def prune_timeline(self, user):
+        if not current_app.config['TIMELINE_FANOUT']:
+            return
+        db.session.execute(timeline.delete().where(
+            timeline.c.user_id == self.id,
+            timeline.c.post_id.in_(sa.select(Post.id).where(Post.user_id == user.id))
+        ))
+
+    def home_timeline(self):
+        if not current_app.config['TIMELINE_FANOUT']:
+            return self.following_posts()
+        query = (
+            sa.select(Post)
+            .join(timeline, timeline.c.post_id == Post.id)
+            .where(timeline.c.user_id == self.id)
+            .order_by(timeline.c.timestamp.desc(), timeline.c.post_id.desc())
+        )
+        limit = current_app.config['TIMELINE_FANOUT_LIMIT']
+        if limit is None:
+            return query
+
+        # Posts from followed accounts that are too large to fan out are
+        # pulled in at read time.
+        popular_followed = db.session.scalars(
+            self.following.select()
+            .where(User.num_followers > limit)
+            .with_only_columns(User.id)
+        ).all()
+        if not popular_followed:
+            return query
+        return (
+            sa.select(Post)
+            .where(Post.is_approved.is_(True), sa.or_(
+                Post.id.in_(sa.select(timeline.c.post_id).where(timeline.c.user_id == self.id)),
+                Post.user_id.in_(popular_followed)
+            ))
+            .order_by(Post.timestamp.desc(), Post.id.desc())
+        )
+
     def is_admin(self) -> bool:
         return self.role == "admin"
 
@@ -120,19 +308,38 @@ class User(UserMixin, db.Model):
         return self.role == 'user'
 
     
-class Post(db.Model):
+class Post(SearchableMixin, db.Model):
+    __searchable__ = ['title', 'body']
+    __table_args__ = (
+        sa.Index('ix_post_timestamp_id', 'timestamp', 'id'),
+        # explore and the admin lists: filter on approval, newest first
+        sa.Index('ix_post_is_approved_timestamp_id', 'is_approved', 'timestamp', 'id'),
+        # profile pages; also serves lookups by user_id alone
+        sa.Index('ix_post_user_id_is_approved_timestamp_id',
+                 'user_id', 'is_approved', 'timestamp', 'id'),
+        # the moderation queue is a small slice of all posts
+        sa.Index('ix_post_pending_timestamp_id', 'timestamp', 'id',
+                 sqlite_where=sa.column('is_approved').is_(False),
+                 postgresql_where=sa.column('is_approved').is_(False)),
+    )
+
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     title: so.Mapped[str] = so.mapped_column(sa.String(200))
     body: so.Mapped[str] = so.mapped_column(sa.String(500))
     image: so.Mapped[str | None] = so.mapped_column(sa.String(255), nullable=True)
     timestamp: so.Mapped[datetime] = so.mapped_column(
-        index=True,
         default=lambda: datetime.now(timezone.utc)
     )
-    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id, ondelete="CASCADE"), index=True)
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id, ondelete="CASCADE"))
     author: so.Mapped[User] = so.relationship(back_populates='posts')
     comments: so.Mapped[List['Comment']] = so.relationship(back_populates='post', cascade='all, delete-orphan')
     is_approved: so.Mapped[bool] = so.mapped_column(default=False)
+    num_comments: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    version: so.Mapped[int] = so.mapped_column(default=1, server_default='1')
+    language: so.Mapped[str | None] = so.mapped_column(sa.String(5))
+    image_width: so.Mapped[int | None]
+    image_height: so.Mapped[int | None]
+    image_format: so.Mapped[str | None] = so.mapped_column(sa.String(8))
 
     def __repr__(self) -> str:
         return f'<Post {self.body}>'
@@ -141,15 +348,97 @@ class Post(db.Model):
         order = Comment.timestamp.asc() if ascending else Comment.timestamp.desc()
         return sa.select(Comment).where(Comment.post_id == self.id).order_by(order)
     
+    def is_searchable(self):
+        return self.is_approved
+
+    @classmethod
+    def searchable_query(cls):
+        return sa.select(cls).where(cls.is_approved.is_(True))
+
+    def fan_out(self):
+        """Push an approved post into the author's and followers' timelines."""
+        if not current_app.config['TIMELINE_FANOUT'] or not self.is_approved:
+            return
+        self.remove_from_timelines()
+        recipients = sa.select(sa.literal(self.user_id))
+        if not self.author.fans_out_on_read():
+            recipients = recipients.union(
+                sa.select(followers.c.follower_id).where(followers.c.followed_id == self.user_id)
+            )
+        recipients = recipients.subquery()
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            sa.select(recipients.c[0], sa.literal(self.id), sa.literal(self.timestamp, sa.DateTime))
+        ))
+
+    def remove_from_timelines(self):
+        db.session.execute(timeline.delete().where(timeline.c.post_id == self.id))
+
     def comment_count(self):
-        query = sa.select(sa.func.count()).where(Comment.post_id == self.id)
-        return db.session.scalar(query)
-    
+        return self.num_comments
+
+    def update_comment_count(self, delta):
+        db.session.execute(
+            sa.update(Post).where(Post.id == self.id)
+            .values(num_comments=Post.num_comments + delta, version=Post.version + 1)
+        )
+        db.session.info['posts_changed'] = True
+
+    def detect_language(self):
+        self.language = detect_language(f'{self.title}\n{self.body}')
+
+    def image_filename(self, variant):
+        """File name of a processed variant of the uploaded image."""
+        return variant_name(self.image, variant, self.image_format)
+
+    def image_size(self, variant):
+        """(width, height) of a variant: the image scaled down to fit the
+        variant's box in IMAGE_VARIANTS."""
+        return fit((self.image_width, self.image_height),
+                   current_app.config['IMAGE_VARIANTS'][variant])
+
+    def image_url(self, variant='full'):
+        if self.image_format is None:
+            # the variants are not ready yet, serve the upload itself
+            return get_storage().url(self.image)
+        return get_storage().url(self.image_filename(variant))
+
+    def touch(self):
+        """Bump the version so cached renderings of this post go stale."""
+        self.version = Post.version + 1
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        if any(isinstance(obj, Post) for obj in session.new | session.dirty | session.deleted):
+            session.info['posts_changed'] = True
+
+    @staticmethod
+    def after_commit(session):
+        if session.info.pop('posts_changed', False):
+            cache.invalidate('explore')
+            clear_count_cache()
+
+    @staticmethod
+    def after_soft_rollback(session, previous_transaction):
+        session.info.pop('posts_changed', None)
+
+
+db.event.listen(db.session, 'after_flush', Post.after_flush)
+db.event.listen(db.session, 'after_commit', Post.after_commit)
+db.event.listen(db.session, 'after_soft_rollback', Post.after_soft_rollback)
+
 @login.user_loader
 def load_user(id):
-    return db.session.get(User, int(id))
+    user = db.session.get(User, int(id))
+    # a deleted account is signed out on its next request
+    return user if user is not None and user.is_active else None
 
 class Comment(db.Model):
+    __table_args__ = (
+        # a post's comments in order; also serves lookups by post_id alone
+        sa.Index('ix_comment_post_id_timestamp', 'post_id', 'timestamp'),
+    )
+
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     body: so.Mapped[str] = so.mapped_column(sa.String(200))
     timestamp: so.Mapped[datetime] = so.mapped_column(
@@ -157,6 +446,207 @@ class Comment(db.Model):
         default=lambda: datetime.now(timezone.utc)
     )
     user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id, ondelete="CASCADE"), index=True)
-    post_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(Post.id, ondelete="CASCADE"), index=True)
+    post_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(Post.id, ondelete="CASCADE"))
     author: so.Mapped[User] = so.relationship(back_populates='comments')
-    post: so.Mapped[Post] = so.relationship(back_populates='comments')
\ No newline at end of file
+    post: so.Mapped[Post] = so.relationship(back_populates='comments')
+    language: so.Mapped[str | None] = so.mapped_column(sa.String(5))
+
+    def detect_language(self):
+        self.language = detect_language(self.body)
+
+
+class Translation(db.Model):
+    """A cached translation, keyed by a hash of the source text."""
+    text_hash: so.Mapped[str] = so.mapped_column(sa.String(64), primary_key=True)
+    source_language: so.Mapped[str] = so.mapped_column(sa.String(8), primary_key=True)
+    dest_language: so.Mapped[str] = so.mapped_column(sa.String(8), primary_key=True)
+    text: so.Mapped[str] = so.mapped_column(sa.Text)
+    last_used: so.Mapped[datetime] = so.mapped_column(
+        index=True, default=lambda: datetime.now(timezone.utc))
+
+
+class Job(db.Model):
+    """A unit of background work, run by ``flask worker``."""
+    __table_args__ = (
+        sa.Index('ix_job_status_run_at', 'status', 'run_at'),
+    )
+
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    name: so.Mapped[str] = so.mapped_column(sa.String(64))
+    payload: so.Mapped[dict] = so.mapped_column(sa.JSON)
+    status: so.Mapped[str] = so.mapped_column(sa.String(16), default='queued')
+    attempts: so.Mapped[int] = so.mapped_column(default=0)
+    max_attempts: so.Mapped[int] = so.mapped_column(default=5)
+    run_at: so.Mapped[datetime] = so.mapped_column(
+        default=lambda: datetime.now(timezone.utc))
+    locked_at: so.Mapped[datetime | None]
+    finished_at: so.Mapped[datetime | None]
+    error: so.Mapped[str | None] = so.mapped_column(sa.Text)
+
+    def __repr__(self) -> str:
+        return f'<Job {self.id} {self.name} {self.status}>'
+
+
+class UserDeletion(db.Model):
+    """Progress of the removal of a user account by the ``purge_user`` job.
+
+    ``total`` is the number of rows to delete (posts, comments, follow
+    edges and timeline entries), counted when the deletion starts;
+    ``done`` grows by one batch at a time.
+    """
+    __tablename__ = 'user_deletion'
+
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    # not a foreign key: the user row is the last thing to go
+    user_id: so.Mapped[int] = so.mapped_column(index=True)
+    username: so.Mapped[str] = so.mapped_column(sa.String(64))
+    total: so.Mapped[int] = so.mapped_column(default=0)
+    done: so.Mapped[int] = so.mapped_column(default=0)
+    files: so.Mapped[int] = so.mapped_column(default=0)
+    created_at: so.Mapped[datetime] = so.mapped_column(
+        default=lambda: datetime.now(timezone.utc))
+    finished_at: so.Mapped[datetime | None]
+
+    def __repr__(self) -> str:
+        return f'<UserDeletion {self.username} {self.done}/{self.total}>'
+
+    def progress(self):
+        if self.finished_at is not None or not self.total:
+            return 100 if self.finished_at is not None else 0
+        return min(99, 100 * self.done // self.total)
+
+
+class Blob(db.Model):
+    """An uploaded file stored under the SHA-256 of its content.
+
+    ``refcount`` is the number of posts using it, kept up to date as posts
+    are saved and deleted; ``flask uploads gc`` recounts it and deletes
+    unused blobs. Once the image variants exist their size and format are
+    recorded here, so a re-upload of the same file needs no processing.
+    """
+    hash: so.Mapped[str] = so.mapped_column(sa.String(64), primary_key=True)
+    extension: so.Mapped[str] = so.mapped_column(sa.String(8))
+    size: so.Mapped[int]
+    refcount: so.Mapped[int] = so.mapped_column(default=0)
+    width: so.Mapped[int | None]
+    height: so.Mapped[int | None]
+    format: so.Mapped[str | None] = so.mapped_column(sa.String(8))
+    created_at: so.Mapped[datetime] = so.mapped_column(
+        default=lambda: datetime.now(timezone.utc))
+
+    @property
+    def filename(self):
+        return f'{self.hash}.{self.extension}'
+
+    @staticmethod
+    def hash_of(filename):
+        """The blob hash in a stored file name, or None for a legacy upload."""
+        stem = filename.split('.', 1)[0]
+        return stem if len(stem) == 64 and all(c in '0123456789abcdef' for c in stem) else None
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        changes = {}
+
+        def add(filename, delta):
+            hash = filename and Blob.hash_of(filename)
+            if hash:
+                changes[hash] = changes.get(hash, 0) + delta
+
+        for obj in session.new:
+            if isinstance(obj, Post):
+                add(obj.image, 1)
+        for obj in session.dirty:
+            if isinstance(obj, Post):
+                history = sa.inspect(obj).attrs.image.history
+                for filename in history.added:
+                    add(filename, 1)
+                for filename in history.deleted:
+                    add(filename, -1)
+        for obj in session.deleted:
+            if isinstance(obj, Post):
+                add(obj.image, -1)
+        for hash, delta in changes.items():
+            if delta:
+                session.connection().execute(
+                    sa.update(Blob).where(Blob.hash == hash)
+                    .values(refcount=Blob.refcount + delta))
+
+
+db.event.listen(db.session, 'after_flush', Blob.after_flush)
+
+
+class DailyPostStats(db.Model):
+    """Per-day post totals, kept up to date as posts are created, approved
+    and deleted so the analytics page does not have to scan every post."""
+    __tablename__ = 'daily_post_stats'
+
+    day: so.Mapped[date] = so.mapped_column(primary_key=True)
+    posts: so.Mapped[int] = so.mapped_column(default=0)
+    approved: so.Mapped[int] = so.mapped_column(default=0)
+
+    @classmethod
+    def bump(cls, conn, day, posts=0, approved=0):
+        updated = conn.execute(
+            sa.update(cls).where(cls.day == day)
+            .values(posts=cls.posts + posts, approved=cls.approved + approved)
+        )
+        if updated.rowcount == 0:
+            conn.execute(sa.insert(cls).values(day=day, posts=posts, approved=approved))
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        if not current_app.config['ANALYTICS_ROLLUP']:
+            return
+        changes = {}
+
+        def add(post, posts, approved):
+            day = post.timestamp.date()
+            total = changes.setdefault(day, [0, 0])
+            total[0] += posts
+            total[1] += approved
+
+        for obj in session.new:
+            if isinstance(obj, Post):
+                add(obj, 1, int(bool(obj.is_approved)))
+        for obj in session.dirty:
+            if isinstance(obj, Post):
+                history = sa.inspect(obj).attrs.is_approved.history
+                if history.has_changes():
+                    add(obj, 0, 1 if obj.is_approved else -1)
+        for obj in session.deleted:
+            if isinstance(obj, Post):
+                add(obj, -1, -int(bool(obj.is_approved)))
+        for day, (posts, approved) in changes.items():
+            if posts or approved:
+                DailyPostStats.bump(session.connection(), day, posts, approved)
+
+    @classmethod
+    def rebuild(cls):
+        db.session.execute(sa.delete(cls))
+        day = sa.func.date(Post.timestamp)
+        rows = db.session.execute(
+            sa.select(day, sa.func.count(),
+                      sa.func.sum(sa.case((Post.is_approved, 1), else_=0)))
+            .group_by(day)
+        ).all()
+        if rows:
+            db.session.execute(sa.insert(cls), [
+                {'day': as_date(d), 'posts': posts, 'approved': approved}
+                for d, posts, approved in rows
+            ])
+        return len(rows)
+
+
+def fit(size, box):
+    """Scale ``size`` down, never up, to fit inside ``box``."""
+    scale = min(box[0] / size[0], box[1] / size[1], 1)
+    return max(round(size[0] * scale), 1), max(round(size[1] * scale), 1)
+
+
+def as_date(value):
+    """date() in SQLite returns a string, in other databases a date."""
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+
+db.event.listen(db.session, 'after_flush', DailyPostStats.after_flush)
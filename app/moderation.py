@@ -0,0 +1,147 @@
+from collections import Counter
+from flask import current_app
+import sqlalchemy as sa
+from app import db
+from app.models import Blob, Comment, DailyPostStats, Post, User, as_date, followers, timeline
+from app.search import get_backend
+from app.storage import get_storage, variant_name
+
+
+def chunks(query, size):
+    """Yield the ids selected by ``query``, a ``select(Post.id)``, in lists
+    of up to ``size``. Each chunk is queried after the previous one was
+    handled, so the caller may commit in between."""
+    last = 0
+    while True:
+        ids = db.session.scalars(
+            query.where(Post.id > last).order_by(Post.id).limit(size)).all()
+        if not ids:
+            return
+        yield ids
+        last = ids[-1]
+
+
+def _rollup(ids):
+    """``(day, posts, approved)`` totals of the posts ``ids``, or nothing
+    when the daily rollup is off."""
+    if not current_app.config['ANALYTICS_ROLLUP']:
+        return []
+    day = sa.func.date(Post.timestamp)
+    rows = db.session.execute(
+        sa.select(day, sa.func.count(), sa.func.sum(sa.case((Post.is_approved, 1), else_=0)))
+        .where(Post.id.in_(ids)).group_by(day)).all()
+    return [(as_date(d), posts, approved) for d, posts, approved in rows]
+
+
+def approve(ids):
+    """Approve the pending posts among ``ids`` with one ``UPDATE``, then
+    index them and push them into the timelines, as ``approve_post`` does
+    one at a time. Returns the number approved."""
+    ids = db.session.scalars(
+        sa.select(Post.id).where(Post.id.in_(ids), Post.is_approved.is_(False))).all()
+    if not ids:
+        return 0
+    conn = db.session.connection()
+    for day, posts, approved in _rollup(ids):
+        DailyPostStats.bump(conn, day, approved=posts)
+    db.session.execute(
+        sa.update(Post).where(Post.id.in_(ids))
+        .values(is_approved=True, version=Post.version + 1),
+        execution_options={'synchronize_session': False})
+
+    backend = get_backend(Post.__tablename__, Post.__searchable__)
+    for row in db.session.execute(
+            sa.select(Post.id, *[getattr(Post, f) for f in Post.__searchable__])
+            .where(Post.id.in_(ids))):
+        backend.add(conn, row.id, {f: getattr(row, f) for f in Post.__searchable__})
+
+    if current_app.config['TIMELINE_FANOUT']:
+        db.session.execute(timeline.delete().where(timeline.c.post_id.in_(ids)))
+        authors = sa.select(Post.user_id, Post.id, Post.timestamp).where(Post.id.in_(ids))
+        fans = (
+            sa.select(followers.c.follower_id, Post.id, Post.timestamp)
+            .join(followers, followers.c.followed_id == Post.user_id)
+            .join(User, User.id == Post.user_id)
+            .where(Post.id.in_(ids))
+        )
+        limit = current_app.config['TIMELINE_FANOUT_LIMIT']
+        if limit is not None:
+            # popular authors are merged into feeds at read time
+            fans = fans.where(User.num_followers <= limit)
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'], authors.union(fans)))
+    db.session.info['posts_changed'] = True
+    return len(ids)
+
+
+def delete(ids):
+    """Delete the posts ``ids`` with their comments and timeline entries in
+    a few set-based statements, keeping the search index, the daily rollup
+    and the blob refcounts in step. Returns the names of upload files no
+    post uses any more; delete them once the transaction has committed."""
+    posts = db.session.execute(
+        sa.select(Post.id, Post.is_approved, Post.image, Post.image_format)
+        .where(Post.id.in_(ids))).all()
+    if not posts:
+        return []
+    ids = [post.id for post in posts]
+    conn = db.session.connection()
+    for day, count, approved in _rollup(ids):
+        DailyPostStats.bump(conn, day, -count, -approved)
+    backend = get_backend(Post.__tablename__, Post.__searchable__)
+    for post in posts:
+        if post.is_approved:
+            backend.remove(conn, post.id)
+    db.session.execute(timeline.delete().where(timeline.c.post_id.in_(ids)))
+    db.session.execute(sa.delete(Comment).where(Comment.post_id.in_(ids)),
+                       execution_options={'synchronize_session': False})
+    db.session.execute(sa.delete(Post).where(Post.id.in_(ids)),
+                       execution_options={'synchronize_session': False})
+    db.session.info['posts_changed'] = True
+
+    images = {post.image: post.image_format for post in posts if post.image}
+    hashes = Counter(Blob.hash_of(post.image) for post in posts if post.image)
+    hashes.pop(None, None)
+    for hash, n in hashes.items():
+        db.session.execute(sa.update(Blob).where(Blob.hash == hash)
+                           .values(refcount=Blob.refcount - n))
+    for blob in db.session.scalars(
+            sa.select(Blob).where(Blob.hash.in_(hashes), Blob.refcount <= 0)):
+        images.setdefault(blob.filename, blob.format)
+        db.session.delete(blob)
+    in_use = set(db.session.scalars(
+        sa.select(Post.image).where(Post.image.in_(list(images)))))
+    in_use.update(db.session.scalars(sa.select(Blob.hash + '.' + Blob.extension)
+                                     .where(Blob.hash.in_(hashes))))
+    variants = current_app.config['IMAGE_VARIANTS']
+    doomed = []
+    for filename, fmt in images.items():
+        if filename not in in_use:
+            doomed.append(filename)
+            if fmt:
+                doomed += [variant_name(filename, v, fmt) for v in variants]
+    return doomed
+
+
+def approve_all(query):
+    """Approve every post ``query`` selects, committing one chunk of
+    ``MODERATION_CHUNK_SIZE`` at a time. Returns the number approved."""
+    count = 0
+    for ids in chunks(query, current_app.config['MODERATION_CHUNK_SIZE']):
+        count += approve(ids)
+        db.session.commit()
+    return count
+
+
+def delete_all(query):
+    """Delete every post ``query`` selects, committing one chunk of
+    ``MODERATION_CHUNK_SIZE`` at a time. Returns the number deleted."""
+    count = 0
+    storage = get_storage()
+    for ids in chunks(query, current_app.config['MODERATION_CHUNK_SIZE']):
+        doomed = delete(ids)
+        db.session.commit()
+        count += len(ids)
+        for name in doomed:
+            storage.delete(name)
+    return count
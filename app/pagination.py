@@ -0,0 +1,129 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+from time import monotonic
+import sqlalchemy as sa
+from sqlalchemy.sql import operators
+from flask import current_app
+from app import db
+
+_count_cache = {}
+
+
+def _encode(direction, values):
+    raw = json.dumps([direction] + [
+        v.isoformat() if isinstance(v, datetime) else v for v in values
+    ])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _decode(cursor, columns):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        direction, *values = json.loads(raw)
+        if direction not in ('next', 'prev') or len(values) != len(columns):
+            return None
+        return direction, [
+            datetime.fromisoformat(v) if isinstance(c.type, sa.DateTime) else v
+            for c, v in zip(columns, values)
+        ]
+    except (binascii.Error, ValueError, TypeError):
+        return None
+
+
+def _cached_count(query):
+    ttl = current_app.config['PAGINATION_COUNT_TTL']
+    compiled = query.compile()
+    key = (str(compiled), tuple(sorted(compiled.params.items())))
+    now = monotonic()
+    hit = _count_cache.get(key)
+    if hit is not None and hit[0] > now:
+        return hit[1]
+    total = db.session.scalar(
+        sa.select(sa.func.count()).select_from(query.order_by(None).subquery()))
+    if ttl:
+        if len(_count_cache) > 1000:
+            _count_cache.clear()
+        _count_cache[key] = (now + ttl, total)
+    return total
+
+
+def clear_count_cache():
+    """Forget the cached totals, e.g. once posts were added or removed.
+    Only this process's cache is cleared; others catch up within
+    ``PAGINATION_COUNT_TTL`` seconds."""
+    _count_cache.clear()
+
+
+class CursorPagination:
+    """One page of a keyset-paginated query.
+
+    Mirrors the parts of Flask-SQLAlchemy's ``Pagination`` that the templates
+    use, but navigates with opaque ``next_cursor``/``prev_cursor`` values
+    instead of page numbers, so deep pages cost the same as the first one.
+    """
+
+    def __init__(self, items, has_next, has_prev, key, total=None):
+        self.items = items
+        self.has_next = has_next
+        self.has_prev = has_prev
+        self.total = total
+        self.next_cursor = _encode('next', key(items[-1])) \
+            if has_next and items else None
+        self.prev_cursor = _encode('prev', key(items[0])) \
+            if has_prev and items else None
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+def _order_columns(query):
+    columns = []
+    directions = set()
+    for clause in query._order_by_clauses:
+        modifier = getattr(clause, 'modifier', None)
+        if modifier in (operators.desc_op, operators.asc_op):
+            directions.add(modifier is operators.desc_op)
+            clause = clause.element
+        else:
+            directions.add(False)
+        columns.append(clause)
+    if not columns or len(directions) != 1:
+        raise ValueError('keyset pagination needs an ORDER BY in a single direction')
+    return columns, directions.pop()
+
+
+def paginate(query, *, cursor=None, per_page=None, key=None, count=False):
+    """Keyset-paginate ``query`` on its ORDER BY columns.
+
+    The ORDER BY must be unique (end it with the primary key). ``key`` maps a
+    result item to its ORDER BY values and defaults to reading the same-named
+    attributes. ``count`` adds a (cached) total to the page.
+    """
+    if per_page is None:
+        per_page = current_app.config['POSTS_PER_PAGE']
+    columns, descending = _order_columns(query)
+    if key is None:
+        key = lambda item: tuple(getattr(item, c.key) for c in columns)
+    total = _cached_count(query) if count else None
+
+    position = _decode(cursor, columns) if cursor else None
+    direction = position[0] if position else 'next'
+    backwards = direction == 'prev'
+    reverse = descending != backwards
+
+    page_query = query.order_by(None).order_by(
+        *[c.desc() if reverse else c.asc() for c in columns])
+    if position:
+        bound = sa.tuple_(*[sa.literal(v, c.type) for c, v in zip(columns, position[1])])
+        row = sa.tuple_(*columns)
+        page_query = page_query.where(row < bound if reverse else row > bound)
+    items = db.session.scalars(page_query.limit(per_page + 1)).all()
+
+    more = len(items) > per_page
+    items = items[:per_page]
+    if backwards:
+        items.reverse()
+        return CursorPagination(items, True, more, key, total)
+    return CursorPagination(items, more, position is not None, key, total)
@@ -0,0 +1,85 @@
+from collections import Counter, deque
+from datetime import datetime, timezone
+from threading import Lock
+from time import perf_counter
+from flask import current_app, g, has_request_context, request
+import sqlalchemy as sa
+
+
+class QueryProfiler:
+    """Times every SQL statement through engine events.
+
+    For each request it counts the statements, adds up the time spent in
+    the database and finds statements run more than once (usually an N+1
+    lazy load). The totals go out in a ``Server-Timing`` header and the
+    last ``SQL_PROFILER_HISTORY`` requests are kept for the admin panel.
+    Statements slower than ``SQL_SLOW_QUERY_THRESHOLD`` seconds are logged
+    to the ``sql`` child of the app logger, in requests or not.
+    """
+
+    def __init__(self, app=None):
+        self.history = deque()
+        self.lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config['SQL_PROFILER']:
+            return
+        with app.app_context():
+            engines = list(app.extensions['sqlalchemy'].engines.values())
+        engines += app.extensions.get('replicas', [])
+        for engine in engines:
+            sa.event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+            sa.event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+        app.before_request(self.start)
+        app.after_request(self.finish)
+        self.history = deque(maxlen=app.config['SQL_PROFILER_HISTORY'])
+
+    @staticmethod
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = perf_counter() - conn.info['query_start'].pop()
+        if has_request_context() and 'sql_queries' in g:
+            g.sql_queries.append((statement, elapsed))
+        if elapsed >= current_app.config['SQL_SLOW_QUERY_THRESHOLD']:
+            current_app.logger.getChild('sql').warning(
+                'Slow query (%.1f ms)%s: %s', elapsed * 1000,
+                f' in {request.method} {request.path}' if has_request_context() else '',
+                statement)
+
+    @staticmethod
+    def start():
+        g.sql_queries = []
+        g.request_start = perf_counter()
+
+    def finish(self, response):
+        queries = g.pop('sql_queries', None)
+        if queries is None:
+            return response
+        duration = perf_counter() - g.pop('request_start')
+        db_time = sum(elapsed for statement, elapsed in queries)
+        repeated = Counter(statement for statement, elapsed in queries)
+        response.headers.add(
+            'Server-Timing', f'db;dur={db_time * 1000:.1f};desc="{len(queries)} queries"')
+        response.headers.add('Server-Timing', f'app;dur={duration * 1000:.1f}')
+        with self.lock:
+            self.history.appendleft({
+                'time': datetime.now(timezone.utc),
+                'method': request.method,
+                'path': request.full_path.rstrip('?'),
+                'endpoint': request.endpoint,
+                'status': response.status_code,
+                'duration': duration,
+                'queries': len(queries),
+                'db_time': db_time,
+                'duplicates': [(statement, n) for statement, n in repeated.most_common() if n > 1],
+                'slowest': sorted(queries, key=lambda q: q[1], reverse=True)[:5],
+            })
+        return response
+
+    def recent(self):
+        with self.lock:
+            return list(self.history)
@@ -0,0 +1,131 @@
+from collections import Counter
+from datetime import datetime, timezone
+from flask import current_app
+import sqlalchemy as sa
+from app import db, moderation
+from app.jobs import enqueue, task
+from app.models import Comment, Post, User, UserDeletion, followers, timeline
+from app.storage import get_storage
+
+
+def start_deletion(user):
+    """Disable ``user`` right away and queue the removal of the account and
+    everything in it. Returns the ``UserDeletion`` that tracks it."""
+    user.deleted_at = datetime.now(timezone.utc)
+    count = sa.select(sa.func.count())
+    own_posts = sa.select(Post.id).where(Post.user_id == user.id)
+    # timeline entries of the user's posts go along with the posts
+    total = db.session.scalar(sa.select(
+        count.select_from(Post).where(Post.user_id == user.id).scalar_subquery()
+        + count.select_from(Comment).where(sa.or_(
+            Comment.user_id == user.id, Comment.post_id.in_(own_posts)
+        )).scalar_subquery()
+        + count.select_from(followers).where(sa.or_(
+            followers.c.follower_id == user.id, followers.c.followed_id == user.id
+        )).scalar_subquery()
+        + count.select_from(timeline).where(
+            timeline.c.user_id == user.id, timeline.c.post_id.not_in(own_posts)
+        ).scalar_subquery()
+    ))
+    deletion = UserDeletion(user_id=user.id, username=user.username, total=total)
+    db.session.add(deletion)
+    db.session.flush()
+    enqueue('purge_user', deletion_id=deletion.id)
+    return deletion
+
+
+def delete_comments_on_posts(user_id, size):
+    ids = db.session.scalars(
+        sa.select(Comment.id).join(Comment.post).where(Post.user_id == user_id)
+        .limit(size)).all()
+    if ids:
+        db.session.execute(sa.delete(Comment).where(Comment.id.in_(ids)),
+                           execution_options={'synchronize_session': False})
+    return len(ids)
+
+
+def delete_posts(user_id, size, doomed):
+    ids = db.session.scalars(
+        sa.select(Post.id).where(Post.user_id == user_id).order_by(Post.id).limit(size)).all()
+    if ids:
+        doomed += moderation.delete(ids)
+    return len(ids)
+
+
+def delete_comments(user_id, size):
+    rows = db.session.execute(
+        sa.select(Comment.id, Comment.post_id).where(Comment.user_id == user_id)
+        .limit(size)).all()
+    if not rows:
+        return 0
+    for post_id, n in Counter(post_id for _, post_id in rows).items():
+        db.session.execute(
+            sa.update(Post).where(Post.id == post_id)
+            .values(num_comments=Post.num_comments - n, version=Post.version + 1),
+            execution_options={'synchronize_session': False})
+    db.session.info['posts_changed'] = True
+    db.session.execute(sa.delete(Comment).where(Comment.id.in_([id for id, _ in rows])),
+                       execution_options={'synchronize_session': False})
+    return len(rows)
+
+
+def unlink_follows(user_id, size):
+    """Drop a batch of follow edges, fixing the counters of the users on
+    the other side."""
+    for mine, theirs, counter in (
+            (followers.c.follower_id, followers.c.followed_id, User.num_followers),
+            (followers.c.followed_id, followers.c.follower_id, User.num_following)):
+        ids = db.session.scalars(
+            sa.select(theirs).where(mine == user_id).limit(size)).all()
+        if ids:
+            db.session.execute(
+                sa.update(User).where(User.id.in_(ids)).values({counter: counter - 1}),
+                execution_options={'synchronize_session': False})
+            db.session.execute(followers.delete().where(mine == user_id, theirs.in_(ids)))
+            if counter is User.num_followers:
+                User.lost_a_follower(ids)
+            return len(ids)
+    return 0
+
+
+def clear_timeline(user_id, size):
+    ids = db.session.scalars(
+        sa.select(timeline.c.post_id).where(timeline.c.user_id == user_id)
+        .limit(size)).all()
+    if ids:
+        db.session.execute(timeline.delete().where(
+            timeline.c.user_id == user_id, timeline.c.post_id.in_(ids)))
+    return len(ids)
+
+
+@task('purge_user')
+def purge_user(deletion_id):
+    """Delete one batch of ``USER_PURGE_BATCH_SIZE`` rows of a deleted user
+    and queue the next, so no transaction holds the write lock for long.
+    Posts go first, as they are what other users see; the user row goes
+    once nothing refers to it."""
+    deletion = db.session.get(UserDeletion, deletion_id)
+    if deletion is None or deletion.finished_at is not None:
+        return
+    user_id = deletion.user_id
+    size = current_app.config['USER_PURGE_BATCH_SIZE']
+    doomed = []
+    done = (delete_comments_on_posts(user_id, size)
+            or delete_posts(user_id, size, doomed)
+            or delete_comments(user_id, size)
+            or unlink_follows(user_id, size)
+            or clear_timeline(user_id, size))
+    if done:
+        deletion.done += done
+        deletion.files += len(doomed)
+        enqueue('purge_user', deletion_id=deletion_id)
+    else:
+        user = db.session.get(User, user_id)
+        if user is not None:
+            db.session.delete(user)
+        deletion.finished_at = datetime.now(timezone.utc)
+    db.session.commit()
+    # only once the rows are gone, a rollback must not leave posts without files
+    storage = get_storage()
+    for name in doomed:
+        storage.delete(name)
@@ -0,0 +1,45 @@
+"""Queries shared by the views that list posts and comments.
+
+Every post card shows its author, so listings load the authors of a page
+in one extra ``SELECT`` (``selectinload``) instead of one lazy load per
+post. Single rows join their author in (``joinedload``).
+"""
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from app import db
+from app.models import Comment, Post
+
+WITH_AUTHOR = so.selectinload(Post.author)
+
+
+def newest_first(query):
+    return query.order_by(Post.timestamp.desc(), Post.id.desc())
+
+
+def with_authors(query):
+    """Eager-load the authors of the posts ``query`` returns."""
+    return query.options(WITH_AUTHOR)
+
+
+def posts(approved=None):
+    """All posts, newest first; only approved or pending ones if
+    ``approved`` is True or False."""
+    query = sa.select(Post)
+    if approved is not None:
+        query = query.where(Post.is_approved.is_(approved))
+    return with_authors(newest_first(query))
+
+
+def user_posts(user, approved):
+    # the author is already in the session, so there is nothing to load
+    return newest_first(user.posts.select().where(Post.is_approved.is_(approved)))
+
+
+def post_or_404(post_id):
+    return db.first_or_404(
+        sa.select(Post).where(Post.id == post_id).options(so.joinedload(Post.author)))
+
+
+def comments(post):
+    """The comments of ``post``, oldest first, with their authors."""
+    return post.get_comments().options(so.joinedload(Comment.author))
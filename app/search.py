@@ -0,0 +1,230 @@
+import math
+import re
+from collections import defaultdict
+from datetime import datetime, timezone
+from threading import Lock
+from flask import current_app
+import sqlalchemy as sa
+from app import db
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    return TOKEN_RE.findall((text or '').lower())
+
+
+class SQLiteSearch:
+    """FTS5 virtual table keyed by the post id (its rowid)."""
+    name = 'sqlite'
+    loaded = True
+
+    def __init__(self, index, fields):
+        self.table = f'{index}_fts'
+        self.fields = fields
+
+    def ensure(self, conn):
+        conn.execute(sa.text(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} '
+            f'USING fts5({", ".join(self.fields)})'))
+
+    def add(self, conn, id, fields):
+        self.remove(conn, id)
+        conn.execute(sa.text(
+            f'INSERT INTO {self.table} (rowid, {", ".join(self.fields)}) '
+            f'VALUES (:id, {", ".join(":" + f for f in self.fields)})'),
+            dict(fields, id=id))
+
+    def remove(self, conn, id):
+        conn.execute(sa.text(f'DELETE FROM {self.table} WHERE rowid = :id'), {'id': id})
+
+    def clear(self, conn):
+        conn.execute(sa.text(f'DELETE FROM {self.table}'))
+
+    def query(self, conn, expression, limit):
+        terms = tokenize(expression)
+        if not terms:
+            return []
+        match = ' '.join('"{}"'.format(t.replace('"', '""')) for t in terms)
+        rows = conn.execute(sa.text(
+            f'SELECT rowid, -bm25({self.table}) FROM {self.table} '
+            f'WHERE {self.table} MATCH :match ORDER BY bm25({self.table}) LIMIT :limit'),
+            {'match': match, 'limit': limit})
+        return [(row[0], row[1]) for row in rows]
+
+
+class PostgresSearch:
+    """Side table holding a tsvector per post, with a GIN index."""
+    name = 'postgres'
+    loaded = True
+
+    def __init__(self, index, fields):
+        self.table = f'{index}_search'
+        self.fields = fields
+
+    def ensure(self, conn):
+        conn.execute(sa.text(
+            f'CREATE TABLE IF NOT EXISTS {self.table} '
+            '(id INTEGER PRIMARY KEY, document TSVECTOR NOT NULL)'))
+        conn.execute(sa.text(
+            f'CREATE INDEX IF NOT EXISTS ix_{self.table}_document '
+            f'ON {self.table} USING GIN (document)'))
+
+    def add(self, conn, id, fields):
+        # the first field (e.g. a title) weighs more than the rest
+        document = ' || '.join(
+            f"setweight(to_tsvector('simple', coalesce(:{f}, '')), '{'A' if i == 0 else 'B'}')"
+            for i, f in enumerate(self.fields))
+        conn.execute(sa.text(
+            f'INSERT INTO {self.table} (id, document) VALUES (:id, {document}) '
+            'ON CONFLICT (id) DO UPDATE SET document = EXCLUDED.document'),
+            dict(fields, id=id))
+
+    def remove(self, conn, id):
+        conn.execute(sa.text(f'DELETE FROM {self.table} WHERE id = :id'), {'id': id})
+
+    def clear(self, conn):
+        conn.execute(sa.text(f'DELETE FROM {self.table}'))
+
+    def query(self, conn, expression, limit):
+        rows = conn.execute(sa.text(
+            "SELECT id, ts_rank(document, plainto_tsquery('simple', :q)) AS rank "
+            f'FROM {self.table} '
+            "WHERE document @@ plainto_tsquery('simple', :q) "
+            'ORDER BY rank DESC LIMIT :limit'),
+            {'q': expression, 'limit': limit})
+        return [(row[0], row[1]) for row in rows]
+
+
+class PythonSearch:
+    """In-process inverted index, used when the database has no full-text
+    support. It is built from the database on first use, so each worker
+    process holds its own copy."""
+    name = 'python'
+
+    def __init__(self, index, fields):
+        self.fields = fields
+        self.postings = defaultdict(dict)
+        self.documents = {}
+        self.lock = Lock()
+        self.loaded = False
+
+    def ensure(self, conn):
+        pass
+
+    def add(self, conn, id, fields):
+        # the first field (e.g. a title) counts twice
+        tokens = tokenize(fields[self.fields[0]]) * 2
+        for field in self.fields[1:]:
+            tokens += tokenize(fields[field])
+        with self.lock:
+            self._remove(id)
+            counts = defaultdict(int)
+            for token in tokens:
+                counts[token] += 1
+            for token, count in counts.items():
+                self.postings[token][id] = count
+            self.documents[id] = list(counts)
+
+    def remove(self, conn, id):
+        with self.lock:
+            self._remove(id)
+
+    def _remove(self, id):
+        for token in self.documents.pop(id, ()):
+            self.postings[token].pop(id, None)
+            if not self.postings[token]:
+                del self.postings[token]
+
+    def clear(self, conn):
+        with self.lock:
+            self.postings.clear()
+            self.documents.clear()
+
+    def query(self, conn, expression, limit):
+        terms = set(tokenize(expression))
+        with self.lock:
+            if not terms or any(t not in self.postings for t in terms):
+                return []
+            total = len(self.documents)
+            scores = None
+            for term in terms:
+                docs = self.postings[term]
+                idf = math.log(1 + total / len(docs))
+                term_scores = {id: tf * idf for id, tf in docs.items()}
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {id: s + term_scores[id] for id, s in scores.items()
+                              if id in term_scores}
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return ranked[:limit]
+
+
+BACKENDS = {b.name: b for b in (SQLiteSearch, PostgresSearch, PythonSearch)}
+
+
+def get_backend(index, fields):
+    backends = current_app.extensions.setdefault('search', {})
+    if index not in backends:
+        name = current_app.config['SEARCH_BACKEND']
+        dialect = db.engine.dialect.name
+        if name == 'auto':
+            name = dialect if dialect in ('sqlite', 'postgresql') else 'python'
+            name = 'postgres' if name == 'postgresql' else name
+        backend = BACKENDS[name](index, fields)
+        try:
+            backend.ensure(db.session.connection())
+        except sa.exc.OperationalError:
+            # SQLite built without FTS5
+            current_app.logger.warning('Full-text search unavailable, using the Python index')
+            backend = PythonSearch(index, fields)
+        backends[index] = backend
+    return backends[index]
+
+
+def add_to_index(index, model, conn=None):
+    fields = {field: getattr(model, field) for field in model.__searchable__}
+    get_backend(index, model.__searchable__).add(
+        conn or db.session.connection(), model.id, fields)
+
+
+def remove_from_index(index, model, conn=None):
+    get_backend(index, model.__searchable__).remove(
+        conn or db.session.connection(), model.id)
+
+
+def query_index(index, fields, expression, limit):
+    """Return up to ``limit`` ``(id, relevance)`` pairs, best match first."""
+    return get_backend(index, fields).query(db.session.connection(), expression, limit)
+
+
+def reindex(index, fields, query):
+    """Replace the contents of ``index`` with the models ``query`` returns."""
+    backend = get_backend(index, fields)
+    conn = db.session.connection()
+    backend.clear(conn)
+    count = 0
+    for model in db.session.scalars(query.execution_options(yield_per=500)):
+        add_to_index(index, model, conn)
+        count += 1
+    backend.loaded = True
+    return count
+
+
+def rank(matches, timestamps):
+    """Blend relevance with recency: a post loses half its score every
+    SEARCH_RECENCY_HALF_LIFE days."""
+    half_life = current_app.config['SEARCH_RECENCY_HALF_LIFE']
+    now = datetime.now(timezone.utc)
+    scored = []
+    for id, relevance in matches:
+        timestamp = timestamps.get(id)
+        if timestamp is None:
+            continue
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        age = max((now - timestamp).total_seconds() / 86400, 0)
+        scored.append((relevance * 0.5 ** (age / half_life), id))
+    scored.sort(reverse=True)
+    return [id for _, id in scored]
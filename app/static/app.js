@@ -18,3 +18,15 @@ if (toggle) {
         }
     });
 }
+
+async function translate(kind, id, destElem, destLang) {
+    const target = document.getElementById(destElem);
+    target.innerHTML = '<span class="spinner-border spinner-border-sm"></span>';
+    const response = await fetch('/translate', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json; charset=utf-8'},
+        body: JSON.stringify({[kind + '_id']: id, dest_language: destLang})
+    });
+    const data = await response.json();
+    target.innerText = data.text;
+}
@@ -0,0 +1,149 @@
+import hashlib
+import os
+import tempfile
+from datetime import datetime, timezone
+from flask import current_app, url_for
+
+
+def variant_name(name, variant, fmt):
+    """Name of the ``variant`` of image ``name`` encoded as ``fmt``."""
+    stem = os.path.splitext(name)[0]
+    return f'{stem}.{variant}.{"jpg" if fmt == "jpeg" else fmt}'
+
+
+class Storage:
+    """Where uploaded files live, addressed by name.
+
+    Subclasses implement ``put``, ``open``, ``delete``, ``exists``, ``list``
+    and ``url``; streaming and hashing of new uploads is shared.
+    """
+    chunk_size = 64 * 1024
+
+    def temporary_dir(self):
+        return None
+
+    def spool(self, stream):
+        """Copy ``stream`` to a temporary file in chunks, hashing it on the
+        way. Returns ``(sha256 hex digest, size, temporary path)``; pass the
+        path to ``put`` or ``discard``."""
+        digest = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=self.temporary_dir(), suffix='.part',
+                                         delete=False) as tmp:
+            try:
+                while chunk := stream.read(self.chunk_size):
+                    digest.update(chunk)
+                    tmp.write(chunk)
+                    size += len(chunk)
+            except BaseException:
+                self.discard(tmp.name)
+                raise
+        return digest.hexdigest(), size, tmp.name
+
+    @staticmethod
+    def discard(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class LocalStorage(Storage):
+    """Files in ``UPLOAD_FOLDER``, served by the ``main.upload`` view."""
+    name = 'local'
+
+    def __init__(self, app):
+        self.root = app.config['UPLOAD_FOLDER']
+        os.makedirs(self.root, exist_ok=True)
+
+    def temporary_dir(self):
+        # same filesystem, so put() is an atomic rename
+        return self.root
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def put(self, name, path):
+        os.replace(path, self.path(name))
+
+    def open(self, name):
+        return open(self.path(name), 'rb')
+
+    def delete(self, name):
+        self.discard(self.path(name))
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def list(self):
+        """Yield ``(name, modified)`` for every stored file."""
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.startswith('.') \
+                        and not entry.name.endswith('.part'):
+                    yield entry.name, datetime.fromtimestamp(entry.stat().st_mtime, timezone.utc)
+
+    def url(self, name):
+        return url_for('main.upload', name=name)
+
+
+class S3Storage(Storage):
+    """Objects in an S3-compatible bucket. Needs ``boto3``."""
+    name = 's3'
+
+    def __init__(self, app):
+        try:
+            import boto3
+        except ImportError:
+            raise RuntimeError('UPLOAD_STORAGE = "s3" needs the boto3 package')
+        self.bucket = app.config['UPLOAD_S3_BUCKET']
+        self.prefix = app.config['UPLOAD_S3_PREFIX']
+        self.public_url = app.config['UPLOAD_S3_PUBLIC_URL']
+        self.client = boto3.client('s3', endpoint_url=app.config['UPLOAD_S3_ENDPOINT'])
+        self.errors = self.client.exceptions.ClientError
+
+    def put(self, name, path):
+        try:
+            self.client.upload_file(path, self.bucket, self.prefix + name, ExtraArgs={
+                'CacheControl': 'public, max-age=31536000, immutable'})
+        finally:
+            self.discard(path)
+
+    def open(self, name):
+        f = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+        try:
+            self.client.download_fileobj(self.bucket, self.prefix + name, f)
+        except self.errors:
+            f.close()
+            raise FileNotFoundError(name)
+        f.seek(0)
+        return f
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + name)
+
+    def exists(self, name):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + name)
+        except self.errors:
+            return False
+        return True
+
+    def list(self):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get('Contents', []):
+                yield item['Key'][len(self.prefix):], item['LastModified']
+
+    def url(self, name):
+        return f'{self.public_url.rstrip("/")}/{self.prefix}{name}'
+
+
+BACKENDS = {b.name: b for b in (LocalStorage, S3Storage)}
+
+
+def get_storage():
+    if 'storage' not in current_app.extensions:
+        backend = BACKENDS[current_app.config['UPLOAD_STORAGE']]
+        current_app.extensions['storage'] = backend(current_app)
+    return current_app.extensions['storage']
@@ -1,21 +1,140 @@
+import hashlib
+from datetime import datetime, timezone
 import requests
+from requests.adapters import HTTPAdapter
 from flask import current_app
 from flask_babel import _
+import sqlalchemy as sa
+from app import db
+from app.models import Translation
+
+
+class TranslationError(Exception):
+    pass
+
+
+class MicrosoftTranslator:
+    """Azure Translator client sharing one pooled HTTP session per process."""
+    name = 'microsoft'
+    url = 'https://api.cognitive.microsofttranslator.com/translate'
+
+    def __init__(self, app):
+        self.key = app.config['MS_TRANSLATOR_KEY']
+        self.timeout = app.config['TRANSLATOR_TIMEOUT']
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=app.config['TRANSLATOR_POOL_SIZE']))
+
+    def translate(self, texts, source_language, dest_language):
+        if not self.key:
+            raise TranslationError(_('Error: the translation service is not configured.'))
+        params = {'api-version': '3.0', 'to': dest_language}
+        if source_language:
+            params['from'] = source_language
+        headers = {
+            'Ocp-Apim-Subscription-Key': self.key,
+            'Ocp-Apim-Subscription-Region': 'westus'
+        }
+        try:
+            r = self.session.post(self.url, params=params, headers=headers,
+                                  json=[{'Text': text} for text in texts],
+                                  timeout=self.timeout)
+        except requests.RequestException:
+            current_app.logger.warning('Translation request failed', exc_info=True)
+            raise TranslationError(_('Error: the translation service failed.'))
+        if r.status_code != 200:
+            raise TranslationError(_('Error: the translation service failed.'))
+        return [item['translations'][0]['text'] for item in r.json()]
+
+
+class StubTranslator:
+    """Offline stand-in that tags each text with the destination language
+    and records the batches it was asked to translate."""
+    name = 'stub'
+
+    def __init__(self, app):
+        self.batches = []
+
+    def translate(self, texts, source_language, dest_language):
+        self.batches.append(list(texts))
+        return [f'[{dest_language}] {text}' for text in texts]
+
+
+BACKENDS = {b.name: b for b in (MicrosoftTranslator, StubTranslator)}
+
+
+def get_translator():
+    if 'translator' not in current_app.extensions:
+        name = current_app.config['TRANSLATOR_BACKEND']
+        current_app.extensions['translator'] = BACKENDS[name](current_app)
+    return current_app.extensions['translator']
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def translate_batch(texts, source_language, dest_language):
+    """Translate ``texts``, answering from the translation cache where
+    possible and sending the rest in as few API requests as the batch size
+    allows. Raises ``TranslationError`` if the service fails. The caller
+    commits the session so new translations are kept."""
+    source_language = source_language or ''
+    hashes = [text_hash(text) for text in texts]
+    now = datetime.now(timezone.utc)
+    key = sa.and_(Translation.source_language == source_language,
+                  Translation.dest_language == dest_language)
+    cached = dict(db.session.execute(
+        sa.select(Translation.text_hash, Translation.text)
+        .where(key, Translation.text_hash.in_(set(hashes)))).all())
+    if cached:
+        db.session.execute(
+            sa.update(Translation).where(key, Translation.text_hash.in_(cached))
+            .values(last_used=now),
+            execution_options={'synchronize_session': False})
+
+    missing = {}
+    for h, text in zip(hashes, texts):
+        if h not in cached:
+            missing.setdefault(h, text)
+    if missing:
+        translator = get_translator()
+        size = current_app.config['TRANSLATOR_BATCH_SIZE']
+        items = list(missing.items())
+        for i in range(0, len(items), size):
+            batch = items[i:i + size]
+            results = translator.translate([text for h, text in batch],
+                                           source_language, dest_language)
+            cached.update(zip([h for h, text in batch], results))
+        _store([
+            {'text_hash': h, 'source_language': source_language,
+             'dest_language': dest_language, 'text': cached[h], 'last_used': now}
+            for h in missing])
+    return [cached[h] for h in hashes]
+
+
+def _store(rows):
+    try:
+        with db.session.begin_nested():
+            db.session.execute(sa.insert(Translation), rows)
+    except sa.exc.IntegrityError:
+        # another request cached some of these first
+        return
+    limit = current_app.config['TRANSLATION_CACHE_SIZE']
+    excess = db.session.scalar(sa.select(sa.func.count()).select_from(Translation)) - limit
+    if excess > 0:
+        # least recently used first
+        oldest = sa.select(Translation.text_hash, Translation.source_language,
+                           Translation.dest_language) \
+            .order_by(Translation.last_used).limit(excess)
+        db.session.execute(
+            sa.delete(Translation).where(sa.tuple_(
+                Translation.text_hash, Translation.source_language,
+                Translation.dest_language).in_(oldest)),
+            execution_options={'synchronize_session': False})
 
 
 def translate(text, source_language, dest_language):
-    if 'MS_TRANSLATOR_KEY' not in current_app.config or \
-            not current_app.config['MS_TRANSLATOR_KEY']:
-        return _('Error: the translation service is not configured.')
-    auth = {
-        'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY'],
-        'Ocp-Apim-Subscription-Region': 'westus'
-    }
-    r = requests.post(
-        'https://api.cognitive.microsofttranslator.com'
-        '/translate?api-version=3.0&from={}&to={}'.format(
-            source_language, dest_language), headers=auth, json=[
-                {'Text': text}])
-    if r.status_code != 200:
-        return _('Error: the translation service failed.')
-    return r.json()[0]['translations'][0]['text']
\ No newline at end of file
+    try:
+        return translate_batch([text], source_language, dest_language)[0]
+    except TranslationError as e:
+        return str(e)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""Mixed read/write traffic under each database engine profile.
+
+Usage: python benchmarks/engine.py [threads ...]
+
+For the 'plain' and 'tuned' profiles, builds a throwaway SQLite database (or
+uses BENCH_DATABASE_URL, a scratch database whose tables are created and
+dropped) and runs that many threads for BENCH_DURATION seconds (default 5).
+Each operation reads the first explore page, or with probability WRITE_SHARE
+creates a post and commits. Prints throughput, median and 95th percentile
+latency, and the operations that failed, e.g. with "database is locked".
+"""
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import sqlalchemy as sa
+from app import create_app, db, queries
+from app.models import User, Post
+from config import Config
+
+USERS = 100
+POSTS = 5000
+DURATION = int(os.environ.get('BENCH_DURATION') or 5)
+WRITE_SHARE = 0.2
+
+
+class BenchConfig(Config):
+    TESTING = True
+    SQL_PROFILER = False
+
+
+def populate():
+    db.session.execute(sa.insert(User), [
+        {'id': i, 'username': f'user{i}', 'email': f'user{i}@example.com', 'role': 'user'}
+        for i in range(1, USERS + 1)
+    ])
+    db.session.execute(sa.insert(Post), [
+        {'title': 'post', 'body': 'lorem ipsum', 'user_id': random.randint(1, USERS),
+         'is_approved': True}
+        for _ in range(POSTS)
+    ])
+    db.session.commit()
+
+
+def worker(app, deadline, latencies, errors):
+    with app.app_context():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                if random.random() < WRITE_SHARE:
+                    db.session.add(Post(title='new', body='new post', is_approved=True,
+                                        user_id=random.randint(1, USERS)))
+                    db.session.commit()
+                else:
+                    db.session.scalars(queries.posts(approved=True).limit(25)).all()
+                    db.session.rollback()
+            except sa.exc.OperationalError:
+                db.session.rollback()
+                errors.append(1)
+                continue
+            latencies.append(time.perf_counter() - start)
+        db.session.remove()
+
+
+def run(profile, threads):
+    path = None
+    uri = os.environ.get('BENCH_DATABASE_URL')
+    if uri is None:
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        uri = 'sqlite:///' + path
+    BenchConfig.SQLALCHEMY_DATABASE_URI = uri
+    BenchConfig.DATABASE_PROFILE = profile
+    app = create_app(BenchConfig)
+    try:
+        with app.app_context():
+            db.create_all()
+            populate()
+            latencies, errors = [], []
+            deadline = time.perf_counter() + DURATION
+            pool = [threading.Thread(target=worker, args=(app, deadline, latencies, errors))
+                    for _ in range(threads)]
+            for t in pool:
+                t.start()
+            for t in pool:
+                t.join()
+            latencies.sort()
+            p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0
+            p95 = latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0
+            print(f'{profile:>6}  {threads:>3} threads  '
+                  f'{len(latencies) / DURATION:8.0f} ops/s  '
+                  f'p50 {p50:7.2f} ms  p95 {p95:7.2f} ms  '
+                  f'{len(errors):>5} failed')
+            db.drop_all()
+            db.session.remove()
+            db.engine.dispose()
+    finally:
+        if path:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    for threads in [int(arg) for arg in sys.argv[1:]] or [1, 4, 16]:
+        for profile in ('plain', 'tuned'):
+            run(profile, threads)
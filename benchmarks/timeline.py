@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""Compare read-time and write-time (fan-out) home timelines.
+
+Usage: python benchmarks/timeline.py [edges ...]
+
+Builds a throwaway SQLite database per edge count, then times the first page
+of ``User.following_posts()`` against ``User.home_timeline()`` for a sample of
+users, and the cost of fanning out newly approved posts. The hybrid column is
+``home_timeline()`` with the configured ``TIMELINE_FANOUT_LIMIT``, which also
+looks up popular followed accounts on every read.
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import sqlalchemy as sa
+from app import create_app, db
+from app.models import User, Post, followers, timeline
+from config import Config
+
+POSTS_PER_USER = 5
+SAMPLE_USERS = 50
+NEW_POSTS = 20
+
+
+class BenchConfig(Config):
+    TESTING = True
+    TIMELINE_FANOUT = True
+
+
+def populate(edges):
+    users = max(100, edges // 20)
+    now = datetime.now(timezone.utc)
+    db.session.execute(sa.insert(User), [
+        {'id': i, 'username': f'user{i}', 'email': f'user{i}@example.com',
+         'role': 'user'}
+        for i in range(1, users + 1)
+    ])
+    pairs = set()
+    while len(pairs) < edges:
+        follower, followed = random.randint(1, users), random.randint(1, users)
+        if follower != followed:
+            pairs.add((follower, followed))
+    db.session.execute(followers.insert(), [
+        {'follower_id': a, 'followed_id': b} for a, b in pairs
+    ])
+    db.session.execute(sa.insert(Post), [
+        {'title': 'post', 'body': 'lorem ipsum', 'user_id': u,
+         'is_approved': True,
+         'timestamp': now - timedelta(minutes=random.randint(0, 100000))}
+        for u in range(1, users + 1) for _ in range(POSTS_PER_USER)
+    ])
+    db.session.execute(timeline.insert().from_select(
+        ['user_id', 'post_id', 'timestamp'],
+        sa.union(
+            sa.select(Post.user_id, Post.id, Post.timestamp),
+            sa.select(followers.c.follower_id, Post.id, Post.timestamp)
+            .join(Post, Post.user_id == followers.c.followed_id)
+        )
+    ))
+    db.session.commit()
+    return users
+
+
+def time_reads(sample, per_page, build):
+    start = time.perf_counter()
+    for user in sample:
+        db.session.scalars(build(user).limit(per_page)).all()
+    return (time.perf_counter() - start) / len(sample) * 1000
+
+
+def time_fanout(users):
+    start = time.perf_counter()
+    for _ in range(NEW_POSTS):
+        author = db.session.get(User, random.randint(1, users))
+        post = Post(title='new', body='new post', author=author, is_approved=True)
+        db.session.add(post)
+        db.session.flush()
+        post.fan_out()
+        db.session.commit()
+    return (time.perf_counter() - start) / NEW_POSTS * 1000
+
+
+def run(edges):
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    BenchConfig.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+    app = create_app(BenchConfig)
+    try:
+        with app.app_context():
+            db.create_all()
+            users = populate(edges)
+            per_page = app.config['POSTS_PER_PAGE']
+            sample = [db.session.get(User, i) for i in
+                      random.sample(range(1, users + 1), SAMPLE_USERS)]
+            read_time = time_reads(sample, per_page, User.following_posts)
+            hybrid_read = time_reads(sample, per_page, User.home_timeline)
+            app.config['TIMELINE_FANOUT_LIMIT'] = None
+            fanout_read = time_reads(sample, per_page, User.home_timeline)
+            fanout_write = time_fanout(users)
+            print(f'{edges:>8} edges  {users:>6} users  '
+                  f'read-time feed {read_time:8.2f} ms  '
+                  f'fan-out feed {fanout_read:8.2f} ms  '
+                  f'hybrid feed {hybrid_read:8.2f} ms  '
+                  f'fan-out write {fanout_write:8.2f} ms/post')
+            db.session.remove()
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    for edges in [int(arg) for arg in sys.argv[1:]] or [10000, 100000]:
+        run(edges)
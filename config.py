@@ -9,14 +9,83 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
+    DATABASE_REPLICA_URLS = [
+        url for url in (os.environ.get('DATABASE_REPLICA_URLS') or '').split(',') if url]
+    REPLICA_STICKY_SECONDS = 10
+    DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE') or 'tuned'
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or 10)
+    DATABASE_MAX_OVERFLOW = 20
+    DATABASE_POOL_TIMEOUT = 10
+    DATABASE_POOL_RECYCLE = 1800
+    DATABASE_STATEMENT_TIMEOUT = 30
+    DATABASE_BUSY_TIMEOUT = 5
+    SQLITE_JOURNAL_MODE = 'WAL'
+    SQLITE_SYNCHRONOUS = 'NORMAL'
+    SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+    SQLITE_CACHE_SIZE = -64000
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = ['help@microblog.com']
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS') or 4)
+    JOB_MAX_ATTEMPTS = 5
+    JOB_RETRY_BACKOFF = 30
+    JOB_TIMEOUT = 600
+    JOB_POLL_INTERVAL = 1
+    JOB_RETENTION = 7 * 24 * 3600
+    JOB_PRUNE_INTERVAL = 3600
+    USER_PURGE_BATCH_SIZE = 500
+    MODERATION_CHUNK_SIZE = 500
     LANGUAGES = ['en', 'es']
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    TRANSLATOR_BACKEND = os.environ.get('TRANSLATOR_BACKEND') or 'microsoft'
+    TRANSLATOR_TIMEOUT = 5
+    TRANSLATOR_POOL_SIZE = 10
+    TRANSLATOR_BATCH_SIZE = 100
+    TRANSLATION_CACHE_SIZE = 100000
     POSTS_PER_PAGE = 25
+    PAGINATION_COUNT_TTL = 30
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or 'auto'
+    SEARCH_MAX_RESULTS = 1000
+    SEARCH_RECENCY_HALF_LIFE = 30
+    ANALYTICS_ROLLUP = True
+    ANALYTICS_DEFAULT_DAYS = 30
+    LAST_SEEN_WINDOW = 60
+    LAST_SEEN_FLUSH_INTERVAL = 30
+    LAST_SEEN_BATCH_SIZE = 500
+    SQL_PROFILER = os.environ.get('SQL_PROFILER', '0') != '0'
+    SQL_PROFILER_HISTORY = 100
+    SQL_SLOW_QUERY_THRESHOLD = float(os.environ.get('SQL_SLOW_QUERY_THRESHOLD') or 0.5)
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    METRICS_FLUSH_INTERVAL = 5
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    CACHE_TYPE = os.environ.get('CACHE_TYPE') or 'memory'
+    # None: cache whole pages only with a backend all processes share
+    CACHE_PAGES = None
+    CACHE_DEFAULT_TIMEOUT = 300
+    CACHE_THRESHOLD = 1000
+    CACHE_DIR = os.environ.get('CACHE_DIR') or os.path.join(basedir, 'cache')
+    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL') or 'redis://localhost:6379/0'
+    CACHE_KEY_PREFIX = 'microblog:'
+    TIMELINE_FANOUT = os.environ.get('TIMELINE_FANOUT', '0') != '0'
+    TIMELINE_FANOUT_LIMIT = int(os.environ.get('TIMELINE_FANOUT_LIMIT') or 10000)
     UPLOAD_FOLDER = os.path.join(basedir, "app/static/uploads")
-    ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif"}
\ No newline at end of file
+    UPLOAD_STORAGE = os.environ.get('UPLOAD_STORAGE') or 'local'
+    UPLOAD_S3_BUCKET = os.environ.get('UPLOAD_S3_BUCKET')
+    UPLOAD_S3_ENDPOINT = os.environ.get('UPLOAD_S3_ENDPOINT')
+    UPLOAD_S3_PREFIX = os.environ.get('UPLOAD_S3_PREFIX') or 'uploads/'
+    UPLOAD_S3_PUBLIC_URL = os.environ.get('UPLOAD_S3_PUBLIC_URL')
+    UPLOAD_GC_GRACE = 3600
+    UPLOAD_MAX_AGE = 365 * 24 * 3600
+    UPLOAD_X_ACCEL_PREFIX = os.environ.get('UPLOAD_X_ACCEL_PREFIX')
+    USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE') is not None
+    AVATAR_PROVIDER = os.environ.get('AVATAR_PROVIDER') or 'local'
+    AVATAR_FOLDER = os.path.join(basedir, 'cache', 'avatars')
+    AVATAR_SIZES = (64, 128, 256)
+    AVATAR_MAX_AGE = 365 * 24 * 3600
+    ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif"}
+    IMAGE_FORMAT = os.environ.get('IMAGE_FORMAT') or 'webp'
+    IMAGE_QUALITY = 80
+    IMAGE_VARIANTS = {'thumb': (200, 200), 'card': (800, 600), 'full': (1600, 1600)}
\ No newline at end of file
@@ -0,0 +1,48 @@
+"""Add post search index
+
+Revision ID: 5c1e8f2a9d47
+Revises: a73af6b50029
+Create Date: 2026-10-17 07:31:12.402918
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1e8f2a9d47'
+down_revision = 'a73af6b50029'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    conn = op.get_bind()
+    if conn.dialect.name == 'sqlite':
+        conn.execute(sa.text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(title, body)"))
+        conn.execute(sa.text(
+            "INSERT INTO post_fts (rowid, title, body) "
+            "SELECT id, title, body FROM post WHERE is_approved"))
+    elif conn.dialect.name == 'postgresql':
+        op.create_table('post_search',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('document', sa.dialects.postgresql.TSVECTOR(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index('ix_post_search_document', 'post_search', ['document'],
+                        unique=False, postgresql_using='gin')
+        conn.execute(sa.text(
+            "INSERT INTO post_search (id, document) "
+            "SELECT id, setweight(to_tsvector('simple', coalesce(title, '')), 'A') || "
+            "setweight(to_tsvector('simple', coalesce(body, '')), 'B') "
+            "FROM post WHERE is_approved"))
+
+
+def downgrade():
+    conn = op.get_bind()
+    if conn.dialect.name == 'sqlite':
+        conn.execute(sa.text("DROP TABLE IF EXISTS post_fts"))
+    elif conn.dialect.name == 'postgresql':
+        op.drop_index('ix_post_search_document', table_name='post_search')
+        op.drop_table('post_search')
@@ -1,14 +1,70 @@
 #!/usr/bin/env python
 from datetime import datetime, timezone, timedelta
+import csv
+import io
+import json
+import re
+import os
+import shutil
+import socket
+import socketserver
+import subprocess
+import tempfile
+import threading
+import time
 import unittest
-from app import create_app, db
-from app.models import User, Post
+import warnings
+from unittest import mock
+from app import create_app, db, last_seen, cache, metrics, profiler
+import sqlalchemy as sa
+from aiosmtpd.controller import Controller
+from PIL import Image
+from markupsafe import Markup
+from app.auth.email import send_password_reset_email
+from app.database import engine_options
+from app.email import send_email
+from app.images import collect_garbage, process_image
+from app.jobs import Worker, enqueue, task
+from app import queries
+from app.models import User, Post, Blob, Comment, DailyPostStats, Job, Translation, \
+    UserDeletion, followers, timeline
+from app.pagination import paginate
+from app.purge import clear_timeline, unlink_follows
+from app.translate import get_translator, translate, translate_batch
 from config import Config
 
 
 class TestConfig(Config):
     TESTING = True
+    WTF_CSRF_ENABLED = False
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    LAST_SEEN_FLUSH_INTERVAL = 0
+
+
+class QueryCounter:
+    """Collects the SQL statements run against the engine while active.
+    With a ``budget``, fails if more statements than that were run."""
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.statements = []
+
+    def __enter__(self):
+        sa.event.listen(db.engine, 'before_cursor_execute', self.record)
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        sa.event.remove(db.engine, 'before_cursor_execute', self.record)
+        if exc_type is None and self.budget is not None and self.count > self.budget:
+            raise AssertionError('{} queries over a budget of {}:\n{}'.format(
+                self.count, self.budget, '\n'.join(self.statements)))
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    @property
+    def count(self):
+        return len(self.statements)
 
 
 class UserModelCase(unittest.TestCase):
@@ -31,9 +87,18 @@ class UserModelCase(unittest.TestCase):
 
     def test_avatar(self):
         u = User(username='john', email='john@example.com')
+        self.assertEqual(u.avatar_hash, 'd4c74594d841139328695756648b6bd6')
+        with self.app.test_request_context():
+            self.assertEqual(u.avatar(128),
+                             '/avatars/d4c74594d841139328695756648b6bd6/128')
+            self.assertEqual(u.avatar(60),
+                             '/avatars/d4c74594d841139328695756648b6bd6/64')
+        self.app.config['AVATAR_PROVIDER'] = 'gravatar'
         self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
                                          'd4c74594d841139328695756648b6bd6'
                                          '?d=identicon&s=128'))
+        u.email = 'John@Example.org'
+        self.assertEqual(u.avatar_hash, '08aff750c4586c34375a0ebd987c1a7e')
 
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
@@ -62,6 +127,36 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.following_count(), 0)
         self.assertEqual(u2.followers_count(), 0)
 
+    def test_follow_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        u1.follow(u2)
+        u2.follow(u1)
+        u3.follow(u2)
+        db.session.commit()
+        self.assertEqual(u2.followers_count(), 2)
+
+        # deleting a user fixes the counters on the other side
+        while unlink_follows(u3.id, 10):
+            pass
+        db.session.delete(u3)
+        db.session.commit()
+        self.assertEqual(u2.followers_count(), 1)
+        self.assertEqual(u2.following_count(), 1)
+
+        # drifted counters are repaired by 'flask counters rebuild'
+        u1.num_followers = 7
+        u2.num_following = 0
+        db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=['counters', 'rebuild'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        db.session.refresh(u1)
+        db.session.refresh(u2)
+        self.assertEqual(u1.followers_count(), 1)
+        self.assertEqual(u2.following_count(), 1)
+
     def test_follow_posts(self):
         # create four users
         u1 = User(username='john', email='john@example.com')
@@ -72,14 +167,14 @@ class UserModelCase(unittest.TestCase):
 
         # create four posts
         now = datetime.now(timezone.utc)
-        p1 = Post(body="post from john", author=u1,
-                  timestamp=now + timedelta(seconds=1))
-        p2 = Post(body="post from susan", author=u2,
-                  timestamp=now + timedelta(seconds=4))
-        p3 = Post(body="post from mary", author=u3,
-                  timestamp=now + timedelta(seconds=3))
-        p4 = Post(body="post from david", author=u4,
-                  timestamp=now + timedelta(seconds=2))
+        p1 = Post(title="john", body="post from john", author=u1,
+                  is_approved=True, timestamp=now + timedelta(seconds=1))
+        p2 = Post(title="susan", body="post from susan", author=u2,
+                  is_approved=True, timestamp=now + timedelta(seconds=4))
+        p3 = Post(title="mary", body="post from mary", author=u3,
+                  is_approved=True, timestamp=now + timedelta(seconds=3))
+        p4 = Post(title="david", body="post from david", author=u4,
+                  is_approved=True, timestamp=now + timedelta(seconds=2))
         db.session.add_all([p1, p2, p3, p4])
         db.session.commit()
 
@@ -100,6 +195,1383 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_home_timeline(self):
+        self.app.config['TIMELINE_FANOUT'] = True
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        u1.follow(u2)
+        u3.follow(u2)
+        db.session.commit()
+
+        # approved posts are pushed to the author and their followers
+        now = datetime.now(timezone.utc)
+        p1 = Post(title='one', body='post from susan', author=u2,
+                  timestamp=now + timedelta(seconds=1))
+        p2 = Post(title='two', body='post from mary', author=u3,
+                  timestamp=now + timedelta(seconds=2))
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.home_timeline()).all(), [])
+        p1.is_approved = True
+        p1.fan_out()
+        p2.is_approved = True
+        p2.fan_out()
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.home_timeline()).all(), [p1])
+        self.assertEqual(db.session.scalars(u2.home_timeline()).all(), [p1])
+        self.assertEqual(db.session.scalars(u3.home_timeline()).all(), [p2, p1])
+
+        # following backfills, unfollowing prunes
+        u1.follow(u3)
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.home_timeline()).all(), [p2, p1])
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.home_timeline()).all(), [p2])
+
+        # deleted posts leave every timeline
+        p2.remove_from_timelines()
+        db.session.delete(p2)
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.home_timeline()).all(), [])
+        self.assertEqual(db.session.scalars(u3.home_timeline()).all(), [p1])
+
+    def test_home_timeline_popular_author(self):
+        self.app.config.update(TIMELINE_FANOUT=True, TIMELINE_FANOUT_LIMIT=1)
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        u1.follow(u2)
+        u3.follow(u2)
+        db.session.commit()
+
+        # susan is above the fan-out limit, so her post is read-time merged
+        p = Post(title='one', body='post from susan', author=u2,
+                 is_approved=True)
+        db.session.add(p)
+        db.session.flush()
+        p.fan_out()
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.home_timeline()).all(), [p])
+        self.assertEqual(db.session.scalars(u2.home_timeline()).all(), [p])
+        self.assertEqual(db.session.scalars(u3.home_timeline()).all(), [p])
+        self.assertEqual(db.session.scalar(
+            sa.select(sa.func.count()).select_from(timeline)), 1)
+
+        # back at the limit, the post is fanned out instead of merged
+        u3.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.home_timeline()).all(), [p])
+        self.assertEqual(db.session.scalars(u3.home_timeline()).all(), [])
+        self.assertEqual(db.session.scalar(
+            sa.select(sa.func.count()).select_from(timeline)), 2)
+
+        # the same when a follower's account is deleted
+        u3.follow(u2)
+        p2 = Post(title='two', body='another post from susan', author=u2, is_approved=True)
+        db.session.add(p2)
+        db.session.flush()
+        p2.fan_out()
+        while unlink_follows(u3.id, 10) or clear_timeline(u3.id, 10):
+            pass
+        db.session.delete(u3)
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.home_timeline()).all(), [p2, p])
+        self.assertEqual(db.session.scalar(
+            sa.select(sa.func.count()).select_from(timeline)), 4)
+
+    def test_cursor_pagination(self):
+        u = User(username='john', email='john@example.com')
+        now = datetime.now(timezone.utc)
+        # two posts share a timestamp to exercise the id tie-breaker
+        posts = [Post(title=str(i), body='post', author=u, is_approved=True,
+                      timestamp=now + timedelta(seconds=min(i, 3)))
+                 for i in range(6)]
+        db.session.add_all(posts)
+        db.session.commit()
+        query = sa.select(Post).order_by(Post.timestamp.desc(), Post.id.desc())
+        expected = db.session.scalars(query).all()
+
+        page1 = paginate(query, per_page=4, count=True)
+        self.assertEqual(page1.items, expected[:4])
+        self.assertEqual(page1.total, 6)
+        self.assertTrue(page1.has_next)
+        self.assertFalse(page1.has_prev)
+        page2 = paginate(query, cursor=page1.next_cursor, per_page=4)
+        self.assertEqual(page2.items, expected[4:])
+        self.assertFalse(page2.has_next)
+        self.assertTrue(page2.has_prev)
+        back = paginate(query, cursor=page2.prev_cursor, per_page=4)
+        self.assertEqual(back.items, expected[:4])
+        self.assertFalse(back.has_prev)
+
+        # a garbled cursor falls back to the first page
+        self.assertEqual(paginate(query, cursor='nope', per_page=4).items,
+                         expected[:4])
+
+
+class SearchCase(unittest.TestCase):
+    backend = 'sqlite'
+
+    def setUp(self):
+        class SearchConfig(TestConfig):
+            SEARCH_BACKEND = self.backend
+        self.app = create_app(SearchConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_search(self):
+        u = User(username='john', email='john@example.com')
+        now = datetime.now(timezone.utc)
+        old = Post(title='cats', body='a post about cats', author=u,
+                   is_approved=True, timestamp=now - timedelta(days=90))
+        new = Post(title='cats', body='another post about cats', author=u,
+                   is_approved=True, timestamp=now)
+        dogs = Post(title='dogs', body='a post about dogs', author=u,
+                    is_approved=True, timestamp=now)
+        pending = Post(title='cats', body='pending cats', author=u)
+        db.session.add_all([old, new, dogs, pending])
+        db.session.commit()
+
+        # equally relevant matches rank by recency; pending posts are hidden
+        posts, total = Post.search('cats', 1, 10)
+        self.assertEqual(posts, [new, old])
+        self.assertEqual(total, 2)
+        posts, total = Post.search('post cats', 1, 1)
+        self.assertEqual((posts, total), ([new], 2))
+        self.assertEqual(Post.search('"cats*', 1, 10)[1], 2)
+
+        # the index follows approvals, edits and deletes
+        pending.is_approved = True
+        dogs.title = 'cats and dogs'
+        db.session.delete(old)
+        db.session.commit()
+        self.assertEqual(Post.search('cats', 1, 10)[1], 3)
+        self.assertEqual(Post.search('dogs', 1, 10)[0], [dogs])
+
+        self.assertEqual(Post.reindex(), 3)
+        self.assertEqual(Post.search('cats', 1, 10)[1], 3)
+
+
+class PythonSearchCase(SearchCase):
+    backend = 'python'
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """Answers the handful of Redis commands the cache sends."""
+
+    def handle(self):
+        store = self.server.store
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:])):
+                size = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(size + 2)[:-2])
+            command = args[0].upper()
+            if command == b'GET':
+                value = store.get(args[1])
+                if value is None or (value[1] and value[1] < time.time()):
+                    self.wfile.write(b'$-1\r\n')
+                else:
+                    self.wfile.write(b'$%d\r\n%s\r\n' % (len(value[0]), value[0]))
+            elif command == b'SET':
+                expires = time.time() + int(args[4]) if len(args) > 3 else 0
+                store[args[1]] = (args[2], expires)
+                self.wfile.write(b'+OK\r\n')
+            elif command == b'DEL':
+                removed = sum(store.pop(key, None) is not None for key in args[1:])
+                self.wfile.write(b':%d\r\n' % removed)
+            elif command == b'KEYS':
+                prefix = args[1].rstrip(b'*')
+                keys = [key for key in store if key.startswith(prefix)]
+                self.wfile.write(b'*%d\r\n' % len(keys) + b''.join(
+                    b'$%d\r\n%s\r\n' % (len(key), key) for key in keys))
+            else:
+                self.wfile.write(b'+OK\r\n')
+
+
+class CacheCase(unittest.TestCase):
+    backend = 'memory'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), FakeRedisHandler)
+        self.server.daemon_threads = True
+        self.server.store = {}
+        threading.Thread(target=self.server.serve_forever, args=(0.01,), daemon=True).start()
+
+        class CacheConfig(TestConfig):
+            CACHE_TYPE = self.backend
+            CACHE_DIR = self.tmpdir
+            CACHE_THRESHOLD = 3
+            CACHE_REDIS_URL = 'redis://127.0.0.1:%d/0' % self.server.server_address[1]
+        self.app = create_app(CacheConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.request_context = self.app.test_request_context()
+        self.request_context.push()
+
+    def tearDown(self):
+        self.request_context.pop()
+        self.app_context.pop()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_set(self):
+        backend = self.app.extensions['cache']
+        self.assertIsNone(backend.get('a'))
+        backend.set('a', 'caf\u00e9', 60)
+        backend.set('b', 'old', 1)
+        self.assertEqual(backend.get('a'), 'caf\u00e9')
+        backend.delete('a')
+        self.assertIsNone(backend.get('a'))
+        later = time.time() + 2
+        with mock.patch('time.time', return_value=later), \
+                mock.patch('app.cache.time', return_value=later):
+            self.assertIsNone(backend.get('b'))
+        backend.set('c', 'value', 0)
+        cache.clear()
+        self.assertIsNone(backend.get('c'))
+
+    def test_fragment(self):
+        renders = []
+        template = self.app.jinja_env.from_string(
+            "{% call cached('post', id, version) %}{{ render(id) }}{% endcall %}")
+        render = lambda id: renders.append(id) or Markup(f'<b>{id}</b>')
+        self.assertEqual(template.render(id=1, version=1, render=render), '<b>1</b>')
+        self.assertEqual(template.render(id=1, version=1, render=render), '<b>1</b>')
+        self.assertEqual(template.render(id=1, version=2, render=render), '<b>1</b>')
+        self.assertEqual(renders, [1, 1])
+        self.assertGreaterEqual(cache.stats()['fragment']['hits'], 1)
+
+    def test_eviction(self):
+        if self.backend != 'memory':
+            self.skipTest('only the in-process cache has a size limit')
+        backend = self.app.extensions['cache']
+        for key in 'abc':
+            backend.set(key, key, 60)
+        backend.get('a')
+        backend.set('d', 'd', 60)
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(backend.get('a'), 'a')
+
+    def test_page_generation(self):
+        key, html = cache.page('explore', None)
+        self.assertIsNone(html)
+        cache.store(key, 'page')
+        self.assertEqual(cache.page('explore', None)[1], 'page')
+        cache.invalidate('explore')
+        self.assertIsNone(cache.page('explore', None)[1])
+
+
+class FileSystemCacheCase(CacheCase):
+    backend = 'filesystem'
+
+
+class RedisCacheCase(CacheCase):
+    backend = 'redis'
+
+
+class TranslateCase(unittest.TestCase):
+    def setUp(self):
+        class TranslateConfig(TestConfig):
+            TRANSLATOR_BACKEND = 'stub'
+            TRANSLATOR_BATCH_SIZE = 2
+            TRANSLATION_CACHE_SIZE = 3
+        self.app = create_app(TranslateConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_cache(self):
+        translator = get_translator()
+        self.assertEqual(translate('hola', 'es', 'en'), '[en] hola')
+        self.assertEqual(translate('hola', 'es', 'en'), '[en] hola')
+        self.assertEqual(translate('hola', 'es', 'fr'), '[fr] hola')
+        self.assertEqual(translator.batches, [['hola'], ['hola']])
+
+    def test_batch(self):
+        translator = get_translator()
+        translate('uno', 'es', 'en')
+        texts = translate_batch(['uno', 'dos', 'tres', 'dos'], 'es', 'en')
+        self.assertEqual(texts, ['[en] uno', '[en] dos', '[en] tres', '[en] dos'])
+        # the cached text is skipped, duplicates are sent once
+        self.assertEqual(translator.batches, [['uno'], ['dos', 'tres']])
+
+    def test_eviction(self):
+        translate('uno', 'es', 'en')
+        translate('dos', 'es', 'en')
+        translate('tres', 'es', 'en')
+        translate('uno', 'es', 'en')  # now the most recently used
+        translate('cuatro', 'es', 'en')
+        cached = db.session.scalars(sa.select(Translation.text)).all()
+        self.assertEqual(sorted(cached), ['[en] cuatro', '[en] tres', '[en] uno'])
+
+    def test_route(self):
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        response = client.post('/translate', json={
+            'texts': ['uno', 'dos'], 'source_language': 'es', 'dest_language': 'en'})
+        self.assertEqual(response.json, {'texts': ['[en] uno', '[en] dos']})
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(Translation)), 2)
+
+        # a stored post is translated from its detected language
+        p = Post(title='Hola', body='Hola, ¿cómo estás? Espero que todo vaya bien.',
+                 author=u, is_approved=True)
+        p.detect_language()
+        db.session.add(p)
+        db.session.commit()
+        self.assertEqual(p.language, 'es')
+        response = client.post('/translate', json={'post_id': p.id, 'dest_language': 'en'})
+        self.assertEqual(response.json, {'text': '[en] ' + p.body})
+
+    def test_language_backfill(self):
+        u = User(username='john', email='john@example.com')
+        p = Post(title='Bonjour', body="Je pense que c'est une très bonne idée.", author=u)
+        c = Comment(body='This is a perfectly ordinary English sentence.', author=u, post=p)
+        db.session.add_all([u, p, c])
+        db.session.commit()
+        self.assertIsNone(p.language)
+        result = self.app.test_cli_runner().invoke(args=['language', 'backfill', '--workers', '1'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        db.session.expire_all()
+        self.assertEqual(p.language, 'fr')
+        self.assertEqual(c.language, 'en')
+
+
+class SMTPRecorder:
+    def __init__(self):
+        self.messages = []
+        self.sessions = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        if session not in self.sessions:
+            self.sessions.append(session)
+        return '250 OK'
+
+
+flaky_calls = []
+
+
+@task('flaky')
+def flaky(failures):
+    flaky_calls.append(failures)
+    if len(flaky_calls) <= failures:
+        raise RuntimeError('try again')
+
+
+class JobCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        self.smtp = SMTPRecorder()
+        self.controller = Controller(self.smtp, hostname='127.0.0.1', port=port)
+        self.controller.start()
+
+        class JobConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(self.tmpdir, 'app.db')
+            MAIL_SERVER = '127.0.0.1'
+            MAIL_PORT = port
+            MAIL_SUPPRESS_SEND = False
+            JOB_RETRY_BACKOFF = 0
+            JOB_POLL_INTERVAL = 0.01
+        self.app = create_app(JobConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        flaky_calls.clear()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.controller.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_email(self):
+        for i in range(6):
+            send_email(f'Hello {i}', sender='no-reply@example.com',
+                       recipients=[f'user{i}@example.com'],
+                       text_body='hello', html_body='<p>hello</p>')
+        db.session.commit()
+        Worker(self.app, workers=2).run(burst=True)
+        self.assertEqual(len(self.smtp.messages), 6)
+        # each worker thread keeps its SMTP connection open between messages
+        self.assertLessEqual(len(self.smtp.sessions), 2)
+        statuses = db.session.scalars(sa.select(Job.status)).all()
+        self.assertEqual(statuses, ['done'] * 6)
+
+    def test_retry(self):
+        enqueue('flaky', failures=2)
+        db.session.commit()
+        with self.assertLogs(self.app.logger, 'WARNING'):
+            Worker(self.app, workers=1).run(burst=True)
+        job = db.session.scalar(sa.select(Job))
+        self.assertEqual((job.status, job.attempts), ('done', 3))
+        self.assertIsNone(job.error)
+
+    def test_give_up(self):
+        enqueue('flaky', max_attempts=2, failures=5)
+        db.session.commit()
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            Worker(self.app, workers=1).run(burst=True)
+        self.assertIn('failed for good', logs.output[-1])
+        job = db.session.scalar(sa.select(Job))
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
+        self.assertEqual(job.error, 'RuntimeError: try again')
+
+    def test_requeue_stale(self):
+        job = enqueue('flaky', failures=0)
+        job.status = 'running'
+        job.locked_at = datetime.now(timezone.utc) - timedelta(hours=1)
+        db.session.commit()
+        Worker(self.app, workers=1).run(burst=True)
+        db.session.refresh(job)
+        self.assertEqual(job.status, 'done')
+
+    def test_prune(self):
+        now = datetime.now(timezone.utc)
+        for status, age in (('done', 10), ('failed', 10), ('done', 1), ('queued', 10)):
+            job = enqueue('flaky', failures=0)
+            job.status = status
+            if status != 'queued':
+                job.finished_at = now - timedelta(days=age)
+        db.session.commit()
+        worker = Worker(self.app, workers=1)
+        self.assertEqual(worker.prune(batch_size=1), 2)
+        statuses = db.session.scalars(sa.select(Job.status).order_by(Job.id)).all()
+        self.assertEqual(statuses, ['done', 'queued'])
+
+        # the worker loop prunes when it starts and every JOB_PRUNE_INTERVAL
+        db.session.execute(sa.update(Job).where(Job.status == 'done')
+                           .values(finished_at=now - timedelta(days=10)))
+        db.session.commit()
+        Worker(self.app, workers=1).run(burst=True)
+        statuses = db.session.scalars(sa.select(Job.status).order_by(Job.id)).all()
+        self.assertEqual(statuses, ['done'])
+
+
+class PurgeCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        class PurgeConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(self.tmpdir, 'app.db')
+            UPLOAD_FOLDER = os.path.join(self.tmpdir, 'uploads')
+            USER_PURGE_BATCH_SIZE = 2
+            TIMELINE_FANOUT = True
+            JOB_POLL_INTERVAL = 0.01
+        self.app = create_app(PurgeConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.engine.dispose()
+        self.app_context.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_delete_user(self):
+        admin = User(username='admin', email='admin@example.com', role='admin')
+        admin.set_password('cat')
+        john = User(username='john', email='john@example.com')
+        john.set_password('dog')
+        susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([admin, john, susan])
+        os.makedirs(self.app.config['UPLOAD_FOLDER'])
+        blob = Blob(hash='a' * 64, extension='jpg', size=3)
+        db.session.add(blob)
+        for name in (blob.filename, 'legacy.jpg'):
+            with open(os.path.join(self.app.config['UPLOAD_FOLDER'], name), 'w') as f:
+                f.write('jpg')
+        posts = [Post(title=f'post {i}', body='hello', author=john, is_approved=True)
+                 for i in range(3)]
+        posts[0].image = blob.filename
+        posts[1].image = 'legacy.jpg'
+        other = Post(title='other', body='hello', author=susan, is_approved=True)
+        db.session.add_all(posts + [other])
+        db.session.flush()
+        john.follow(susan)
+        susan.follow(john)
+        for post in posts + [other]:
+            post.fan_out()
+        db.session.add_all([
+            Comment(body='mine', author=john, post=other),
+            Comment(body='mine too', author=john, post=other),
+            Comment(body='yours', author=susan, post=posts[0]),
+        ])
+        other.update_comment_count(2)
+        db.session.commit()
+        john_id = john.id
+
+        self.client.post('/auth/login', data={'username': 'admin', 'password': 'cat'})
+        response = self.client.post(f'/admin/users/delete/{john_id}')
+        self.assertEqual(response.location, '/admin/users/deletions')
+        deletion = db.session.scalar(sa.select(UserDeletion))
+        # 3 posts, 3 comments, 2 follow edges and susan's post in john's timeline
+        self.assertEqual((deletion.username, deletion.total, deletion.done), ('john', 9, 0))
+        db.session.refresh(john)
+        self.assertFalse(john.is_active)
+        self.assertEqual(self.client.get('/user/john').status_code, 404)
+        self.client.post('/follow/john')
+        self.assertFalse(admin.is_following(john))
+        self.client.get('/auth/logout')
+        response = self.client.post('/auth/login', data={'username': 'john', 'password': 'dog'})
+        self.assertEqual(response.location, '/auth/login')
+
+        Worker(self.app, workers=1).run(burst=True)
+        db.session.expire_all()
+        self.assertIsNone(db.session.get(User, john_id))
+        self.assertEqual(db.session.scalars(sa.select(Post.title)).all(), ['other'])
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(Comment)), 0)
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(timeline)), 1)
+        self.assertEqual((other.num_comments, susan.num_followers, susan.num_following), (0, 0, 0))
+        self.assertIsNone(db.session.get(Blob, 'a' * 64))
+        self.assertEqual(os.listdir(self.app.config['UPLOAD_FOLDER']), [])
+        self.assertIsNotNone(deletion.finished_at)
+        self.assertEqual((deletion.done, deletion.files, deletion.progress()), (9, 2, 100))
+        jobs = db.session.scalars(sa.select(Job.status).where(Job.name == 'purge_user')).all()
+        self.assertEqual(jobs, ['done'] * 8)
+
+        self.client.post('/auth/login', data={'username': 'admin', 'password': 'cat'})
+        html = self.client.get('/admin/users/deletions').get_data(as_text=True)
+        self.assertIn('9 of 9 rows deleted, 2 files removed', html)
+
+
+class ImageCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        class ImageConfig(TestConfig):
+            UPLOAD_FOLDER = self.tmpdir
+        self.app = create_app(ImageConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def upload(self, size=(3000, 2000), orientation=None):
+        image = Image.new('RGB', size, 'red')
+        exif = Image.Exif()
+        exif[0x010f] = 'Camera maker'
+        if orientation:
+            exif[0x0112] = orientation
+        image.save(os.path.join(self.tmpdir, 'photo.jpg'), exif=exif.tobytes())
+        u = User(username='john', email='john@example.com')
+        post = Post(title='photo', body='a photo', author=u, image='photo.jpg')
+        db.session.add(post)
+        db.session.commit()
+        return post
+
+    def test_variants(self):
+        post = self.upload(orientation=6)  # rotated 90 degrees
+        process_image(post.id, 'photo.jpg')
+        self.assertEqual((post.image_width, post.image_height), (2000, 3000))
+        self.assertEqual(post.image_size('card'), (400, 600))
+        with self.app.test_request_context():
+            self.assertEqual(post.image_url('thumb'), '/uploads/photo.thumb.webp')
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'photo.jpg')))
+        for variant in ('thumb', 'card', 'full'):
+            with Image.open(os.path.join(self.tmpdir, post.image_filename(variant))) as image:
+                self.assertEqual(image.format, 'WEBP')
+                self.assertEqual(image.size, post.image_size(variant))
+                self.assertEqual(len(image.getexif()), 0)
+
+        post.is_approved = True
+        db.session.commit()
+        html = self.app.test_client().get('/explore').get_data(as_text=True)
+        self.assertIn('src="/uploads/photo.card.webp" alt="Post image" width="400" height="600"', html)
+
+    def test_small_image_not_enlarged(self):
+        self.app.config['IMAGE_FORMAT'] = 'jpeg'
+        post = self.upload(size=(120, 80))
+        process_image(post.id, 'photo.jpg')
+        self.assertEqual(post.image_size('full'), (120, 80))
+        with Image.open(os.path.join(self.tmpdir, 'photo.full.jpg')) as image:
+            self.assertEqual(image.size, (120, 80))
+            self.assertNotIn('exif', image.info)
+
+    def post_upload(self, client, title, data):
+        return client.post('/index', data={
+            'title': title, 'post': 'a photo', 'image': (io.BytesIO(data), 'photo.jpg')},
+            content_type='multipart/form-data')
+
+    def test_deduplication(self):
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        data = io.BytesIO()
+        Image.new('RGB', (50, 40), 'blue').save(data, format='JPEG')
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', sa.exc.SAWarning)
+            self.post_upload(client, 'first', data.getvalue())
+            self.post_upload(client, 'second', data.getvalue())
+
+        blob = db.session.scalar(sa.select(Blob))
+        self.assertEqual(blob.refcount, 2)
+        self.assertEqual(os.listdir(self.tmpdir), [blob.filename])
+        posts = db.session.scalars(sa.select(Post).order_by(Post.id)).all()
+        self.assertEqual([p.image for p in posts], [blob.filename] * 2)
+        jobs = db.session.scalars(sa.select(Job)).all()
+        self.assertEqual(len(jobs), 2)
+
+        # processing one upload serves every post sharing it
+        process_image(**jobs[0].payload)
+        process_image(**jobs[1].payload)
+        db.session.expire_all()
+        self.assertEqual([p.image_size('full') for p in posts], [(50, 40)] * 2)
+        self.assertEqual(len(os.listdir(self.tmpdir)), 3)
+
+        # a third upload of the same file needs no work at all
+        self.post_upload(client, 'third', data.getvalue())
+        third = db.session.scalar(sa.select(Post).where(Post.title == 'third'))
+        self.assertEqual(third.image_format, 'webp')
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(Job)), 2)
+        self.assertEqual(db.session.get(Blob, blob.hash).refcount, 3)
+
+    def test_garbage_collection(self):
+        post = self.upload()
+        blob = Blob(hash='a' * 64, extension='jpg', size=3, refcount=1)
+        db.session.add(blob)
+        post.image = blob.filename
+        db.session.commit()
+        self.assertEqual(blob.refcount, 2)
+        for name in (blob.filename, 'stray.jpg'):
+            with open(os.path.join(self.tmpdir, name), 'wb') as f:
+                f.write(b'abc')
+
+        # the recount fixes the drift; nothing is old enough to go yet
+        self.assertEqual(collect_garbage(), (0, 0))
+        self.assertEqual(blob.refcount, 1)
+        db.session.delete(post)
+        db.session.commit()
+        self.assertEqual(blob.refcount, 0)
+        self.assertEqual(collect_garbage(grace=-1), (1, 2))
+        self.assertEqual(os.listdir(self.tmpdir), [])
+        self.assertIsNone(db.session.get(Blob, blob.hash))
+
+    def test_unprocessed_image(self):
+        post = self.upload()
+        with self.app.test_request_context():
+            self.assertEqual(post.image_url('card'), '/uploads/photo.jpg')
+
+    def test_serve_upload(self):
+        with open(os.path.join(self.tmpdir, 'abc123.card.webp'), 'wb') as f:
+            f.write(b'0123456789')
+        client = self.app.test_client()
+        rv = client.get('/uploads/abc123.card.webp')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.headers['ETag'], '"abc123.card"')
+        self.assertEqual(rv.mimetype, 'image/webp')
+        cache_control = rv.headers['Cache-Control']
+        self.assertIn('immutable', cache_control)
+        self.assertIn('max-age=31536000', cache_control)
+        rv = client.get('/uploads/abc123.card.webp', headers={'If-None-Match': '"abc123.card"'})
+        self.assertEqual(rv.status_code, 304)
+        rv = client.get('/uploads/abc123.card.webp', headers={'Range': 'bytes=2-5'})
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(rv.data, b'2345')
+        self.assertEqual(client.get('/uploads/missing.webp').status_code, 404)
+        self.assertEqual(client.get('/uploads/..').status_code, 404)
+
+    def test_serve_upload_x_accel(self):
+        with open(os.path.join(self.tmpdir, 'abc123.card.webp'), 'wb') as f:
+            f.write(b'0123456789')
+        self.app.config['UPLOAD_X_ACCEL_PREFIX'] = '/protected/uploads/'
+        client = self.app.test_client()
+        rv = client.get('/uploads/abc123.card.webp')
+        self.assertEqual(rv.headers['X-Accel-Redirect'], '/protected/uploads/abc123.card.webp')
+        self.assertEqual(rv.data, b'')
+        self.assertIn('immutable', rv.headers['Cache-Control'])
+        rv = client.get('/uploads/abc123.card.webp', headers={'If-None-Match': '"abc123.card"'})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(client.get('/uploads/missing.webp').status_code, 404)
+
+
+class MetricsCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        metrics.latency.clear()
+        metrics.responses.clear()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def scrape(self, **kwargs):
+        response = self.client.get('/metrics', **kwargs)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/plain')
+        samples = {}
+        for line in response.get_data(as_text=True).splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        return samples
+
+    def test_metrics(self):
+        self.app.config['CACHE_PAGES'] = True
+        self.client.get('/explore')
+        self.client.get('/explore')
+        self.client.get('/auth/login')
+        enqueue('send_email', subject='hi')
+        db.session.add(Blob(hash='a' * 64, extension='jpg', size=1234))
+        db.session.commit()
+
+        samples = self.scrape()
+        explore = 'blueprint="main",endpoint="main.explore",method="GET"'
+        self.assertEqual(samples[f'microblog_request_duration_seconds_count{{{explore}}}'], 2)
+        self.assertEqual(samples[f'microblog_request_duration_seconds_bucket{{{explore},le="+Inf"}}'], 2)
+        self.assertGreater(samples[f'microblog_request_duration_seconds_sum{{{explore}}}'], 0)
+        self.assertEqual(samples[f'microblog_responses_total{{{explore},status="200"}}'], 2)
+        self.assertIn('microblog_request_duration_seconds_count{blueprint="auth",'
+                      'endpoint="auth.login",method="GET"}', samples)
+        # the scrape itself
+        self.assertEqual(samples['microblog_requests_in_flight'], 1)
+        self.assertEqual(samples['microblog_job_queue_depth{name="send_email"}'], 1)
+        self.assertEqual(samples['microblog_upload_blobs'], 1)
+        self.assertEqual(samples['microblog_upload_bytes'], 1234)
+        stats = cache.stats()['page']
+        self.assertEqual(samples['microblog_cache_hits_total{kind="page"}'], stats['hits'])
+        self.assertEqual(samples['microblog_cache_hit_ratio{kind="page"}'], stats['ratio'])
+        activity = last_seen.stats()
+        for name in ('recorded', 'skipped', 'flushes', 'rows_flushed', 'errors'):
+            self.assertEqual(samples[f'microblog_last_seen_{name}_total'], activity[name])
+        self.assertEqual(samples['microblog_last_seen_pending'], activity['pending'])
+
+    def test_multiprocess(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.app.config['METRICS_DIR'] = directory
+        key = ['main', 'main.explore', 'GET']
+        other = {'latency': [key + [[0] * 10 + [3], 30.0, 3]],
+                 'responses': [key + ['200', 3]], 'in_flight': 2, 'pool': {},
+                 'cache': {'page': [5, 5]}}
+        # a worker that is still running and one that has exited
+        exited = subprocess.Popen(['true'])
+        exited.wait()
+
+        def write(name):
+            with open(os.path.join(directory, name), 'w') as f:
+                json.dump(other, f)
+        write(f'{os.getppid()}-a.json')
+        write(f'{exited.pid}-a.json')
+
+        self.client.get('/explore')
+        samples = self.scrape()
+        explore = 'blueprint="main",endpoint="main.explore",method="GET"'
+        self.assertEqual(samples[f'microblog_request_duration_seconds_count{{{explore}}}'], 7)
+        self.assertEqual(samples[f'microblog_request_duration_seconds_bucket{{{explore},le="5"}}'], 1)
+        self.assertEqual(samples[f'microblog_responses_total{{{explore},status="200"}}'], 7)
+        self.assertEqual(samples['microblog_requests_in_flight'], 3)
+        self.assertIn(metrics.filename(), os.listdir(directory))
+
+        # exited workers are folded into one file, whose counts are kept
+        self.assertNotIn(f'{exited.pid}-a.json', os.listdir(directory))
+        self.assertIn('exited.json', os.listdir(directory))
+        self.assertEqual(self.scrape()[f'microblog_responses_total{{{explore},status="200"}}'], 7)
+        # a new worker that was given the PID of an exited one
+        write(f'{os.getppid()}-b.json')
+        write(f'{exited.pid}-b.json')
+        samples = self.scrape()
+        self.assertEqual(samples[f'microblog_responses_total{{{explore},status="200"}}'], 13)
+        self.assertEqual(samples['microblog_requests_in_flight'], 5)
+
+    def test_token(self):
+        self.app.config['METRICS_TOKEN'] = 'secret'
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.scrape(headers={'Authorization': 'Bearer secret'})
+
+
+class QueryPlanCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def assertUsesIndex(self, query, index=None):
+        compiled = query.compile(db.engine, compile_kwargs={'literal_binds': True})
+        plan = ' | '.join(row[-1] for row in db.session.execute(
+            sa.text(f'EXPLAIN QUERY PLAN {compiled}')))
+        self.assertIn('USING', plan)
+        self.assertNotRegex(plan, r'SCAN (post|comment|followers)\b')
+        # the index also gives the order, so there is no sort step
+        self.assertNotIn('TEMP B-TREE', plan)
+        if index:
+            self.assertIn(index, plan)
+
+    def test_hot_queries_use_indexes(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        since = datetime(2024, 1, 1)
+        for approved in (True, False):
+            with self.subTest(approved=approved):
+                self.assertUsesIndex(queries.posts(approved).limit(25))
+                self.assertUsesIndex(
+                    queries.posts(approved).where(Post.timestamp < since).limit(25))
+                self.assertUsesIndex(queries.user_posts(u, approved).limit(3),
+                                     'ix_post_user_id_is_approved_timestamp_id')
+        self.assertUsesIndex(queries.posts(True).limit(25), 'ix_post_is_approved_timestamp_id')
+        self.assertUsesIndex(sa.select(Comment).where(Comment.post_id == 1)
+                             .order_by(Comment.timestamp), 'ix_comment_post_id_timestamp')
+        self.assertUsesIndex(sa.select(followers.c.follower_id)
+                             .where(followers.c.followed_id == u.id),
+                             'ix_followers_followed_id_follower_id')
+        # the public avatar route looks up arbitrary digests
+        self.assertUsesIndex(sa.select(User.id).where(User.avatar_hash == '0' * 32),
+                             'ix_user_avatar_hash')
+
+    def test_pending_partial_index(self):
+        index = sa.inspect(db.engine).get_indexes('post')
+        pending = [i for i in index if i['name'] == 'ix_post_pending_timestamp_id']
+        self.assertEqual(pending[0]['column_names'], ['timestamp', 'id'])
+        sql = db.session.scalar(sa.text(
+            "SELECT sql FROM sqlite_master WHERE name = 'ix_post_pending_timestamp_id'"))
+        self.assertIn('WHERE is_approved IS 0', sql)
+        # SQLite refuses INDEXED BY when the index cannot answer the query
+        query = str(queries.posts(False).limit(25).compile(
+            db.engine, compile_kwargs={'literal_binds': True}))
+        plan = db.session.execute(sa.text('EXPLAIN QUERY PLAN ' + query.replace(
+            'FROM post', 'FROM post INDEXED BY ix_post_pending_timestamp_id'))).all()
+        self.assertNotIn('TEMP B-TREE', str(plan))
+
+
+class DatabaseProfileCase(unittest.TestCase):
+    def make_app(self, profile):
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        class ProfileConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+            DATABASE_PROFILE = profile
+        app = create_app(ProfileConfig)
+        app_context = app.app_context()
+        app_context.push()
+        self.addCleanup(app_context.pop)
+        self.addCleanup(db.engine.dispose)
+        self.addCleanup(db.session.remove)
+        db.create_all()
+        return app
+
+    def pragma(self, name):
+        return db.session.execute(sa.text(f'PRAGMA {name}')).scalar()
+
+    def test_tuned_sqlite(self):
+        self.make_app('tuned')
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
+        self.assertEqual(self.pragma('synchronous'), 1)
+        self.assertEqual(self.pragma('foreign_keys'), 1)
+        self.assertEqual(self.pragma('busy_timeout'), 5000)
+        self.assertEqual(self.pragma('cache_size'), -64000)
+
+        # ON DELETE CASCADE is enforced
+        u = User(username='john', email='john@example.com')
+        db.session.add(Post(title='post', body='post', author=u))
+        db.session.commit()
+        db.session.execute(sa.delete(User).where(User.id == u.id))
+        db.session.commit()
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(Post)), 0)
+
+    def test_plain_sqlite(self):
+        self.make_app('plain')
+        self.assertEqual(self.pragma('journal_mode'), 'delete')
+        self.assertEqual(self.pragma('foreign_keys'), 0)
+
+    def test_server_options(self):
+        config = {k: getattr(TestConfig, k) for k in dir(TestConfig) if k.isupper()}
+        options = engine_options(config, 'postgresql://db/microblog')
+        self.assertEqual(options['pool_size'], 10)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args'], {'options': '-c statement_timeout=30000'})
+        options = engine_options(config, 'mysql://db/microblog')
+        self.assertNotIn('connect_args', options)
+        self.assertEqual(engine_options(config, 'sqlite://'), {})
+        config['DATABASE_PROFILE'] = 'plain'
+        self.assertEqual(engine_options(config, 'postgresql://db/microblog'), {})
+
+
+class ReplicaCase(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        class ReplicaConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'primary.db')
+            DATABASE_REPLICA_URLS = ['sqlite:///' + os.path.join(directory, 'replica.db')]
+        self.app = create_app(ReplicaConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.replica, = self.app.extensions['replicas']
+        db.metadata.create_all(self.replica)
+        self.client = self.app.test_client()
+
+        # the replica lags behind: it has the user but not the new post
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(Post(title='old', body='old post', author=u, is_approved=True))
+        db.session.commit()
+        with self.replica.begin() as conn:
+            conn.execute(sa.insert(User.__table__), [{c.key: getattr(u, c.key) for c in User.__table__.c}])
+            conn.execute(sa.insert(Post.__table__), [{
+                'title': 'old', 'body': 'old post', 'user_id': u.id, 'is_approved': True,
+                'timestamp': datetime.now(timezone.utc), 'num_comments': 0, 'version': 1}])
+        db.session.add(Post(title='new', body='new post', author=u, is_approved=True))
+        db.session.commit()
+        cache.clear()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.engine.dispose()
+        self.replica.dispose()
+        self.app_context.pop()
+
+    def test_get_reads_replica(self):
+        html = self.client.get('/explore').get_data(as_text=True)
+        self.assertIn('old', html)
+        self.assertNotIn('new post', html)
+        # outside requests everything goes to the primary
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(Post)), 2)
+
+    def test_page_cache_reads_primary(self):
+        self.app.config['CACHE_PAGES'] = True
+        self.assertIn('new post', self.client.get('/explore').get_data(as_text=True))
+        hits = cache.stats()['page']['hits']
+        self.assertIn('new post', self.client.get('/explore').get_data(as_text=True))
+        self.assertEqual(cache.stats()['page']['hits'], hits + 1)
+
+    def test_read_your_writes(self):
+        self.client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        self.assertIn('new post', self.client.get('/explore').get_data(as_text=True))
+        with mock.patch('app.database.time', return_value=time.time() + 60):
+            html = self.client.get('/explore').get_data(as_text=True)
+        self.assertNotIn('new post', html)
+
+    def test_flush_switches_to_primary(self):
+        with self.app.test_request_context():
+            db.session.info['replica'] = self.replica
+            count = sa.select(sa.func.count()).select_from(Post)
+            self.assertEqual(db.session.scalar(count), 1)
+            db.session.add(Post(title='newer', body='newer post', user_id=1))
+            db.session.flush()
+            self.assertEqual(db.session.scalar(count), 3)
+            db.session.rollback()
+
+
+class ProfilerCase(unittest.TestCase):
+    def setUp(self):
+        class ProfilerConfig(TestConfig):
+            SQL_PROFILER = True
+        self.app = create_app(ProfilerConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_sql_profiler(self):
+        admin = User(username='admin', email='admin@example.com', role='admin')
+        db.session.add(admin)
+        db.session.commit()
+
+        def twice():
+            db.session.scalar(sa.select(User).where(User.username == 'admin'))
+            db.session.scalar(sa.select(User).where(User.username == 'admin'))
+            return 'ok'
+        self.app.add_url_rule('/twice', view_func=twice)
+
+        self.app.config['SQL_SLOW_QUERY_THRESHOLD'] = 0
+        with self.assertLogs(self.app.logger.getChild('sql'), 'WARNING') as logs:
+            response = self.client.get('/twice')
+        self.assertIn('in GET /twice: SELECT user.id', logs.output[0])
+        timing = response.headers.getlist('Server-Timing')
+        self.assertTrue(timing[0].startswith('db;dur='), timing)
+        self.assertIn('desc="2 queries"', timing[0])
+        self.assertTrue(timing[1].startswith('app;dur='), timing)
+        self.app.config['SQL_SLOW_QUERY_THRESHOLD'] = 10
+
+        profile = profiler.recent()[0]
+        self.assertEqual(profile['path'], '/twice')
+        self.assertEqual(profile['queries'], 2)
+        self.assertEqual(len(profile['duplicates']), 1)
+        self.assertEqual(profile['duplicates'][0][1], 2)
+
+        admin.set_password('cat')
+        db.session.commit()
+        self.client.post('/auth/login', data={'username': 'admin', 'password': 'cat'})
+        html = self.client.get('/admin/sql').get_data(as_text=True)
+        self.assertIn('GET /twice', html)
+        self.assertIn('2 times', html)
+        admin.role = 'user'
+        db.session.commit()
+        self.assertEqual(self.client.get('/admin/sql').status_code, 302)
+
+
+class RouteCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, user, password):
+        user.set_password(password)
+        db.session.commit()
+        self.client.post('/auth/login', data={'username': user.username,
+                                              'password': password})
+
+    def test_bulk_moderation(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.app.config.update(UPLOAD_FOLDER=folder, MODERATION_CHUNK_SIZE=2, TIMELINE_FANOUT=True)
+        admin = User(username='admin', email='admin@example.com', role='admin')
+        john = User(username='john', email='john@example.com')
+        susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([admin, john, susan])
+        db.session.flush()
+        susan.follow(john)
+        blob = Blob(hash='b' * 64, extension='jpg', size=3)
+        db.session.add(blob)
+        with open(os.path.join(folder, blob.filename), 'w') as f:
+            f.write('jpg')
+        posts = [Post(title=f'cats {i}', body='pending', author=john) for i in range(5)]
+        posts[4].image = blob.filename
+        db.session.add_all(posts)
+        db.session.flush()
+        db.session.add(Comment(body='hi', author=susan, post=posts[4]))
+        db.session.commit()
+        self.login(admin, 'cat')
+        pending = '<p class="display-6 fw-bold">{}</p>'
+        self.assertIn(pending.format(5), self.client.get('/admin/dashboard').get_data(as_text=True))
+
+        ids = [posts[0].id, posts[1].id, posts[2].id]
+        response = self.client.post('/admin/posts/bulk', data={
+            'action': 'approve', 'post_ids': ids, 'next': '/admin/dashboard'})
+        self.assertEqual(response.location, '/admin/dashboard')
+        db.session.expire_all()
+        self.assertEqual([p.is_approved for p in posts], [True] * 3 + [False] * 2)
+        self.assertEqual([p.version for p in posts[:3]], [2] * 3)
+        self.assertEqual(Post.search('cats', 1, 10)[1], 3)
+        feed = db.session.scalars(susan.home_timeline()).all()
+        self.assertEqual({p.id for p in feed}, set(ids))
+        self.assertEqual(db.session.scalar(sa.select(sa.func.sum(DailyPostStats.approved))), 3)
+        # the cached total is dropped along with the explore pages
+        self.assertIn(pending.format(2), self.client.get('/admin/dashboard').get_data(as_text=True))
+
+        # everything still pending, not only the selection
+        self.client.post('/admin/posts/bulk', data={
+            'action': 'delete', 'scope': 'all', 'status': 'pending'})
+        db.session.expire_all()
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(Post)), 3)
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(Comment)), 0)
+        self.assertEqual(db.session.scalar(sa.select(sa.func.sum(DailyPostStats.posts))), 3)
+        self.assertIsNone(db.session.get(Blob, 'b' * 64))
+        self.assertEqual(os.listdir(folder), [])
+
+        # approved posts leave the search index and the timelines
+        self.client.post('/admin/posts/bulk', data={
+            'action': 'delete', 'scope': 'all', 'status': 'approved'})
+        self.assertEqual(Post.search('cats', 1, 10)[1], 0)
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(timeline)), 0)
+        html = self.client.get('/admin/dashboard').get_data(as_text=True)
+        self.assertIn('3 posts deleted.', html)
+
+    def test_avatar_route(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.app.config['AVATAR_FOLDER'] = folder
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        url = f'/avatars/{u.avatar_hash}/64'
+        rv = self.client.get(url)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.mimetype, 'image/png')
+        self.assertIn('immutable', rv.headers['Cache-Control'])
+        with Image.open(io.BytesIO(rv.data)) as image:
+            self.assertEqual(image.size, (64, 64))
+        self.assertEqual(os.listdir(folder), [f'{u.avatar_hash}-64.png'])
+        rv = self.client.get(url, headers={'If-None-Match': rv.headers['ETag']})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(self.client.get(f'/avatars/{u.avatar_hash}/65').status_code, 404)
+        self.assertEqual(self.client.get('/avatars/' + '0' * 32 + '/64').status_code, 404)
+        self.assertEqual(self.client.get('/avatars/nothex/64').status_code, 404)
+
+    def test_password_reset_queues_email(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        with self.app.test_request_context():
+            send_password_reset_email(u)
+        db.session.commit()
+        job = db.session.scalar(sa.select(Job))
+        self.assertEqual((job.name, job.status), ('send_email', 'queued'))
+        self.assertEqual(job.payload['recipients'], ['john@example.com'])
+
+    def test_comment_count(self):
+        u = User(username='john', email='john@example.com')
+        p = Post(title='one', body='post', author=u, is_approved=True)
+        db.session.add_all([u, p])
+        db.session.commit()
+        self.login(u, 'cat')
+        self.client.post(f'/post/{p.id}/comment', data={'body': 'first'})
+        self.client.post(f'/post/{p.id}/comment', data={'body': 'second'})
+        db.session.refresh(p)
+        self.assertEqual(p.comment_count(), 2)
+
+    def test_last_seen(self):
+        an_hour_ago = datetime.now(timezone.utc) - timedelta(hours=1)
+        u = User(username='john', email='john@example.com', last_seen=an_hour_ago)
+        db.session.add(u)
+        self.login(u, 'cat')
+        before = last_seen.stats()
+        self.client.get('/explore')
+        db.session.refresh(u)
+        self.assertGreater(u.last_seen, an_hour_ago.replace(tzinfo=None))
+        first = u.last_seen
+
+        # a second hit inside the window is neither buffered nor written
+        with QueryCounter() as queries:
+            self.client.get('/explore')
+        self.assertFalse(any(q.startswith('UPDATE') for q in queries.statements))
+        db.session.refresh(u)
+        self.assertEqual(u.last_seen, first)
+        after = last_seen.stats()
+        self.assertGreaterEqual(after['skipped'] - before['skipped'], 1)
+        self.assertEqual(after['pending'], 0)
+
+    def test_exports(self):
+        admin = User(username='admin', email='admin@example.com', role='admin')
+        users = [User(username=f'user{i}', email=f'user{i}@example.com')
+                 for i in range(5)]
+        db.session.add_all([admin] + users)
+        for u in users:
+            u.follow(admin)
+            db.session.add(Post(title=f'by {u.username}', body='post', author=u,
+                                num_comments=2))
+        db.session.commit()
+        self.login(admin, 'cat')
+
+        with QueryCounter() as queries:
+            response = self.client.get('/admin/export_users')
+            rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual(len(rows), 7)
+        self.assertEqual(rows[1][1], 'admin')
+        self.assertEqual(rows[1][5:], ['5', '0'])
+        # at most the logged in user, then the export itself
+        self.assertLessEqual(queries.count, 2, queries.statements)
+
+        with QueryCounter() as queries:
+            response = self.client.get('/admin/report/export?order=title_asc')
+            rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[1][1:5], ['by user0', 'user0', 'Pending', '2'])
+        self.assertLessEqual(queries.count, 2, queries.statements)
+
+    def test_analytics(self):
+        admin = User(username='admin', email='admin@example.com', role='admin')
+        now = datetime.now(timezone.utc)
+        yesterday = now - timedelta(days=1)
+        posts = [Post(title=str(i), body='post', author=admin, timestamp=ts)
+                 for i, ts in enumerate([yesterday, yesterday, now])]
+        db.session.add_all([admin] + posts)
+        db.session.commit()
+        posts[0].is_approved = True
+        db.session.delete(posts[1])
+        db.session.commit()
+
+        def stats():
+            return {(s.day, s.posts, s.approved)
+                    for s in db.session.scalars(sa.select(DailyPostStats))}
+        expected = {(yesterday.date(), 1, 1), (now.date(), 1, 0)}
+        self.assertEqual(stats(), expected)
+        self.assertEqual(DailyPostStats.rebuild(), 2)
+        self.assertEqual(stats(), expected)
+
+        self.login(admin, 'cat')
+        for rollup in (True, False):
+            self.app.config['ANALYTICS_ROLLUP'] = rollup
+            response = self.client.get('/admin/analytics')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(f'"{yesterday.date().isoformat()}"',
+                          response.get_data(as_text=True))
+
+    def test_report(self):
+        self.app.config['POSTS_PER_PAGE'] = 2
+        admin = User(username='admin', email='admin@example.com', role='admin')
+        posts = [Post(title=t, body='post', author=admin, is_approved=t != 'b')
+                 for t in 'cadb']
+        db.session.add_all([admin] + posts)
+        db.session.commit()
+        self.login(admin, 'cat')
+
+        with QueryCounter() as queries:
+            response = self.client.get('/admin/report?order=title_desc')
+        # the page (authors joined in) and the metrics, plus at most the user
+        self.assertLessEqual(queries.count, 3, queries.statements)
+        html = response.get_data(as_text=True)
+        self.assertLess(html.index('<td>d</td>'), html.index('<td>c</td>'))
+        self.assertNotIn('<td>b</td>', html)
+        next_url = re.search(r'href="(/admin/report\?[^"]*cursor=[^"]*)"', html)
+        html = self.client.get(next_url.group(1).replace('&amp;', '&')).get_data(as_text=True)
+        self.assertLess(html.index('<td>b</td>'), html.index('<td>a</td>'))
+        self.assertNotIn('<td>c</td>', html)
+
+    def test_explore_query_count(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        for i in range(5):
+            p = Post(title=str(i), body='post', author=u, is_approved=True,
+                     num_comments=2)
+            db.session.add(p)
+            db.session.add_all([Comment(body='hi', author=u, post=p),
+                                Comment(body='ho', author=u, post=p)])
+        db.session.commit()
+        db.session.expunge_all()
+        with QueryCounter() as queries:
+            response = self.client.get('/explore')
+        self.assertEqual(response.status_code, 200)
+        # one query for the page of posts, one for their (shared) author
+        self.assertEqual(queries.count, 2, queries.statements)
+
+    def test_query_budgets(self):
+        admin = User(username='admin', email='admin@example.com', role='admin')
+        users = [User(username=f'user{i}', email=f'user{i}@example.com') for i in range(6)]
+        db.session.add_all([admin] + users)
+        admin.follow(admin)
+        for u in users:
+            admin.follow(u)
+        first = Post(title='first', body='hello', author=users[0], is_approved=True)
+        db.session.add(first)
+        for i, u in enumerate(users):
+            db.session.add_all([
+                Post(title=f'approved {i}', body='hello', author=u, is_approved=True),
+                Post(title=f'pending {i}', body='hello', author=u),
+                Comment(body=f'comment {i}', author=u, post=first),
+            ])
+        db.session.flush()
+        for post in db.session.scalars(sa.select(Post).where(Post.is_approved.is_(True))):
+            post.fan_out()
+        db.session.commit()
+        self.login(admin, 'cat')
+
+        # the number of queries must not grow with the number of authors
+        budgets = {
+            '/index': 3,
+            '/explore': 2,
+            f'/post/{first.id}': 3,
+            '/user/user1': 3,
+            '/search?query=hello': 4,
+            '/admin/dashboard': 5,
+            '/admin/all_posts': 2,
+            f'/admin/post/{first.id}': 1,
+        }
+        for url, budget in budgets.items():
+            cache.clear()
+            db.session.expunge_all()
+            with self.subTest(url=url), QueryCounter(budget):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+        self.assertIn('comment 5', self.client.get(f'/post/{first.id}').get_data(as_text=True))
+
+    def test_sql_profiler_off(self):
+        # off by default: no per-request timing is sent to visitors
+        response = self.client.get('/auth/login')
+        self.assertNotIn('Server-Timing', response.headers)
+
+    def test_explore_page_cache(self):
+        u = User(username='john', email='john@example.com')
+        p = Post(title='first', body='post', author=u, is_approved=True)
+        db.session.add(p)
+        db.session.commit()
+        # the in-process backend cannot tell other workers about new posts
+        self.client.get('/explore')
+        with QueryCounter() as queries:
+            self.client.get('/explore')
+        self.assertGreater(queries.count, 0)
+
+        self.app.config['CACHE_PAGES'] = True
+        self.client.get('/explore')
+        with QueryCounter() as queries:
+            response = self.client.get('/explore')
+        self.assertEqual(queries.count, 0, queries.statements)
+        self.assertIn('first', response.get_data(as_text=True))
+
+        # a new comment changes the card and starts a new page generation
+        version = p.version
+        self.login(u, 'cat')
+        self.client.post(f'/post/{p.id}/comment', data={'body': 'hi'})
+        self.assertEqual(db.session.get(Post, p.id).version, version + 1)
+        self.client.get('/auth/logout')
+        response = self.client.get('/explore')
+        self.assertIn('bi-chat-dots-fill"></i> 1', response.get_data(as_text=True))
+
+        p.title = 'edited'
+        p.touch()
+        db.session.commit()
+        response = self.client.get('/explore')
+        self.assertIn('edited', response.get_data(as_text=True))
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file